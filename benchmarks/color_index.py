@@ -0,0 +1,107 @@
+"""
+Compares ColorIndex with the colormath loops it replaced in cogs.colors.
+
+Run from the repository root
+    python -m benchmarks.color_index [amounts of colors]
+
+For every amount random colors are matched against random targets and
+sorted like the colors command does. The results of the index are checked
+against the old loops which are copied here.
+"""
+
+import argparse
+import random
+import time
+
+from colormath.color_conversions import convert_color
+from colormath.color_diff import delta_e_cie2000
+from colormath.color_objects import LabColor, sRGBColor
+
+from utils.colorindex import ColorIndex, delta_e_cie2000 as delta_e_vectorized
+
+
+class Color:
+    def __init__(self, lab):
+        self.lab = lab
+
+
+def legacy_closest_color_match(lab, colors):
+    closest_match = None
+    similarity = 0
+    for c in colors:
+        d = 100 - delta_e_cie2000(c.lab, lab)
+        if d > similarity:
+            similarity = d
+            closest_match = c
+
+    return closest_match, similarity
+
+
+def legacy_sort_by_color(colors, start):
+    colors = list(colors)
+    color, _ = legacy_closest_color_match(start, colors)
+    sorted_colors = [color]
+    colors.remove(color)
+
+    while colors:
+        closest, _ = legacy_closest_color_match(sorted_colors[-1].lab, colors)
+        colors.remove(closest)
+        sorted_colors.append(closest)
+
+    return sorted_colors
+
+
+def random_lab():
+    rgb = sRGBColor(random.random(), random.random(), random.random())
+    return convert_color(rgb, LabColor)
+
+
+def timed(func):
+    t = time.perf_counter()
+    result = func()
+    return result, (time.perf_counter() - t) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('amounts', nargs='*', type=int, default=[50, 200, 1000],
+                        help='Amounts of colors to test with')
+    parser.add_argument('-t', '--targets', type=int, default=100,
+                        help='How many colors are matched against the colors')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    start = convert_color(sRGBColor(0, 0, 1/255), LabColor)
+    print(f'{"colors":>7} {"match loop":>11} {"match index":>12} {"sort loop":>11} {"sort index":>11} {"max diff":>9}  same')
+    for amount in args.amounts:
+        colors = [Color(random_lab()) for _ in range(amount)]
+        targets = [random_lab() for _ in range(args.targets)]
+
+        old_matches, old_match_ms = timed(lambda: [legacy_closest_color_match(t, colors) for t in targets])
+
+        def index_matches():
+            index = ColorIndex(colors)
+            return [index.closest(t) for t in targets]
+
+        new_matches, new_match_ms = timed(index_matches)
+        old_sorted, old_sort_ms = timed(lambda: legacy_sort_by_color(colors, start))
+        new_sorted, new_sort_ms = timed(lambda: ColorIndex(colors).sorted(start))
+
+        same = all(a[0] is b[0] for a, b in zip(old_matches, new_matches))
+        same = same and all(a is b for a, b in zip(old_sorted, new_sorted))
+        max_diff = max(abs(a[1] - b[1]) for a, b in zip(old_matches, new_matches))
+
+        # Check the raw delta E values pair by pair too
+        lab = ColorIndex(colors).lab
+        for t in targets[:10]:
+            expected = [delta_e_cie2000(c.lab, t) for c in colors]
+            got = delta_e_vectorized(lab, t.get_value_tuple())
+            max_diff = max(max_diff, max(abs(a - b) for a, b in zip(expected, got)))
+
+        print(f'{amount:>7} {old_match_ms:>9.1f}ms {new_match_ms:>10.1f}ms '
+              f'{old_sort_ms:>9.1f}ms {new_sort_ms:>9.1f}ms {max_diff:>9.2g}  {same}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+"""
+Compares the frame stack operations with the per frame PIL versions they replaced.
+
+Run from the repository root
+    python -m benchmarks.frame_ops [gif or image files]
+
+Tinting, transparency masking and frame repetition are timed on the same
+frames, separately and chained like gradient_flash does them. The old
+versions are copied here since they're gone from imagetools.
+"""
+
+import argparse
+import os
+import time
+
+from PIL import Image, ImageChops
+
+from utils.imagetools import (get_frame_stack, unstack_frames, tint_frames,
+                              repeat_frames, apply_transparency, quantize_frames,
+                              transparent_mask)
+
+
+def tint_colors(n):
+    # Red to blue so every frame has a different color like in gradient_flash
+    return [(255, 0, int(i * 255 / max(n - 1, 1))) for i in range(n)]
+
+
+def legacy_tint(frames):
+    images = []
+    for frame, color in zip(frames, tint_colors(len(frames))):
+        im = Image.new('RGBA', frame.size, color)
+        images.append(ImageChops.multiply(frame, im))
+    return images
+
+
+def legacy_transparency(frames):
+    images = []
+    for img in frames:
+        alpha = img.split()[3]
+        img = img.convert('P', palette=Image.ADAPTIVE, colors=255)
+        mask = Image.eval(alpha, lambda a: 255 if a <= 128 else 0)
+        img.paste(255, mask=mask)
+        img.info['transparency'] = 255
+        img.info['background'] = 255
+        images.append(img)
+    return images
+
+
+def legacy_repeat(frames):
+    frames = list(frames)
+    while len(frames) <= 20:
+        frames.extend([frame.copy() for frame in frames])
+    return frames
+
+
+def timed(func, repeat):
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - t
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='*', default=[os.path.join('data', 'templates', 'jotaro_photo.gif')],
+                        help='Images to use as frames')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='How many times each operation is run. The fastest run is reported')
+    args = parser.parse_args()
+
+    for path in args.paths:
+        stack, duration = get_frame_stack(Image.open(path), max_size=600)
+        frames = unstack_frames(stack)
+        n, h, w = stack.shape[:3]
+        print(f'{path} ({n} frames, {w}x{h})')
+
+        def legacy_all():
+            legacy_transparency(legacy_tint(legacy_repeat(frames)))
+
+        def stack_all():
+            repeated, _ = repeat_frames(stack, duration, 20)
+            tinted = tint_frames(repeated, tint_colors(len(repeated)))
+            indices, _ = quantize_frames(tinted)
+            indices[transparent_mask(tinted)] = 255
+
+        cases = [
+            ('tint', lambda: legacy_tint(frames), lambda: tint_frames(stack, tint_colors(n))),
+            ('transparency', lambda: legacy_transparency(frames), lambda: apply_transparency(frames)),
+            ('repeat', lambda: legacy_repeat(frames), lambda: repeat_frames(stack, duration, 20)),
+            ('all', legacy_all, stack_all),
+        ]
+        print(f'  {"":<14} {"per frame":>10} {"stack":>10}')
+        for name, old, new in cases:
+            old_ms = timed(old, args.repeat)
+            new_ms = timed(new, args.repeat)
+            print(f'  {name:<14} {old_ms:>8.1f}ms {new_ms:>8.1f}ms')
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Compares output size and encoding time of the gif encoders.
+
+Run from the repository root
+    python -m benchmarks.gif_encoding [gif files or folders]
+
+Every gif is decoded once and then encoded with a plain PIL save, the
+ImageMagick pipeline (when convert is installed) and encode_gif with a
+few different tolerances.
+"""
+
+import argparse
+import os
+import shutil
+import time
+from io import BytesIO
+
+from PIL import Image
+
+from utils.imagetools import (convert_frames, get_duration, encode_gif,
+                              MAGICK, MAGICK_ENCODER, PIL_ENCODER)
+
+
+def find_gifs(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.lower().endswith('.gif'):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def pil_save(frames, duration):
+    data = BytesIO()
+    frames[0].save(data, format='GIF', save_all=True, append_images=frames[1:],
+                   duration=duration, loop=65535)
+    return data
+
+
+def timed(func, repeat):
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        data = func()
+        elapsed = time.perf_counter() - t
+        best = elapsed if best is None else min(best, elapsed)
+
+    return len(data.getvalue()), best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='*', default=[os.path.join('data', 'templates')],
+                        help='Gif files or folders containing gifs')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='How many times each encoder is run. The fastest run is reported')
+    parser.add_argument('-t', '--tolerance', type=int, nargs='*', default=[0, 8, 16],
+                        help='Tolerances used with the in process encoder')
+    args = parser.parse_args()
+
+    magick = shutil.which(MAGICK.strip() or 'convert') is not None
+    if not magick:
+        print('ImageMagick not found. Skipping the magick encoder\n')
+
+    totals = {}
+    for path in find_gifs(args.paths):
+        img = Image.open(path)
+        frames = convert_frames(img, 'RGBA')
+        duration = get_duration(frames)
+        duration = duration[:len(frames)]
+
+        encoders = [('pil save', lambda: pil_save(frames, duration))]
+        if magick:
+            encoders.append(('magick', lambda: encode_gif(frames, duration, encoder=MAGICK_ENCODER)))
+        for tolerance in args.tolerance:
+            encoders.append((f'encode_gif t={tolerance}',
+                             lambda t=tolerance: encode_gif(frames, duration, encoder=PIL_ENCODER, tolerance=t)))
+
+        print(f'{path} ({len(frames)} frames, {img.width}x{img.height}, {os.path.getsize(path)/1024:.0f}kB)')
+        for name, func in encoders:
+            size, ms = timed(func, args.repeat)
+            total = totals.setdefault(name, [0, 0])
+            total[0] += size
+            total[1] += ms
+            print(f'  {name:<18} {size/1024:>9.1f}kB {ms:>9.1f}ms')
+        print()
+
+    if totals:
+        print('Total')
+        for name, (size, ms) in totals.items():
+            print(f'  {name:<18} {size/1024:>9.1f}kB {ms:>9.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Compares HashIndex with the boolean matrix cogs.pokemon used to match spawns.
+
+Run from the repository root
+    python -m benchmarks.phash_index [amounts of queries]
+
+Queries are the known sprite hashes with random bits flipped to imitate
+spawn images that aren't exactly the same as the sprites. Loading time is
+measured for building the matrix from the json like the cog used to and
+for loading the saved binary index.
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+
+from utils.hashindex import HashIndex, pack_bits
+
+HASHES = os.path.join('data', 'pokestats', 'pokemon_hashes.json')
+
+
+def legacy_hex_to_hash(hexstr):
+    # Same as imagehash.hex_to_hash
+    hash_size = int(np.sqrt(len(hexstr)*4))
+    binary_array = '{:0>{width}b}'.format(int(hexstr, 16), width=hash_size * hash_size)
+    bit_rows = [binary_array[i:i+hash_size] for i in range(0, len(binary_array), hash_size)]
+    return np.array([[bool(int(d)) for d in row] for row in bit_rows])
+
+
+def legacy_load():
+    with open(HASHES, 'r', encoding='utf-8') as f:
+        poke_hashes = json.load(f)
+    names = list(poke_hashes.values())
+    only_hash = np.array(list(map(lambda h: legacy_hex_to_hash(h).flatten(), poke_hashes.keys())))
+    return only_hash, names
+
+
+def legacy_match(only_hash, bits):
+    hammingdiff = (only_hash != bits.reshape(1, -1)).sum(axis=1)
+    idx = np.argmin(hammingdiff)
+    return idx, hammingdiff[idx]
+
+
+def timed(func):
+    t = time.perf_counter()
+    result = func()
+    return result, (time.perf_counter() - t) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('amounts', nargs='*', type=int, default=[100, 1000, 10000],
+                        help='Amounts of queries to test with')
+    parser.add_argument('-f', '--flips', type=int, default=20,
+                        help='Max amount of bits flipped in the queries')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    (only_hash, names), legacy_load_ms = timed(legacy_load)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'hashes.bin')
+        index, build_ms = timed(lambda: HashIndex.load_or_build(HASHES, path))
+        index, load_ms = timed(lambda: HashIndex.load(path))
+
+    print(f'{len(names)} hashes. Legacy load {legacy_load_ms:.1f}ms, '
+          f'build index {build_ms:.1f}ms, load index {load_ms:.2f}ms')
+    print(f'Memory: matrix {only_hash.nbytes} bytes, index {index.hashes.nbytes} bytes')
+    print(f'{"queries":>8} {"legacy":>10} {"index":>10} {"per query":>10}  same')
+    for amount in args.amounts:
+        queries = []
+        for _ in range(amount):
+            bits = only_hash[random.randrange(len(only_hash))].copy()
+            for i in random.sample(range(bits.size), random.randint(0, args.flips)):
+                bits[i] = not bits[i]
+            queries.append(bits)
+
+        old, old_ms = timed(lambda: [legacy_match(only_hash, q) for q in queries])
+        packed = [pack_bits(q) for q in queries]
+        new, new_ms = timed(lambda: [index.nearest(q) for q in packed])
+
+        same = index.names == names and all(o[0] == n[0] and o[1] == n[1] for o, n in zip(old, new))
+        print(f'{amount:>8} {old_ms:>8.1f}ms {new_ms:>8.1f}ms {new_ms / amount * 1000:>8.1f}us  {same}')
+
+
+if __name__ == '__main__':
+    main()
@@ -33,6 +33,10 @@ from sqlalchemy.exc import SQLAlchemyError
 
 from bot.botbase import BotBase
 from bot.cooldown import CooldownManager
+from bot.imagefetcher import ImageFetcher
+from bot.rendercache import RenderCache
+from bot.renderpool import RenderPool
+from utils.templates import templates
 from utils.utilities import (split_string, slots2dict, retry, random_color)
 
 logger = logging.getLogger('debug')
@@ -56,6 +60,32 @@ class NotABot(BotBase):
         self._server = WebhookServer(self)
         self.redis = None
         self.antispam = True
+        config = self.config
+        # Decode templates before the render workers are forked so they share them
+        templates.preload(config.template_memory*1024*1024)
+        self._render_pool = RenderPool(self.loop, workers=config.render_workers,
+                                       max_in_flight=config.render_max_in_flight,
+                                       max_queue=config.render_max_queue,
+                                       max_per_guild=config.render_max_per_guild)
+        self._render_cache = RenderCache(self, max_bytes=config.render_cache_size*1024*1024,
+                                         disk_path=config.render_disk_cache,
+                                         disk_max_bytes=config.render_disk_cache_size*1024*1024,
+                                         source_ttl=config.render_source_ttl)
+        self._image_fetcher = ImageFetcher(self, max_bytes=config.fetch_cache_size*1024*1024,
+                                           ttl=config.fetch_ttl,
+                                           max_pixels=config.max_image_pixels)
+
+    @property
+    def render_pool(self):
+        return self._render_pool
+
+    @property
+    def render_cache(self):
+        return self._render_cache
+
+    @property
+    def image_fetcher(self):
+        return self._image_fetcher
 
     @property
     def server(self):
@@ -159,10 +189,11 @@ class NotABot(BotBase):
             return
 
         # Ignore if user is botbanned
-        if message.author.id != self.owner_id and (await self.dbutil.execute('SELECT 1 FROM `banned_users` WHERE user=%s' % message.author.id)).first():
+        timings = await self.check_botban(message)
+        if timings is None:
             return
 
-        await self.process_commands(message, local_time=local)
+        await self.process_commands(message, local_time=local, timings=timings)
 
         oshit = self.cdm.get_cooldown('oshit')
         channel = message.channel
@@ -0,0 +1,209 @@
+"""
+Index of the downloaded songs in the audio cache folder.
+
+Finding the file of a song used to list the whole cache folder and check
+every file name for the video id, and clearing the cache compared every
+file against every queued song. The index maps video ids to their files
+so both are dict lookups. The folder is only listed once when the index is
+created and the index is updated when songs are downloaded or deleted.
+"""
+
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger('audio')
+terminal = logging.getLogger('terminal')
+
+# Files are named with the template '%(extractor)s-%(id)s-%(title)s.%(ext)s'
+# Youtube ids can have dashes in them but they're always 11 characters long
+_youtube_file = re.compile(r'^youtube-([\w-]{11})-')
+_other_file = re.compile(r'^[^-]+-([^-]+)-')
+
+
+def id_from_filename(name):
+    """Video id from the name of a downloaded file or None if it can't be parsed"""
+    match = _youtube_file.match(name) or _other_file.match(name)
+    if match:
+        return match.group(1)
+
+
+class CachedFile:
+    __slots__ = ('path', 'size', 'last_played')
+
+    def __init__(self, path, size, last_played):
+        self.path = path
+        self.size = size
+        self.last_played = last_played
+
+
+class AudioCache:
+    """
+    Downloaded files by video id in least recently played order.
+    When max_bytes is more than 0 the least recently played files are deleted
+    when the total size goes over it. keep is a function that returns the ids
+    of the songs that must not be deleted, e.g. the ones that are in a queue
+    """
+    def __init__(self, folder, max_bytes=0, keep=None):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.keep = keep
+
+        self._files = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.build_time = 0
+        self.rebuild()
+
+    def __len__(self):
+        return len(self._files)
+
+    def __contains__(self, video_id):
+        return video_id in self._files
+
+    @property
+    def size(self):
+        return self._size
+
+    def rebuild(self):
+        """Reads the cache folder into the index"""
+        t = time.perf_counter()
+        self._files.clear()
+        self._size = 0
+        if not self.folder or not os.path.isdir(self.folder):
+            return
+
+        files = []
+        for entry in os.scandir(self.folder):
+            if not entry.is_file() or entry.name.endswith('.part'):
+                continue
+
+            video_id = id_from_filename(entry.name)
+            if video_id is None:
+                continue
+
+            stat = entry.stat()
+            files.append((stat.st_atime, video_id, entry.path, stat.st_size))
+
+        # Least recently used first
+        files.sort()
+        for last_played, video_id, path, size in files:
+            self._set(video_id, CachedFile(path, size, last_played))
+
+        self.build_time = (time.perf_counter() - t) * 1000
+        terminal.info(f'Indexed {len(self._files)} cached songs ({self._size / 1024**2:.0f}MB) in {self.build_time:.0f}ms')
+        if self.max_bytes > 0 and self._size > self.max_bytes:
+            self.evict()
+
+    def _set(self, video_id, cached):
+        old = self._files.pop(video_id, None)
+        if old is not None:
+            self._size -= old.size
+        self._files[video_id] = cached
+        self._size += cached.size
+
+    def get(self, video_id):
+        """Path of the downloaded file of video_id or None if it's not downloaded"""
+        if video_id is None:
+            return
+
+        cached = self._files.get(video_id)
+        if cached is None:
+            self.misses += 1
+            return
+
+        if not os.path.exists(cached.path):
+            self._remove(video_id)
+            self.misses += 1
+            return
+
+        self.hits += 1
+        return cached.path
+
+    def played(self, video_id):
+        cached = self._files.get(video_id)
+        if cached is not None:
+            cached.last_played = time.time()
+            self._files.move_to_end(video_id)
+
+    def add(self, video_id, path):
+        """Adds a downloaded file to the index and evicts old files if needed"""
+        if video_id is None or path is None:
+            return
+
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return
+
+        self._set(video_id, CachedFile(path, size, time.time()))
+        if self.max_bytes > 0 and self._size > self.max_bytes:
+            self.evict(keep={video_id})
+
+    def _remove(self, video_id):
+        cached = self._files.pop(video_id, None)
+        if cached is not None:
+            self._size -= cached.size
+        return cached
+
+    def remove(self, video_id, delete=True):
+        """Removes video_id from the index and deletes its file. Returns True if a file was deleted"""
+        cached = self._remove(video_id)
+        if cached is None or not delete:
+            return False
+
+        try:
+            os.remove(cached.path)
+        except FileNotFoundError:
+            return False
+        except OSError:
+            # Probably still open. Add it back so it can be deleted later
+            logger.debug(f'Failed to delete {cached.path}')
+            self._set(video_id, cached)
+            self._files.move_to_end(video_id, last=False)
+            return False
+
+        logger.debug(f'Deleted {cached.path}')
+        return True
+
+    def _keep_ids(self, keep):
+        ids = set(keep or ())
+        if self.keep is not None:
+            ids.update(self.keep())
+        return ids
+
+    def evict(self, keep=None):
+        """Deletes the least recently played files until the cache fits in max_bytes"""
+        keep = self._keep_ids(keep)
+        for video_id in list(self._files.keys()):
+            if self._size <= self.max_bytes:
+                break
+
+            if video_id in keep:
+                continue
+
+            if self.remove(video_id):
+                self.evicted += 1
+
+    def clear(self, keep=None):
+        """Deletes every file except the ones in keep. Returns the number of files deleted"""
+        keep = self._keep_ids(keep)
+        deleted = 0
+        for video_id in list(self._files.keys()):
+            if video_id not in keep and self.remove(video_id):
+                deleted += 1
+
+        return deleted
+
+    def stats(self):
+        return {'files': len(self._files),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evicted': self.evicted,
+                'build_time': self.build_time}
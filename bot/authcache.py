@@ -0,0 +1,174 @@
+import asyncio
+import logging
+
+import discord
+
+from bot.globals import BlacklistTypes
+from bot.permresolver import PermResolver
+
+logger = logging.getLogger('debug')
+
+
+class AuthCache:
+    """
+    Keeps botbans, bot staff and command black/whitelists in memory so
+    checks done on every message and command don't need to hit the database.
+    Values are loaded lazily and invalidated by the methods that write
+    to the corresponding tables.
+    """
+    BANNED = 'banned'
+    STAFF = 'staff'
+    GLOBAL = 'global'
+
+    def __init__(self, bot):
+        self._bot = bot
+        self._cache = {}
+        self._loading = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def bot(self):
+        return self._bot
+
+    def _start_load(self, key, load):
+        task = asyncio.ensure_future(load(), loop=self.bot.loop)
+        self._loading[key] = task
+
+        def on_done(fut):
+            # If the key was invalidated while loading the result is stale
+            if self._loading.get(key) is not fut:
+                return
+
+            del self._loading[key]
+            if not fut.cancelled() and fut.exception() is None:
+                self._cache[key] = fut.result()
+
+        task.add_done_callback(on_done)
+        return task
+
+    async def _get(self, key, load):
+        try:
+            value = self._cache[key]
+        except KeyError:
+            pass
+        else:
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        task = self._loading.get(key)
+        if task is None:
+            task = self._start_load(key, load)
+
+        # Shield so one cancelled waiter doesn't cancel the load for everyone
+        return await asyncio.shield(task)
+
+    def _invalidate(self, key):
+        self._cache.pop(key, None)
+        self._loading.pop(key, None)
+
+    async def _load_banned(self):
+        rows = await self.bot.dbutil.execute('SELECT `user` FROM `banned_users`')
+        return {r['user'] for r in rows}
+
+    async def _load_staff(self):
+        rows = await self.bot.dbutil.execute('SELECT `user`, `auth_level` FROM `bot_staff`')
+        return {r['user']: r['auth_level'] for r in rows}
+
+    async def _load_global(self):
+        sql = 'SELECT `command`, `user` FROM `command_blacklist` WHERE type=%s' % BlacklistTypes.GLOBAL
+        return {(r['command'], r['user']) for r in await self.bot.dbutil.execute(sql)}
+
+    def _guild_loader(self, guild_id):
+        async def load():
+            sql = 'SELECT `id`, `type`, `command`, `user`, `role`, `channel` FROM `command_blacklist` WHERE guild=%s' % guild_id
+            return PermResolver(await self.bot.dbutil.execute(sql))
+
+        return load
+
+    async def is_banned(self, user_id):
+        return user_id in await self._get(self.BANNED, self._load_banned)
+
+    async def auth_level(self, user_id):
+        return (await self._get(self.STAFF, self._load_staff)).get(user_id, 0)
+
+    async def global_blacklist(self):
+        return await self._get(self.GLOBAL, self._load_global)
+
+    async def guild_resolver(self, guild_id):
+        return await self._get(('guild', guild_id), self._guild_loader(guild_id))
+
+    def set_banned(self, user_id, banned):
+        users = self._cache.get(self.BANNED)
+        if users is None:
+            # Cache not loaded yet. Make sure an ongoing load isn't used
+            self._invalidate(self.BANNED)
+            return
+
+        if banned:
+            users.add(user_id)
+        else:
+            users.discard(user_id)
+
+    def invalidate_staff(self):
+        self._invalidate(self.STAFF)
+
+    def invalidate_blacklist(self, guild_id=None):
+        """Invalidates the blacklist of a guild or the global blacklist if guild_id is None"""
+        if guild_id is None:
+            self._invalidate(self.GLOBAL)
+        else:
+            self._invalidate(('guild', guild_id))
+
+    def set_blacklist_row(self, guild_id, row):
+        """Adds or updates a row in the guilds resolver if it has been loaded"""
+        resolver = self._cache.get(('guild', guild_id))
+        if resolver is None:
+            self.invalidate_blacklist(guild_id)
+            return
+
+        resolver.add_row(row)
+
+    def remove_blacklist_row(self, guild_id, row_id):
+        resolver = self._cache.get(('guild', guild_id))
+        if resolver is None:
+            self.invalidate_blacklist(guild_id)
+            return
+
+        resolver.remove_row(row_id)
+
+    def clear(self):
+        self._cache.clear()
+        self._loading.clear()
+
+    def stats(self):
+        guilds = sum(1 for k in self._cache if isinstance(k, tuple))
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0,
+                'cached_guilds': guilds,
+                'banned_loaded': self.BANNED in self._cache,
+                'staff_loaded': self.STAFF in self._cache}
+
+    async def check_blacklist(self, command, user, ctx, fetch_raw: bool=False):
+        """
+        Same as DatabaseUtils.check_blacklist but resolved from memory.
+        Unlike the db version command is the name of the command instead of an sql clause
+        """
+        global_blacklist = await self.global_blacklist()
+        if global_blacklist:
+            for key in ((command, user.id), (command, None), (None, user.id), (None, None)):
+                if key in global_blacklist:
+                    return False
+
+        if ctx.guild is None:
+            return True
+
+        if isinstance(user, discord.Member) and user.roles:
+            roles = [r.id for r in user.roles]
+        else:
+            roles = ()
+
+        resolver = await self.guild_resolver(user.guild.id)
+        return resolver.resolve(command, user.id, roles, ctx.channel.id, return_raw=fetch_raw)
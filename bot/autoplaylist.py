@@ -0,0 +1,262 @@
+"""
+Indexed access to the autoplaylist file.
+
+Picking a random autoplaylist song used to read the whole file into a list
+every time. The file is now memory mapped and the offsets of its lines are
+kept in arrays so a random line can be read without reading the others.
+The file keeps its one url per line format so it can still be edited by hand.
+"""
+
+import logging
+import mmap
+import os
+import random
+import zlib
+from collections import deque
+
+import numpy as np
+
+from bot.globals import AUTOPLAYLIST
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+terminal = logging.getLogger('terminal')
+
+
+class _FileLock:
+    """Exclusive lock shared with other processes that write to the same file"""
+    def __init__(self, path):
+        self.path = path + '.lock'
+        self._f = None
+
+    def __enter__(self):
+        self._f = open(self.path, 'a')
+        if fcntl is not None:
+            fcntl.flock(self._f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if fcntl is not None:
+            fcntl.flock(self._f, fcntl.LOCK_UN)
+        self._f.close()
+        self._f = None
+
+
+class AutoplaylistStore:
+    """
+    Random access to the lines of a playlist file.
+
+    The index is built the first time a song is read and updated when
+    songs are added through the store. Changes made by other processes are
+    noticed from the size and modification time of the file. If the file
+    only grew and the already indexed part has the same checksum the new
+    lines are indexed and if not the whole file is indexed again. The last recent_size picked songs aren't picked again if
+    there are other songs to choose from.
+    """
+    def __init__(self, path=AUTOPLAYLIST, recent_size=50):
+        self.path = path
+        self.recent = deque(maxlen=recent_size)
+        self._recent = set()
+
+        self._file = None
+        self._mmap = None
+        self._starts = np.empty(0, dtype=np.int64)
+        self._ends = np.empty(0, dtype=np.int64)
+        self._stat = None
+        # crc32 of the indexed part of the file
+        self._crc = 0
+        self.reindexed = 0
+
+    def __len__(self):
+        self._check()
+        return len(self._starts)
+
+    def __iter__(self):
+        self._check()
+        for idx in range(len(self._starts)):
+            yield self[idx]
+
+    def __getitem__(self, idx):
+        start, end = int(self._starts[idx]), int(self._ends[idx])
+        return self._mmap[start:end].decode('utf-8').strip()
+
+    @staticmethod
+    def _stat_key(stat):
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def _close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        self._close()
+        self._stat = None
+        self._crc = 0
+
+    def _checksum(self, start, end, value=0):
+        with memoryview(self._mmap) as view, view[start:end] as part:
+            return zlib.crc32(part, value)
+
+    @staticmethod
+    def _index(buffer, offset=0):
+        """Start and end offsets of the non empty lines in buffer"""
+        data = np.frombuffer(buffer, dtype=np.uint8)
+        if len(data) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        newlines = np.flatnonzero(data == 10)
+        starts = np.concatenate(([0], newlines + 1))
+        ends = np.concatenate((newlines, [len(data)]))
+        # Skip empty lines and lines with only a \r
+        lengths = ends - starts
+        keep = (lengths > 1) | ((lengths == 1) & (data[np.minimum(starts, len(data) - 1)] != 13))
+        return starts[keep] + offset, ends[keep] + offset
+
+    def _map(self, stat):
+        self._close()
+        self._stat = self._stat_key(stat)
+        if stat.st_size == 0:
+            return False
+
+        self._file = open(self.path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return True
+
+    def reload(self):
+        """Indexes the whole file"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self._close()
+            self._stat = None
+            self._crc = 0
+            self._starts = self._ends = np.empty(0, dtype=np.int64)
+            return
+
+        if self._map(stat):
+            self._starts, self._ends = self._index(self._mmap)
+            self._crc = self._checksum(0, stat.st_size)
+        else:
+            self._starts = self._ends = np.empty(0, dtype=np.int64)
+            self._crc = 0
+        self.reindexed += 1
+
+    def _check(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            if self._stat is not None or self._mmap is not None:
+                self.reload()
+            return
+
+        key = self._stat_key(stat)
+        if key == self._stat:
+            return
+
+        old_size = self._stat[1] if self._stat is not None else 0
+        if self._stat is None or key[0] != self._stat[0] or stat.st_size < old_size or old_size == 0:
+            self.reload()
+            return
+
+        # Only appended to if the old part is unchanged. Index the new part
+        # Start from the last indexed line end in case it was unterminated
+        old_end = int(self._ends[-1]) if len(self._ends) else 0
+        if self._map(stat):
+            if self._checksum(0, old_size) != self._crc:
+                # Edited by hand
+                self.reload()
+                return
+
+            self._crc = self._checksum(old_size, stat.st_size, self._crc)
+            starts, ends = self._index(self._mmap[old_end:], offset=old_end)
+            if len(self._ends) and len(starts) and starts[0] == old_end:
+                # The last line was continued
+                starts[0] = self._starts[-1]
+                self._starts, self._ends = self._starts[:-1], self._ends[:-1]
+            self._starts = np.concatenate((self._starts, starts))
+            self._ends = np.concatenate((self._ends, ends))
+
+    def played(self, song):
+        if len(self.recent) == self.recent.maxlen:
+            self._recent.discard(self.recent[0])
+        self.recent.append(song)
+        self._recent.add(song)
+
+    def random(self, tries=10):
+        """Random song that hasn't been played recently or None if there are no songs"""
+        self._check()
+        n = len(self._starts)
+        if n == 0:
+            return
+
+        song = None
+        for _ in range(tries):
+            song = self[random.randrange(n)]
+            if song not in self._recent:
+                break
+
+        self.played(song)
+        return song
+
+    def add(self, songs):
+        """Appends songs to the file in one write. Returns the number of songs added"""
+        songs = [s.strip() for s in songs if s and s.strip()]
+        if not songs:
+            return 0
+
+        data = '\n'.join(songs) + '\n'
+        with _FileLock(self.path):
+            with open(self.path, 'a+b') as f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() > 0:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        data = '\n' + data
+                f.write(data.encode('utf-8'))
+
+        # Only reindex if the file has been read already
+        if self._stat is not None:
+            self._check()
+        return len(songs)
+
+    def delete(self, songs):
+        """
+        Removes every line that is in songs. The file is written to a temp file
+        that replaces the old one so readers never see a partial file.
+        Returns the number of different songs that were found in the file
+        """
+        songs = set(s.strip() for s in songs)
+        if not songs:
+            return 0
+
+        with _FileLock(self.path):
+            self.reload()
+            kept = []
+            found = set()
+            for idx in range(len(self._starts)):
+                line = self[idx]
+                if line in songs:
+                    found.add(line)
+                else:
+                    kept.append(line)
+
+            if not found:
+                return 0
+
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                if kept:
+                    f.write('\n'.join(kept) + '\n')
+            # Windows can't replace a file that is mapped
+            self._close()
+            os.replace(tmp, self.path)
+            self.reload()
+
+        return len(found)
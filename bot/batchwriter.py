@@ -0,0 +1,292 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+
+from sqlalchemy.exc import (DataError, DisconnectionError, IntegrityError,
+                            InterfaceError, OperationalError, SQLAlchemyError,
+                            TimeoutError)
+
+from bot.metrics import Histogram
+
+logger = logging.getLogger('debug')
+terminal = logging.getLogger('terminal')
+
+
+class _DatabaseUnavailable(Exception):
+    def __init__(self, handled):
+        super().__init__()
+        # Amount of rows of the batch that were written or failed before the error
+        self.handled = handled
+
+
+class BatchWriter:
+    """
+    Collects parameters of write statements and executes them in batches.
+    Rows of the same statement are coalesced into one executemany call which
+    the db driver turns into a multi row insert.
+
+    A batch is flushed when max_batch rows are waiting or when flush_interval
+    seconds have passed since the last flush. If a batch fails because of
+    the data it's split in halves until the rows that fail are found so one
+    bad row doesn't lose the rest of the batch. If the database can't be
+    reached the rows that weren't written are put back in the queue and
+    flushing is retried with an increasing delay.
+    Each batch is committed on its own so a failing batch doesn't roll back
+    the batches written before it.
+    When max_queue rows are waiting the overflow policy decides what happens
+        drop_new: New rows are discarded
+        drop_oldest: The oldest waiting row of any statement is discarded
+        block: put waits until there's room
+    """
+    DROP_NEW = 'drop_new'
+    DROP_OLDEST = 'drop_oldest'
+    BLOCK = 'block'
+    POLICIES = (DROP_NEW, DROP_OLDEST, BLOCK)
+    MAX_BACKOFF = 60
+
+    def __init__(self, bot, max_batch=500, flush_interval=2.0, max_queue=20000, overflow=DROP_OLDEST):
+        if overflow not in self.POLICIES:
+            raise ValueError(f'Overflow policy must be one of {", ".join(self.POLICIES)}')
+
+        self._bot = bot
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.overflow = overflow
+
+        self._pending = OrderedDict()
+        # Statement of every waiting row in the order they were added
+        self._order = deque()
+        self._size = 0
+        self._flush_needed = asyncio.Event(loop=bot.loop)
+        self._not_full = asyncio.Event(loop=bot.loop)
+        self._not_full.set()
+        self._closed = False
+        self._task = None
+        self._backoff = 0
+        self._retry_at = 0
+
+        self.dropped = 0
+        self.failed = 0
+        self.retried = 0
+        self.written = 0
+        self.batch_size = Histogram((1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500))
+        self.flush_latency = Histogram()
+
+    @property
+    def bot(self):
+        return self._bot
+
+    @property
+    def queue_depth(self):
+        return self._size
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run(), loop=self.bot.loop)
+        return self._task
+
+    def _drop_oldest(self):
+        # Rows of a statement are in the order they were added so the
+        # first row of the statement of the oldest row is the oldest row
+        sql = self._order.popleft()
+        rows = self._pending[sql]
+        rows.popleft()
+        if not rows:
+            del self._pending[sql]
+        self._size -= 1
+        self.dropped += 1
+
+    def put_nowait(self, sql, params, flush=False):
+        """
+        Add a row or a list of rows to be written. If flush is True the rows
+        are written right away instead of waiting for the batch to fill up.
+        Returns False if any of the rows were dropped because the queue is full
+        """
+        if self._closed:
+            return False
+
+        if not isinstance(params, list):
+            params = [params]
+
+        success = True
+        for row in params:
+            if self._size >= self.max_queue:
+                if self.overflow == self.DROP_OLDEST:
+                    self._drop_oldest()
+                else:
+                    self.dropped += 1
+                    success = False
+                    continue
+
+            self._pending.setdefault(sql, deque()).append(row)
+            self._order.append(sql)
+            self._size += 1
+
+        if flush or self._size >= self.max_batch:
+            self._flush_needed.set()
+        if self._size >= self.max_queue:
+            self._not_full.clear()
+
+        return success
+
+    async def put(self, sql, params, flush=False):
+        if self.overflow == self.BLOCK:
+            while self._size >= self.max_queue and not self._closed:
+                self._flush_needed.set()
+                await self._not_full.wait()
+
+        return self.put_nowait(sql, params, flush=flush)
+
+    async def _run(self):
+        while not self._closed:
+            try:
+                await asyncio.wait_for(self._flush_needed.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                return
+
+            self._flush_needed.clear()
+            if time.monotonic() < self._retry_at:
+                # Database was unavailable. Rows keep collecting until the backoff is over
+                continue
+
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                return
+            except Exception:
+                logger.exception('Unexpected error while flushing batch')
+
+    async def flush(self):
+        if not self._pending:
+            return
+
+        pending = OrderedDict((sql, list(rows)) for sql, rows in self._pending.items())
+        order = self._order
+        self._pending = OrderedDict()
+        self._order = deque()
+        self._size = 0
+        self._not_full.set()
+
+        # Amount of rows of each statement that have been handled
+        handled = {}
+        t = time.perf_counter()
+        try:
+            for sql, rows in pending.items():
+                for i in range(0, len(rows), self.max_batch):
+                    handled[sql] = i
+                    batch = rows[i:i + self.max_batch]
+                    self.batch_size.add(len(batch))
+                    failed = await self._write(sql, batch)
+                    if failed:
+                        logger.error(f'Failed to write {failed} rows of a batch of {len(batch)} rows')
+
+                handled[sql] = len(rows)
+
+        except _DatabaseUnavailable as e:
+            handled[sql] += e.handled
+            self._backoff = min(max(self._backoff * 2, self.flush_interval), self.MAX_BACKOFF)
+            self._retry_at = time.monotonic() + self._backoff
+            requeued = self._requeue(pending, order, handled)
+            logger.warning(f'Database unavailable. Retrying {requeued} rows in {self._backoff}s',
+                           exc_info=e.__cause__)
+
+        else:
+            self._backoff = 0
+            self._retry_at = 0
+
+        self.flush_latency.add((time.perf_counter() - t) * 1000)
+
+    def _requeue(self, pending, order, handled):
+        """
+        Puts rows that weren't handled back in front of the queue.
+        If they don't fit the oldest of them are dropped.
+        Returns the amount of rows put back
+        """
+        seen = dict.fromkeys(pending, 0)
+        rows = []
+        for sql in order:
+            i = seen[sql]
+            seen[sql] += 1
+            if i >= handled.get(sql, 0):
+                rows.append((sql, pending[sql][i]))
+
+        room = max(self.max_queue - self._size, 0)
+        if len(rows) > room:
+            self.dropped += len(rows) - room
+            rows = rows[len(rows) - room:]
+
+        for sql, row in reversed(rows):
+            self._pending.setdefault(sql, deque()).appendleft(row)
+            self._order.appendleft(sql)
+
+        self._size += len(rows)
+        if self._size >= self.max_queue:
+            self._not_full.clear()
+
+        return len(rows)
+
+    @staticmethod
+    def _is_unavailable(e):
+        return isinstance(e, (OperationalError, InterfaceError, DisconnectionError, TimeoutError)) or \
+            getattr(e, 'connection_invalidated', False)
+
+    async def _write(self, sql, rows):
+        """
+        Writes rows and splits them in halves if the data is rejected so only
+        the rows that fail on their own are lost. Returns the amount of lost rows.
+        Raises _DatabaseUnavailable if the database can't be reached
+        """
+        try:
+            await self.bot.dbutil.execute(sql, rows, commit=True)
+            self.written += len(rows)
+            return 0
+        except SQLAlchemyError as e:
+            if self._is_unavailable(e):
+                raise _DatabaseUnavailable(0) from e
+
+            # Splitting only helps when some of the rows are bad
+            if len(rows) == 1 or not isinstance(e, (IntegrityError, DataError)):
+                self.failed += len(rows)
+                logger.debug(f'Failed to write {len(rows)} rows starting with {rows[0]}', exc_info=True)
+                return len(rows)
+
+            self.retried += len(rows)
+
+        half = len(rows) // 2
+        failed = await self._write(sql, rows[:half])
+        try:
+            return failed + await self._write(sql, rows[half:])
+        except _DatabaseUnavailable as e:
+            e.handled += half
+            raise
+
+    async def close(self, timeout=10):
+        """Stops the writer and writes everything still waiting"""
+        self._closed = True
+        self._not_full.set()
+        self._flush_needed.set()
+        if self._task is not None:
+            # Let the ongoing flush finish so rows taken by it aren't lost
+            try:
+                await asyncio.wait_for(self._task, timeout=timeout)
+            except asyncio.TimeoutError:
+                terminal.warning('Batch writer did not stop in time')
+            self._task = None
+
+        await self.flush()
+
+    def stats(self):
+        return {'queue_depth': self._size,
+                'max_queue': self.max_queue,
+                'overflow': self.overflow,
+                'written': self.written,
+                'dropped': self.dropped,
+                'failed': self.failed,
+                'retried': self.retried,
+                'backoff': self._backoff,
+                'batch_size': self.batch_size.to_dict(),
+                'flush_latency': self.flush_latency.to_dict()}
@@ -27,6 +27,7 @@ import inspect
 import itertools
 import logging
 import sys
+import time
 import traceback
 
 import discord
@@ -39,6 +40,7 @@ from discord.ext.commands.errors import CommandError
 from discord.ext.commands.formatter import HelpFormatter, Paginator
 from discord.http import HTTPClient
 
+from bot.commandstats import add_timing
 from bot.formatter import Formatter
 from bot.cooldowns import Cooldown, CooldownMapping
 from bot.globals import Auth
@@ -61,7 +63,7 @@ terminal = logging.getLogger('terminal')
 
 class Context(commands.context.Context):
     __slots__ = ('override_perms', 'skip_check', 'original_user', 'domain',
-                 'received_at')
+                 'received_at', 'timings')
 
     def __init__(self, **attrs):
         super().__init__(**attrs)
@@ -71,6 +73,8 @@ class Context(commands.context.Context):
         self.skip_check = attrs.pop('skip_check', False)
         self.domain = attrs.get('domain', None)
         self.received_at = attrs.get('received_at', None)
+        # Phase timings of the invocation in ms. See bot.commandstats
+        self.timings = attrs.get('timings', None)
 
 
 class Command(commands.Command):
@@ -98,9 +102,27 @@ class Command(commands.Command):
             bucket = self._buckets.get_bucket(ctx.message)
             bucket.undo_one()
 
+    async def prepare(self, ctx):
+        # Checks are timed separately in can_run. The rest is argument conversion
+        timings = getattr(ctx, 'timings', None)
+        if timings is None:
+            return await super().prepare(ctx)
+
+        checks = timings.get('checks', 0) + timings.get('checks_db', 0)
+        t = time.perf_counter()
+        try:
+            await super().prepare(ctx)
+        finally:
+            ms = (time.perf_counter() - t) * 1000
+            add_timing(ctx, 'prepare', ms)
+            add_timing(ctx, 'convert', ms - (timings.get('checks', 0) + timings.get('checks_db', 0) - checks))
+
     async def can_run(self, ctx):
         original = ctx.command
         ctx.command = self
+        # Only timed when checking the command being invoked and not e.g. in help
+        stats = getattr(ctx.bot, 'command_stats', None) if original is self else None
+        start = stats.phase_start() if stats is not None else None
 
         try:
             if not (await ctx.bot.can_run(ctx)):
@@ -126,6 +148,8 @@ class Command(commands.Command):
 
         finally:
             ctx.command = original
+            if start is not None:
+                stats.add_checks(ctx, start)
 
 
 class Group(Command, commands.Group):
@@ -236,6 +260,9 @@ class Bot(commands.Bot, Client):
         self.aiohttp_client = aiohttp
         self.config = config
         self.voice_clients_ = {}
+        # Futures waiting for reactions by message id. Listeners that aren't
+        # for a specific message are in self._listeners['reaction_changed']
+        self._reaction_waiters = {}
         self._error_cdm = CooldownMapping(commands.Cooldown(2, 5, commands.BucketType.guild))
 
     @property
@@ -416,9 +443,18 @@ class Bot(commands.Bot, Client):
 
         return ctx
 
-    async def process_commands(self, message, local_time=None):
+    async def process_commands(self, message, local_time=None, timings=None):
+        t = time.perf_counter()
         ctx = await self.get_context(message, cls=Context)
+        ms = (time.perf_counter() - t) * 1000
         ctx.received_at = local_time
+
+        stats = getattr(self, 'command_stats', None)
+        if stats is not None:
+            stats.prefix.add(ms)
+            ctx.timings = timings if timings is not None else {}
+            ctx.timings['prefix'] = ms
+
         await self.invoke(ctx)
 
     def command(self, *args, **kwargs):
@@ -440,14 +476,49 @@ class Bot(commands.Bot, Client):
 
         return decorator
 
-    def handle_reaction_changed(self, reaction, user):
+    async def wait_for_reaction(self, message, check=None, timeout=None):
+        """
+        Same as wait_for('reaction_changed') but only reactions on the given
+        message are checked so the check isn't called for every reaction the bot sees.
+
+        Args:
+            message: The message or message id to wait reactions on
+            check: Optional predicate that takes the reaction and the user
+            timeout: Seconds to wait before raising asyncio.TimeoutError
+
+        Returns:
+            tuple: (reaction, user)
+        """
+        message_id = getattr(message, 'id', message)
+        if check is None:
+            def check(*_):
+                return True
+
+        future = self.loop.create_future()
+        waiter = (future, check)
+        waiters = self._reaction_waiters.setdefault(message_id, [])
+        waiters.append(waiter)
+
+        try:
+            return await asyncio.wait_for(future, timeout, loop=self.loop)
+        finally:
+            # Removed here so waiters that timed out don't pile up on messages
+            # that never get reactions
+            waiters = self._reaction_waiters.get(message_id)
+            if waiters is not None:
+                try:
+                    waiters.remove(waiter)
+                except ValueError:
+                    pass
+                if not waiters:
+                    self._reaction_waiters.pop(message_id, None)
+
+    @staticmethod
+    def _check_reaction_listeners(listeners, reaction, user):
+        """Runs the checks of listeners and removes the finished ones"""
         removed = []
-        event = 'reaction_changed'
-        listeners = self._listeners.get(event)
-        if not listeners:
-            return
         for i, (future, condition) in enumerate(listeners):
-            if future.cancelled():
+            if future.done():
                 removed.append(i)
                 continue
 
@@ -461,11 +532,25 @@ class Bot(commands.Bot, Client):
                     future.set_result((reaction, user))
                     removed.append(i)
 
-        if len(removed) == len(listeners):
+        for idx in reversed(removed):
+            del listeners[idx]
+
+    def handle_reaction_changed(self, reaction, user):
+        message_id = reaction.message.id
+        waiters = self._reaction_waiters.get(message_id)
+        if waiters:
+            self._check_reaction_listeners(waiters, reaction, user)
+            if not waiters:
+                self._reaction_waiters.pop(message_id, None)
+
+        event = 'reaction_changed'
+        listeners = self._listeners.get(event)
+        if not listeners:
+            return
+
+        self._check_reaction_listeners(listeners, reaction, user)
+        if not listeners:
             self._listeners.pop(event)
-        else:
-            for idx in reversed(removed):
-                del listeners[idx]
 
     def handle_reaction_add(self, reaction, user):
         self.handle_reaction_changed(reaction, user)
@@ -22,6 +22,7 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import importlib.util
 import logging
 import time
 from concurrent.futures import ThreadPoolExecutor
@@ -31,10 +32,14 @@ from sqlalchemy import create_engine
 from sqlalchemy.orm import scoped_session, sessionmaker
 
 from bot import exceptions
+from bot.authcache import AuthCache
 from bot.bot import Bot
+from bot.commandstats import CommandStats, add_timing
+from bot.dbbackend import AiomysqlBackend, SessionBackend
 from bot.dbutil import DatabaseUtils
 from bot.globals import Auth
 from bot.guildcache import GuildCache
+from bot.watchdog import LoopWatchdog
 
 logger = logging.getLogger('debug')
 terminal = logging.getLogger('terminal')
@@ -52,11 +57,19 @@ class BotBase(Bot):
 
         self._guild_cache = GuildCache(self)
         self._dbutil = DatabaseUtils(self)
+        self._auth_cache = AuthCache(self)
         self.call_laters = {}
         self._setup_db()
         self.threadpool = ThreadPoolExecutor(4)
         self.loop.set_default_executor(self.threadpool)
 
+        config = self.config
+        self._command_stats = CommandStats(self, flush_interval=config.command_uses_interval)
+        self._watchdog = LoopWatchdog(self.loop, interval=config.watchdog_interval / 1000,
+                                      threshold=config.watchdog_threshold / 1000)
+        if config.watchdog_threshold > 0:
+            self._watchdog.start()
+
         if cogs:
             self.default_cogs = {'cogs.' + c for c in cogs}
         else:
@@ -64,13 +77,30 @@ class BotBase(Bot):
 
     def _setup_db(self):
         db = 'discord' if not self.test_mode else 'test'
-        engine = create_engine('mysql+pymysql://{0.db_user}:{0.db_password}@{0.db_host}:{0.db_port}/{1}?charset=utf8mb4'.format(self.config, db),
+        config = self.config
+        engine = create_engine('mysql+pymysql://{0.db_user}:{0.db_password}@{0.db_host}:{0.db_port}/{1}?charset=utf8mb4'.format(config, db),
                                encoding='utf8', pool_recycle=36000)
         session_factory = sessionmaker(bind=engine)
         Session = scoped_session(session_factory)
         self._Session = Session
         self._engine = engine
 
+        backend = config.db_backend
+        if backend == 'aiomysql':
+            if importlib.util.find_spec('aiomysql') is None:
+                terminal.warning('aiomysql not installed. Falling back to sqlalchemy database backend')
+                backend = 'sqlalchemy'
+
+        if backend == 'aiomysql':
+            self._db_backend = AiomysqlBackend(self.loop, config.db_host, config.db_port,
+                                               config.db_user, config.db_password, db,
+                                               min_connections=config.db_pool_min,
+                                               max_connections=config.db_pool_max)
+        else:
+            self._db_backend = SessionBackend(self.loop, Session, engine,
+                                              min_connections=config.db_pool_min,
+                                              max_connections=config.db_pool_max)
+
     @staticmethod
     def get_command_prefix(self, message):
         guild = message.guild
@@ -88,6 +118,10 @@ class BotBase(Bot):
     def engine(self):
         return self._engine
 
+    @property
+    def db_backend(self):
+        return self._db_backend
+
     @property
     def guild_cache(self):
         return self._guild_cache
@@ -100,6 +134,18 @@ class BotBase(Bot):
     def dbutils(self):
         return self._dbutil
 
+    @property
+    def auth_cache(self):
+        return self._auth_cache
+
+    @property
+    def watchdog(self):
+        return self._watchdog
+
+    @property
+    def command_stats(self):
+        return self._command_stats
+
     def _load_cogs(self, print_err=True):
         if not print_err:
             errors = []
@@ -138,24 +184,28 @@ class BotBase(Bot):
             return
 
         # Ignore if user is botbanned
-        if message.author.id != self.owner_id and (await self.dbutil.execute('SELECT 1 FROM `banned_users` WHERE user=%s' % message.author.id)).first():
+        timings = await self.check_botban(message)
+        if timings is None:
+            return
+
+        await self.process_commands(message, local_time=local, timings=timings)
+
+    async def check_botban(self, message):
+        """
+        Returns None if the author of message is botbanned. Otherwise returns
+        the timings the invocation of the message starts with
+        """
+        t = time.perf_counter()
+        if message.author.id != self.owner_id and await self.auth_cache.is_banned(message.author.id):
             return
 
-        await self.process_commands(message, local_time=local)
+        return {'ban_check': (time.perf_counter() - t) * 1000}
 
     async def _check_auth(self, user_id, auth_level):
         if auth_level == 0:
             return True
 
-        sql = 'SELECT `auth_level` FROM `bot_staff` WHERE user=%s' % user_id
-        rows = (await self.dbutil.execute(sql)).first()
-        if not rows:
-            return False
-
-        if rows['auth_level'] >= auth_level:
-            return True
-        else:
-            return False
+        return await self.auth_cache.auth_level(user_id) >= auth_level
 
     async def check_auth(self, ctx):
         if not await self._check_auth(ctx.author.id, ctx.command.auth):
@@ -172,14 +222,25 @@ class BotBase(Bot):
             terminal.info(s)
             logger.debug(s)
             self.dispatch('command', ctx)
+            stats = self.command_stats
+            stats.start(ctx)
+            error = True
             try:
-                if (await self.can_run(ctx, call_once=True)):
+                start = stats.phase_start()
+                can_run = await self.can_run(ctx, call_once=True)
+                stats.add_checks(ctx, start)
+                if can_run:
+                    t = time.perf_counter()
                     await ctx.command.invoke(ctx)
+                    add_timing(ctx, 'invoke', (time.perf_counter() - t) * 1000)
+                error = False
             except CommandError as e:
                 await self.on_command_error(ctx, e)
                 return
             else:
                 self.dispatch('command_completion', ctx)
+            finally:
+                stats.finish(ctx, error=error)
         elif ctx.invoked_with:
             exc = CommandNotFound('Command "{}" is not found'.format(ctx.invoked_with))
             self.dispatch('command_error', ctx, exc)
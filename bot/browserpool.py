@@ -0,0 +1,174 @@
+"""
+Pool of headless browsers for commands that need to render a web page.
+
+Pokefusion used to share one browser behind a lock so every fusion in every
+server waited for the page loads before it. The pool lets size pages load
+at once on its own threads. Browsers that fail a health check or raise an
+exception while they're used are replaced and the rest are recycled after
+a number of uses or an amount of time so a leaking browser doesn't live
+forever.
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from bot.metrics import Histogram
+
+logger = logging.getLogger('debug')
+terminal = logging.getLogger('terminal')
+
+
+class Browser:
+    __slots__ = ('driver', 'created', 'uses', 'last_used')
+
+    def __init__(self, driver):
+        self.driver = driver
+        self.created = time.monotonic()
+        self.uses = 0
+        self.last_used = self.created
+
+
+class BrowserPool:
+    """
+    At most size browsers created with factory. Browsers are created when
+    they're first needed. A browser that has been idle for check_interval
+    seconds is checked before it's used and browsers are closed after max_uses
+    uses or max_age seconds
+    """
+    def __init__(self, bot, factory, size=2, max_uses=200, max_age=3600, check_interval=60):
+        self._bot = bot
+        self.factory = factory
+        self.size = max(size, 1)
+        self.max_uses = max_uses
+        self.max_age = max_age
+        self.check_interval = check_interval
+
+        self._executor = ThreadPoolExecutor(max_workers=self.size)
+        self._slots = asyncio.Semaphore(self.size, loop=bot.loop)
+        self._idle = deque()
+        self._closed = False
+
+        self.created = 0
+        self.recycled = 0
+        self.broken = 0
+        self.wait_time = Histogram()
+        self.run_time = Histogram()
+
+    @property
+    def bot(self):
+        return self._bot
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    def prefill(self, amount=1):
+        """
+        Creates browsers in the calling thread so errors in starting them
+        are raised right away instead of on the first use
+        """
+        for _ in range(min(amount, self.size) - len(self._idle)):
+            self._idle.append(Browser(self.factory()))
+            self.created += 1
+
+    @staticmethod
+    def _quit(browser):
+        try:
+            browser.driver.quit()
+        except Exception:
+            logger.exception('Failed to quit browser')
+
+    @staticmethod
+    def _is_alive(browser):
+        try:
+            return browser.driver.execute_script('return 1') == 1
+        except Exception:
+            # Besides WebDriverExceptions a dead driver can raise connection errors
+            return False
+
+    def _get_browser(self):
+        """Runs in the pool threads. Returns a working browser"""
+        now = time.monotonic()
+        while True:
+            # Other threads can take the last browser between checking and popping
+            try:
+                browser = self._idle.popleft()
+            except IndexError:
+                break
+
+            if now - browser.created > self.max_age:
+                self.recycled += 1
+                self._quit(browser)
+                continue
+
+            if now - browser.last_used > self.check_interval and not self._is_alive(browser):
+                self.broken += 1
+                self._quit(browser)
+                continue
+
+            return browser
+
+        browser = Browser(self.factory())
+        self.created += 1
+        return browser
+
+    def _run(self, func, args):
+        browser = self._get_browser()
+        broken = False
+        try:
+            return func(browser.driver, *args)
+        except Exception:
+            # The page could be left in any state so don't reuse the browser
+            broken = True
+            raise
+        finally:
+            browser.uses += 1
+            browser.last_used = time.monotonic()
+            if broken:
+                self.broken += 1
+                self._quit(browser)
+            elif self._closed or browser.uses >= self.max_uses:
+                self.recycled += 1
+                self._quit(browser)
+            else:
+                self._idle.append(browser)
+
+    async def run(self, func, *args):
+        """
+        Runs func(driver, *args) in the pool threads with a browser from the pool.
+        The browser is replaced if func raises an exception
+        """
+        if self._closed:
+            raise RuntimeError('Browser pool is closed')
+
+        t = time.perf_counter()
+        async with self._slots:
+            started = time.perf_counter()
+            self.wait_time.add((started - t) * 1000)
+            try:
+                return await self.bot.loop.run_in_executor(self._executor, self._run, func, args)
+            finally:
+                self.run_time.add((time.perf_counter() - started) * 1000)
+
+    def close(self):
+        """Quits the idle browsers. Browsers in use are quit when they're done"""
+        self._closed = True
+        while True:
+            try:
+                browser = self._idle.popleft()
+            except IndexError:
+                break
+            self._quit(browser)
+        self._executor.shutdown(wait=False)
+
+    def stats(self):
+        return {'size': self.size,
+                'idle': self.idle,
+                'created': self.created,
+                'recycled': self.recycled,
+                'broken': self.broken,
+                'wait_time': self.wait_time.to_dict(),
+                'run_time': self.run_time.to_dict()}
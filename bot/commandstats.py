@@ -0,0 +1,157 @@
+"""
+Timings of the phases of command invocations and command usage counts.
+
+Every invocation records how long resolving the prefix, the botban check,
+the command checks, argument conversion and the command callback took. The
+time the checks spend waiting for the database is counted separately from
+the rest of the checks. Usage counts used to be written with one UPDATE per
+command and are now added up in memory and written in one batch.
+"""
+
+import asyncio
+import time
+from collections import Counter
+
+from bot.metrics import Histogram, HistogramGroup
+
+try:
+    _current_task = asyncio.current_task
+except AttributeError:
+    _current_task = asyncio.Task.current_task
+
+# Phases in the order they happen. Only the ones in this list are recorded
+PHASES = ('prefix', 'ban_check', 'checks', 'checks_db', 'convert', 'callback', 'total')
+
+
+def add_timing(ctx, phase, ms):
+    """Adds ms to phase of the invocation of ctx if it's being timed"""
+    timings = getattr(ctx, 'timings', None)
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0) + ms
+
+
+class CommandStats:
+    """
+    Phase histograms for every command and all of them combined.
+    Database time is tracked per task so the task running the checks only
+    gets the time of its own queries
+    """
+    def __init__(self, bot, flush_interval=60):
+        self._bot = bot
+        self.flush_interval = flush_interval
+
+        self.commands = {}
+        self.all = HistogramGroup()
+        # Every message, not just commands
+        self.prefix = Histogram()
+        self.invocations = Counter()
+        self.errors = Counter()
+
+        self._db_time = {}
+        self._uses = Counter()
+        self._flush_task = None
+        self.flushed = 0
+
+    @property
+    def bot(self):
+        return self._bot
+
+    def _histograms(self, name):
+        h = self.commands.get(name)
+        if h is None:
+            h = HistogramGroup()
+            self.commands[name] = h
+
+        return h
+
+    def db_time(self):
+        return self._db_time.get(_current_task(loop=self.bot.loop), 0)
+
+    def add_db_time(self, ms):
+        """Called by the database utils after every query"""
+        task = _current_task(loop=self.bot.loop)
+        if task in self._db_time:
+            self._db_time[task] += ms
+
+    def start(self, ctx):
+        """Starts tracking the database time of the task invoking ctx"""
+        if ctx.timings is None:
+            ctx.timings = {}
+        self._db_time[_current_task(loop=self.bot.loop)] = 0
+
+    def phase_start(self):
+        return time.perf_counter(), self.db_time()
+
+    def add_checks(self, ctx, start):
+        """Splits the time since start into database and other check time"""
+        t, db = start
+        db = self.db_time() - db
+        add_timing(ctx, 'checks_db', db)
+        add_timing(ctx, 'checks', (time.perf_counter() - t) * 1000 - db)
+
+    def finish(self, ctx, error=False):
+        self._db_time.pop(_current_task(loop=self.bot.loop), None)
+        timings = ctx.timings
+        if not timings or ctx.command is None:
+            return
+
+        name = ctx.command.qualified_name
+        invoke = timings.pop('invoke', None)
+        prepare = timings.pop('prepare', 0)
+        if invoke is not None:
+            timings['callback'] = invoke - prepare
+
+        if ctx.received_at is not None:
+            timings['total'] = (time.perf_counter() - ctx.received_at) * 1000
+
+        histograms = self._histograms(name)
+        for phase in PHASES:
+            ms = timings.get(phase)
+            if ms is None:
+                continue
+
+            histograms.add(phase, ms)
+            self.all.add(phase, ms)
+
+        self.invocations[name] += 1
+        if error:
+            self.errors[name] += 1
+
+    def command_used(self, parent, name=''):
+        self._uses[(parent, name or '')] += 1
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_later(), loop=self.bot.loop)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self):
+        """Writes the usage counts gathered since the last flush"""
+        if not self._uses:
+            return
+
+        uses, self._uses = self._uses, Counter()
+        values = [{'parent': parent, 'cmd': cmd, 'uses': n} for (parent, cmd), n in uses.items()]
+        if not await self.bot.dbutil.commands_used(values):
+            # Try again with the next flush
+            self._uses.update(uses)
+            return
+
+        self.flushed += 1
+
+    def reset(self):
+        self.commands.clear()
+        self.all.reset()
+        self.prefix.reset()
+        self.invocations.clear()
+        self.errors.clear()
+
+    def to_dict(self):
+        return {'prefix': self.prefix.to_dict(),
+                'all': self.all.to_dict(),
+                'pending_uses': sum(self._uses.values()),
+                'commands': {name: {'invocations': self.invocations[name],
+                                    'errors': self.errors[name],
+                                    'phases': h.to_dict()}
+                             for name, h in self.commands.items()}}
@@ -73,6 +73,9 @@ class Config:
         self.sfx_db_pass = get_config_value(self.config, 'Database', 'SFXPassword', str)
         self.redis_auth = get_config_value(self.config, 'Database', 'RedisAuth', str)
         self.redis_port = get_config_value(self.config, 'Database', 'RedisPort', int)
+        self.db_backend = get_config_value(self.config, 'Database', 'Backend', str, 'aiomysql')
+        self.db_pool_min = get_config_value(self.config, 'Database', 'PoolMin', int, 1)
+        self.db_pool_max = get_config_value(self.config, 'Database', 'PoolMax', int, 10)
 
 
         try:
@@ -110,6 +113,18 @@ class Config:
             terminal.exception("DownloadSongs value is not boolean. DownloadSongs set to on")
             self.download = True
 
+        try:
+            self.audio_cache_size = self.config.getint('MusicSettings', 'AudioCacheSize', fallback=0) * 1024 * 1024
+        except ValueError:
+            terminal.exception("AudioCacheSize value is not a number. AudioCacheSize set to 0")
+            self.audio_cache_size = 0
+
+        try:
+            self.prefetch_songs = self.config.getint('MusicSettings', 'PrefetchSongs', fallback=3)
+        except ValueError:
+            terminal.exception("PrefetchSongs value is not a number. PrefetchSongs set to 3")
+            self.prefetch_songs = 3
+
         try:
             self.auto_volume = self.config.getboolean('MusicSettings', 'AutoVolume', fallback=False)
         except ValueError:
@@ -137,6 +152,31 @@ class Config:
                 # Activity config put in json because it's easier to handle in code
                 self.default_activity = json.load(f)
 
+        self.log_batch_size = get_config_value(self.config, 'Logging', 'BatchSize', int, 500)
+        self.log_flush_interval = get_config_value(self.config, 'Logging', 'FlushInterval', float, 2.0)
+        self.log_max_queue = get_config_value(self.config, 'Logging', 'MaxQueue', int, 20000)
+        self.log_overflow = get_config_value(self.config, 'Logging', 'OverflowPolicy', str, 'drop_oldest')
+        self.command_uses_interval = get_config_value(self.config, 'Logging', 'CommandUsesInterval', int, 60)
+
+        self.render_workers = get_config_value(self.config, 'Images', 'RenderWorkers', int, 2)
+        self.render_max_in_flight = get_config_value(self.config, 'Images', 'MaxInFlight', int, 0)
+        self.render_max_queue = get_config_value(self.config, 'Images', 'MaxQueue', int, 30)
+        self.render_max_per_guild = get_config_value(self.config, 'Images', 'MaxPerGuild', int, 3)
+        self.render_cache_size = get_config_value(self.config, 'Images', 'CacheSize', int, 64)
+        self.render_disk_cache = get_config_value(self.config, 'Images', 'DiskCache', str, os.path.join('data', 'render_cache'))
+        self.render_disk_cache_size = get_config_value(self.config, 'Images', 'DiskCacheSize', int, 0)
+        self.render_source_ttl = get_config_value(self.config, 'Images', 'SourceTTL', int, 3600)
+        self.template_memory = get_config_value(self.config, 'Images', 'TemplateMemory', int, 256)
+        self.fetch_cache_size = get_config_value(self.config, 'Images', 'FetchCacheSize', int, 32)
+        self.fetch_ttl = get_config_value(self.config, 'Images', 'FetchTTL', int, 120)
+        self.max_image_pixels = get_config_value(self.config, 'Images', 'MaxImagePixels', int, 30000000)
+        self.pokefusion_browsers = get_config_value(self.config, 'Images', 'PokefusionBrowsers', int, 2)
+        self.pokefusion_browser_uses = get_config_value(self.config, 'Images', 'PokefusionBrowserUses', int, 200)
+        self.palette_guilds = get_config_value(self.config, 'Images', 'PaletteGuilds', int, 20)
+
+        self.watchdog_threshold = get_config_value(self.config, 'Watchdog', 'Threshold', int, 250)
+        self.watchdog_interval = get_config_value(self.config, 'Watchdog', 'Interval', int, 100)
+
         self.game = self.config.get('BotOptions', 'Game', fallback=None)
         self.sfx_game = self.config.get('BotOptions', 'SfxGame', fallback=None)
         self.phantomjs = self.config.get('BotOptions', 'PhantomJS', fallback='phantomjs')
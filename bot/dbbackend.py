@@ -0,0 +1,335 @@
+"""
+Backends that DatabaseUtils.execute runs queries with.
+
+Every backend has the same interface
+    await backend.execute(sql, params=None, commit=False)
+where params is a dict of named parameters (`:name` style like in sqlalchemy)
+or a list of dicts for executemany. The returned object behaves like
+a sqlalchemy ResultProxy so existing callers don't need to change.
+"""
+
+import asyncio
+import logging
+import re
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy.exc import DBAPIError, SQLAlchemyError
+
+from bot.metrics import Histogram
+
+logger = logging.getLogger('debug')
+terminal = logging.getLogger('terminal')
+
+# Same pattern sqlalchemy uses to find bind params in text()
+_bind_params = re.compile(r'(?<![:\w\x5c]):(\w+)(?!:)')
+
+
+class Row(tuple):
+    """Tuple that can also be indexed with column names like RowProxy"""
+    def __new__(cls, values, keymap):
+        row = super().__new__(cls, values)
+        row._keymap = keymap
+        return row
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return super().__getitem__(self._keymap[key])
+        return super().__getitem__(key)
+
+    def keys(self):
+        return list(self._keymap.keys())
+
+    def values(self):
+        return list(self)
+
+    def items(self):
+        return list(zip(self._keymap.keys(), self))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+class Result:
+    """Buffered query result with the parts of the ResultProxy api that are used in the bot"""
+    def __init__(self, keys=None, rows=None, rowcount=-1, lastrowid=None):
+        keys = keys or []
+        keymap = {k: idx for idx, k in enumerate(keys)}
+        self._keys = keys
+        self._rows = [Row(r, keymap) for r in rows] if rows else []
+        self._idx = 0
+        self.rowcount = rowcount
+        self.lastrowid = lastrowid
+
+    @property
+    def returns_rows(self):
+        return bool(self._keys)
+
+    def keys(self):
+        return list(self._keys)
+
+    def fetchone(self):
+        if self._idx >= len(self._rows):
+            return None
+
+        row = self._rows[self._idx]
+        self._idx += 1
+        return row
+
+    def fetchmany(self, size=1):
+        rows = self._rows[self._idx:self._idx + size]
+        self._idx += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._rows[self._idx:]
+        self._idx = len(self._rows)
+        return rows
+
+    def first(self):
+        row = self.fetchone()
+        self._idx = len(self._rows)
+        return row
+
+    def scalar(self):
+        row = self.first()
+        return row[0] if row is not None else None
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+
+class DatabaseBackend:
+    name = 'base'
+
+    def __init__(self, loop, min_connections=1, max_connections=10):
+        self.loop = loop
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        # Time spent waiting for a free connection and time spent running the query
+        self.pool_wait = Histogram()
+        self.query_latency = Histogram()
+        self.errors = 0
+
+    async def execute(self, sql, params=None, commit=False):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    def stats(self):
+        return {'backend': self.name,
+                'min_connections': self.min_connections,
+                'max_connections': self.max_connections,
+                'errors': self.errors,
+                'pool_wait': self.pool_wait.to_dict(),
+                'query_latency': self.query_latency.to_dict()}
+
+
+class _ThreadedBackend(DatabaseBackend):
+    """Runs blocking drivers on a thread pool reserved for the database"""
+    def __init__(self, loop, min_connections=1, max_connections=10):
+        super().__init__(loop, min_connections, max_connections)
+        self._executor = ThreadPoolExecutor(max_connections, thread_name_prefix='db')
+
+    def _execute(self, sql, params, commit):
+        raise NotImplementedError
+
+    async def execute(self, sql, params=None, commit=False):
+        submitted = time.perf_counter()
+
+        def run():
+            t = time.perf_counter()
+            self.pool_wait.add((t - submitted) * 1000)
+            try:
+                return self._execute(sql, params, commit)
+            except SQLAlchemyError:
+                self.errors += 1
+                raise
+            finally:
+                self.query_latency.add((time.perf_counter() - t) * 1000)
+
+        return await self.loop.run_in_executor(self._executor, run)
+
+    async def close(self):
+        self._executor.shutdown(wait=False)
+
+
+class SessionBackend(_ThreadedBackend):
+    """
+    Old behaviour of running queries with a sqlalchemy scoped_session
+    but on its own threads so other work on bot.threadpool can't block it
+    """
+    name = 'sqlalchemy'
+
+    def __init__(self, loop, session_factory, engine, min_connections=1, max_connections=10):
+        super().__init__(loop, min_connections, max_connections)
+        self._Session = session_factory
+        self._engine = engine
+
+    def _execute(self, sql, params, commit):
+        session = self._Session()
+        try:
+            if params is None:
+                row = session.execute(sql)
+            else:
+                row = session.execute(sql, params)
+            if commit:
+                session.commit()
+
+        except DBAPIError as e:
+            if e.connection_invalidated:
+                logger.exception('CONNECTION INVALIDATED')
+                self._engine.connect()
+
+            raise e
+
+        except SQLAlchemyError as e:
+            session.rollback()
+            raise e
+
+        return row
+
+    async def close(self):
+        await super().close()
+        self._Session.close_all()
+        self._engine.dispose()
+
+
+class AiomysqlBackend(DatabaseBackend):
+    """
+    asyncio native MySQL pool. Connections are in autocommit mode so
+    the commit argument doesn't do anything here. Every statement is committed
+    """
+    name = 'aiomysql'
+
+    def __init__(self, loop, host, port, user, password, db, min_connections=1, max_connections=10):
+        super().__init__(loop, min_connections, max_connections)
+        self._connect_kwargs = {'host': host, 'port': int(port or 3306), 'user': user,
+                                'password': password or '', 'db': db}
+        self._pool = None
+        self._starting = None
+
+    async def _get_pool(self):
+        if self._pool is not None:
+            return self._pool
+
+        # Only create one pool even if many queries are waiting for it
+        if self._starting is None:
+            self._starting = asyncio.ensure_future(self._create_pool(), loop=self.loop)
+
+        try:
+            self._pool = await asyncio.shield(self._starting)
+        except Exception:
+            self._starting = None
+            raise
+
+        return self._pool
+
+    async def _create_pool(self):
+        import aiomysql
+        return await aiomysql.create_pool(minsize=self.min_connections,
+                                          maxsize=self.max_connections,
+                                          charset='utf8mb4', autocommit=True,
+                                          pool_recycle=36000, loop=self.loop,
+                                          **self._connect_kwargs)
+
+    @staticmethod
+    def convert_sql(sql, params):
+        """Converts sqlalchemy style :name params to pyformat used by pymysql"""
+        sql = str(sql)
+        if not params:
+            return sql
+
+        return _bind_params.sub(r'%(\1)s', sql.replace('%', '%%'))
+
+    async def execute(self, sql, params=None, commit=False):
+        import pymysql
+
+        pool = await self._get_pool()
+        query = self.convert_sql(sql, params)
+        t = time.perf_counter()
+        try:
+            async with pool.acquire() as conn:
+                t2 = time.perf_counter()
+                self.pool_wait.add((t2 - t) * 1000)
+                try:
+                    async with conn.cursor() as cursor:
+                        if isinstance(params, (list, tuple)):
+                            await cursor.executemany(query, params)
+                        else:
+                            await cursor.execute(query, params or None)
+
+                        if cursor.description:
+                            keys = [d[0] for d in cursor.description]
+                            rows = await cursor.fetchall()
+                        else:
+                            keys = None
+                            rows = None
+
+                        return Result(keys, rows, cursor.rowcount, cursor.lastrowid)
+                finally:
+                    self.query_latency.add((time.perf_counter() - t2) * 1000)
+
+        except pymysql.err.Error as e:
+            self.errors += 1
+            # instance picks the subclass like IntegrityError matching the driver error
+            raise DBAPIError.instance(query, params, e, pymysql.err.Error) from e
+
+    async def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            await self._pool.wait_closed()
+            self._pool = None
+
+
+class SQLiteBackend(_ThreadedBackend):
+    """
+    Backend using the builtin sqlite3 module for tests that need a database
+    without a MySQL server. sqlite supports the :name params used everywhere
+    but the database starts empty and MySQL only syntax like INSERT IGNORE,
+    ON DUPLICATE KEY UPDATE or multi table DELETE isn't translated, so it
+    can't run the bot. Tests create the tables they use themselves
+    """
+    name = 'sqlite'
+
+    def __init__(self, loop, path=':memory:'):
+        # sqlite3 connections can't be shared between threads safely so use only one
+        super().__init__(loop, 1, 1)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+
+    def _execute(self, sql, params, commit):
+        sql = str(sql)
+        try:
+            cursor = self._conn.cursor()
+            if isinstance(params, (list, tuple)):
+                cursor.executemany(sql, params)
+            else:
+                cursor.execute(sql, params or {})
+
+            if cursor.description:
+                keys = [d[0] for d in cursor.description]
+                rows = cursor.fetchall()
+            else:
+                keys = None
+                rows = None
+
+            if commit:
+                self._conn.commit()
+
+            return Result(keys, rows, cursor.rowcount, cursor.lastrowid)
+        except sqlite3.Error as e:
+            self._conn.rollback()
+            raise DBAPIError.instance(sql, params, e, sqlite3.Error) from e
+
+    async def close(self):
+        await super().close()
+        self._conn.close()
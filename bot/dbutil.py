@@ -21,7 +21,8 @@ class DatabaseUtils:
 
     async def execute(self, sql, *args, commit=False, measure_time=False, **params):
         """
-        Asynchronously run an sql query using loop.run_in_executor
+        Asynchronously run an sql query using the database backend of the bot.
+        Falls back to loop.run_in_executor with a session if the bot has no backend
         Args:
             sql: sql query
             *args: args passed to execute
@@ -32,6 +33,29 @@ class DatabaseUtils:
         Returns:
             ResultProxy or ResultProxy, int depending of the value of measure time
         """
+        backend = getattr(self.bot, 'db_backend', None)
+        if backend is None:
+            return await self._execute_session(sql, *args, commit=commit, measure_time=measure_time, **params)
+
+        if args:
+            parameters = args[0]
+        else:
+            parameters = params.get('params')
+
+        t = time.perf_counter()
+        try:
+            row = await backend.execute(sql, parameters, commit=commit)
+        finally:
+            command_stats = getattr(self.bot, 'command_stats', None)
+            if command_stats is not None:
+                command_stats.add_db_time((time.perf_counter() - t) * 1000)
+
+        if measure_time:
+            return row, time.perf_counter() - t
+
+        return row
+
+    async def _execute_session(self, sql, *args, commit=False, measure_time=False, **params):
         def _execute():
             session = self.bot.get_session
             try:
@@ -341,6 +365,26 @@ class DatabaseUtils:
 
         return True
 
+    async def commands_used(self, values):
+        """
+        Adds to the use counts of multiple commands
+        Args:
+            values: A list of dictionaries with keys `parent`, `cmd` and `uses`
+
+        Returns:
+            bool based on success
+        """
+        if not values:
+            return True
+        sql = 'UPDATE `command_stats` SET `uses`=(`uses`+:uses) WHERE parent=:parent AND cmd=:cmd'
+        try:
+            await self.execute(sql, values, commit=True)
+        except SQLAlchemyError:
+            logger.exception('Failed to update usage of {} commands'.format(len(values)))
+            return False
+
+        return True
+
     async def command_used(self, parent, name=""):
         if name is None:
             name = ""
@@ -382,10 +426,17 @@ class DatabaseUtils:
     async def botban(self, user_id, reason):
         sql = 'INSERT INTO `banned_users` (`user`, `reason`) VALUES (:user, :reason)'
         await self.execute(sql, {'user': user_id, 'reason': reason}, commit=True)
+        self._set_banned(user_id, True)
 
     async def botunban(self, user_id):
         sql = 'DELETE FROM `banned_users` WHERE user=%s' % user_id
         await self.execute(sql, commit=True)
+        self._set_banned(user_id, False)
+
+    def _set_banned(self, user_id, banned):
+        auth_cache = getattr(self.bot, 'auth_cache', None)
+        if auth_cache is not None:
+            auth_cache.set_banned(user_id, banned)
 
     async def blacklist_guild(self, guild_id, reason):
         sql = 'INSERT INTO `guild_blacklist` (`guild`, `reason`) VALUES (:guild, :reason)'
@@ -23,12 +23,17 @@ SOFTWARE.
 """
 
 import asyncio
+import copy
 import functools
 import logging
 import os
 from concurrent.futures import ThreadPoolExecutor
 
 import youtube_dl
+from validators import url as valid_url
+
+from bot.audiocache import AudioCache
+from bot.metadatacache import MetadataCache
 
 terminal = logging.getLogger('terminal')
 
@@ -54,9 +59,13 @@ youtube_dl.utils.bug_reports_message = lambda: ''
 
 
 class Downloader:
-    def __init__(self, dl_folder=''):
+    def __init__(self, dl_folder='', cache_size=0, metadata_path=None):
         self.dl_folder = dl_folder
-        self.thread_pool = ThreadPoolExecutor(max_workers=3)
+        self.cache = AudioCache(dl_folder, max_bytes=cache_size)
+        self.metadata = MetadataCache(metadata_path) if metadata_path else None
+        self._in_flight = {}
+        self.max_workers = 3
+        self.thread_pool = ThreadPoolExecutor(max_workers=self.max_workers)
         self.safe_ytdl = youtube_dl.YoutubeDL(opts)
         self.safe_ytdl.params['outtmpl'] = os.path.join(self.dl_folder, self.safe_ytdl.params['outtmpl'])
         self.safe_ytdl.params['ignore_errors'] = True
@@ -67,7 +76,47 @@ class Downloader:
         self.non_flat_ytdl = youtube_dl.YoutubeDL(opts)
         self.non_flat_ytdl.params['extract_flat'] = False
 
-    async def extract_info(self, loop, on_error=None, extract_flat=True, *args, **kwargs):
+    async def _extract(self, loop, ytdl, extract_flat, require_stream, *args, **kwargs):
+        """
+        ytdl.extract_info through the metadata cache. Only urls are cached.
+        Lookups of a url that is already being extracted wait for that
+        extraction instead of starting another one
+        """
+        url = kwargs.get('url', args[0] if args else None)
+        extract = functools.partial(ytdl.extract_info, *args, **kwargs)
+        if self.metadata is None or not isinstance(url, str) or not valid_url(url):
+            return await loop.run_in_executor(self.thread_pool, extract)
+
+        key = MetadataCache.key(url, extract_flat)
+        # Downloads must always go through youtube_dl
+        if not kwargs.get('download', True):
+            info = self.metadata.get(key, require_stream=require_stream)
+            if info is not None:
+                return info
+
+            task = self._in_flight.get(key)
+            if task is not None:
+                self.metadata.coalesced += 1
+                return copy.deepcopy(await asyncio.shield(task))
+
+            task = asyncio.ensure_future(loop.run_in_executor(self.thread_pool, extract), loop=loop)
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+            info = await asyncio.shield(task)
+        else:
+            info = await loop.run_in_executor(self.thread_pool, extract)
+
+        self.metadata.add(key, info)
+        if self.metadata.needs_save:
+            loop.run_in_executor(None, self.metadata.save, self.metadata.snapshot())
+
+        return info
+
+    async def extract_info(self, loop, on_error=None, extract_flat=True, *args, require_stream=True, **kwargs):
+        """
+        Runs extract_info in the thread pool. If require_stream is False the
+        info of a url can come from the cache without a valid stream url
+        """
         if extract_flat:
             ytdl = self.unsafe_ytdl
         else:
@@ -76,7 +125,7 @@ class Downloader:
         terminal.debug('dl called {} {}'.format(args, kwargs))
         if callable(on_error):
             try:
-                return await loop.run_in_executor(self.thread_pool, functools.partial(ytdl.extract_info, *args, **kwargs))
+                return await self._extract(loop, ytdl, extract_flat, require_stream, *args, **kwargs)
 
             except Exception as e:
 
@@ -97,7 +146,7 @@ class Downloader:
                     loop.call_soon_threadsafe(on_error, e)
 
         else:
-            return await loop.run_in_executor(self.thread_pool, functools.partial(ytdl.extract_info, *args, **kwargs))
+            return await self._extract(loop, ytdl, extract_flat, require_stream, *args, **kwargs)
 
     async def safe_extract_info(self, loop, *args, **kwargs):
         terminal.debug('dl called {} {}'.format(args, kwargs))
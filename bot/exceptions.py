@@ -129,5 +129,9 @@ class NoPokeFoundException(BotException):
         return 'No pokemon found with {}'.format(self._message)
 
 
+class RenderQueueFull(BotException):
+    pass
+
+
 class NoCachedFileException(Exception):
     pass
@@ -45,6 +45,8 @@ DELETE_AUTOPLAYLIST = join(PLAYLISTS, 'delete_autoplaylist.txt')
 SFX_FOLDER = join(_wd, 'data', 'audio', 'sfx')
 TTS = join(_wd, 'data', 'audio', 'tts')
 CACHE = join(_wd, 'data', 'audio', 'cache')
+LOUDNESS_CACHE = join(_wd, 'data', 'audio', 'loudness.json')
+METADATA_CACHE = join(_wd, 'data', 'audio', 'metadata.json')
 POKESTATS = join(DATA, 'pokestats')
 PERMISSIONS_FOLDER = join(_wd, 'data', 'permissions')
 PERMISSIONS = join(PERMISSIONS_FOLDER, 'permissions.db')
@@ -0,0 +1,154 @@
+"""
+Downloads the source images of image commands.
+
+Every image command used to download its image separately so many users
+using the same avatar or emote caused just as many downloads. Downloads of
+the same url that overlap share one request and the raw data is kept for a
+short while after the download finishes.
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from functools import partial
+from io import BytesIO
+
+from PIL import Image
+
+from bot.metrics import Histogram
+from utils.imagetools import raw_image_from_url
+
+
+class ImageFetcher:
+    """
+    Single flight image downloader with a small TTL cache of the raw data.
+    The cache is bounded by its total size in bytes. Items that are older
+    than ttl seconds are downloaded again
+    """
+    def __init__(self, bot, max_bytes=32*1024*1024, ttl=120, max_size=8000000, max_pixels=30000000):
+        self._bot = bot
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_size = max_size
+        self.max_pixels = max_pixels
+
+        # url: (data, mime type, time added)
+        self._cache = OrderedDict()
+        self._cache_size = 0
+        self._in_flight = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.downloaded_bytes = 0
+        self.download_time = Histogram()
+
+    @property
+    def bot(self):
+        return self._bot
+
+    @property
+    def in_flight(self):
+        return len(self._in_flight)
+
+    def _get_cached(self, url):
+        cached = self._cache.get(url)
+        if cached is None:
+            return
+
+        data, mime_type, added = cached
+        if time.monotonic() - added > self.ttl:
+            self._remove(url)
+            return
+
+        self._cache.move_to_end(url)
+        return data, mime_type
+
+    def _remove(self, url):
+        data, _, _ = self._cache.pop(url)
+        self._cache_size -= len(data)
+
+    def _add(self, url, data, mime_type):
+        if len(data) > self.max_bytes:
+            return
+
+        if url in self._cache:
+            self._remove(url)
+
+        self._cache[url] = (data, mime_type, time.monotonic())
+        self._cache_size += len(data)
+        while self._cache_size > self.max_bytes:
+            self._remove(next(iter(self._cache)))
+
+    async def fetch(self, url):
+        """
+        Raw data and mime type of the image in url or (None, None) if it
+        couldn't be downloaded. Raises the same exceptions as raw_image_from_url
+        """
+        cached = self._get_cached(url)
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        task = self._in_flight.get(url)
+        if task is None:
+            self.misses += 1
+            task = asyncio.ensure_future(self._download(url), loop=self.bot.loop)
+            self._in_flight[url] = task
+            task.add_done_callback(partial(self._on_done, url))
+        else:
+            self.coalesced += 1
+
+        # Cancelling one command mustn't cancel the download for the others waiting on it
+        return await asyncio.shield(task)
+
+    async def image(self, url):
+        """The image in url opened with PIL or None if it couldn't be downloaded"""
+        data, _ = await self.fetch(url)
+        if data is None:
+            return
+
+        return Image.open(BytesIO(data))
+
+    def _on_done(self, url, task):
+        self._in_flight.pop(url, None)
+        # Retrieve the exception so it isn't logged when every waiter was cancelled
+        if not task.cancelled():
+            task.exception()
+
+    async def _download(self, url):
+        t = time.perf_counter()
+        try:
+            data, mime_type = await raw_image_from_url(url, self.bot.aiohttp_client, get_mime=True,
+                                                       max_size=self.max_size,
+                                                       max_pixels=self.max_pixels)
+        except Exception:
+            self.failed += 1
+            raise
+
+        if data is None:
+            self.failed += 1
+            return None, None
+
+        data = data.getvalue()
+        self.download_time.add((time.perf_counter() - t) * 1000)
+        self.downloaded_bytes += len(data)
+        self._add(url, data, mime_type)
+        return data, mime_type
+
+    def clear(self):
+        self._cache.clear()
+        self._cache_size = 0
+
+    def stats(self):
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'failed': self.failed,
+                'in_flight': self.in_flight,
+                'items': len(self._cache),
+                'bytes': self._cache_size,
+                'max_bytes': self.max_bytes,
+                'downloaded_bytes': self.downloaded_bytes,
+                'download_time': self.download_time.to_dict()}
@@ -0,0 +1,239 @@
+"""
+Persistent cache of the loudness of songs for auto volume.
+
+Analysing a song with ffmpeg takes several seconds and used to be done
+every time a song started playing, even for autoplaylist songs that had
+been analysed many times before. Results are now kept on disk keyed by the
+video id and songs are analysed in the background as soon as their file
+is available so the result is usually ready when they start playing.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from bot.globals import LOUDNESS_CACHE
+from bot.metrics import Histogram
+from utils.utilities import volume_stats
+
+logger = logging.getLogger('audio')
+terminal = logging.getLogger('terminal')
+
+
+def song_key(song):
+    """Cache key of a song. The video id if it has one and a hash of the file name if not"""
+    if song.id:
+        return str(song.id)
+
+    name = song.filename or song.webpage_url or song.url
+    return 'file-' + hashlib.blake2b(os.path.basename(str(name)).encode('utf-8'), digest_size=12).hexdigest()
+
+
+class LoudnessCache:
+    """
+    Loudness stats of songs saved in a json file. Analysis requests are put
+    in a queue and handled by a background task one at a time on its own
+    thread so they don't hold up the threadpool of the bot. Songs that are
+    about to play can skip ahead of the queue with priority.
+
+    Saved entries are dicts with the keys
+        mean: mean volume in dB
+        max: max volume in dB
+        loudness: integrated EBU R128 loudness in LUFS
+        duration: duration of the song when it was analysed
+        added: unix time of the analysis
+    """
+    def __init__(self, bot, path=LOUDNESS_CACHE, max_items=50000, timeout=60, ebur128=True, save_interval=30):
+        self._bot = bot
+        self.path = path
+        self.max_items = max_items
+        self.timeout = timeout
+        self.ebur128 = ebur128
+        self.save_interval = save_interval
+
+        self._items = OrderedDict()
+        # Keys waiting for analysis and the futures of their results
+        self._queue = deque()
+        self._pending = {}
+        self._not_empty = asyncio.Event(loop=bot.loop)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._task = None
+        self._dirty = False
+        self._last_save = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.analysed = 0
+        self.failed = 0
+        self.analysis_time = Histogram()
+
+        self._load()
+
+    @property
+    def bot(self):
+        return self._bot
+
+    @property
+    def queued(self):
+        return len(self._queue)
+
+    def __len__(self):
+        return len(self._items)
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                items = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            terminal.exception(f'Failed to load loudness cache from {self.path}')
+            return
+
+        self._items.update(items)
+        terminal.info(f'Loaded the loudness of {len(self._items)} songs')
+
+    def _save(self, items):
+        items = json.dumps(items)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(items)
+        os.replace(tmp, self.path)
+
+    async def save(self):
+        if not self._dirty:
+            return
+
+        self._dirty = False
+        self._last_save = time.monotonic()
+        try:
+            # Copied so the items can't change while they're being written
+            await self.bot.loop.run_in_executor(self._executor, self._save, dict(self._items))
+        except OSError:
+            terminal.exception('Failed to save loudness cache')
+
+    def get(self, song):
+        """Saved stats of song or None if it hasn't been analysed"""
+        stats = self._items.get(song_key(song))
+        if stats is None:
+            self.misses += 1
+            return
+
+        self.hits += 1
+        return stats
+
+    def _add(self, key, stats):
+        self._items[key] = stats
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+        self._dirty = True
+
+    def analyse(self, song, file, priority=False):
+        """
+        Queues song for analysis and returns a future that will have its stats
+        or None if the analysis failed. Cached results are returned right away
+        """
+        key = song_key(song)
+        future = self._pending.get(key)
+        if future is not None:
+            item = next((i for i in self._queue if i[0] == key), None)
+            if priority and item is not None:
+                self._queue.remove(item)
+                self._queue.appendleft(item)
+            return future
+
+        future = self.bot.loop.create_future()
+        stats = self._items.get(key)
+        if stats is not None:
+            future.set_result(stats)
+            return future
+
+        self._pending[key] = future
+        item = (key, file, song.duration)
+        if priority:
+            self._queue.appendleft(item)
+        else:
+            self._queue.append(item)
+        self._not_empty.set()
+        self.start()
+        return future
+
+    def queue_song(self, song, priority=False):
+        """Queues song for analysis if it has a file that can be analysed"""
+        if song is None or not song.success or song.is_live:
+            return
+
+        file = song.filename
+        if file is None or not os.path.exists(file):
+            file = song.url if song.url != 'None' else None
+
+        if file is None:
+            return
+
+        return self.analyse(song, file, priority=priority)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run(), loop=self.bot.loop)
+
+    async def _run(self):
+        while True:
+            if not self._queue:
+                self._not_empty.clear()
+                await self.save()
+                await self._not_empty.wait()
+                continue
+
+            key, file, duration = self._queue.popleft()
+            future = self._pending.get(key)
+            t = time.perf_counter()
+            try:
+                stats = await self.bot.loop.run_in_executor(self._executor, volume_stats, file,
+                                                            False, duration, self.ebur128, self.timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(f'Failed to analyse {file}')
+                stats = None
+
+            self._pending.pop(key, None)
+            if stats is None:
+                self.failed += 1
+            else:
+                self.analysed += 1
+                self.analysis_time.add((time.perf_counter() - t) * 1000)
+                stats['duration'] = duration
+                stats['added'] = int(time.time())
+                self._add(key, stats)
+
+            if future is not None and not future.done():
+                future.set_result(stats)
+
+            if time.monotonic() - self._last_save > self.save_interval:
+                await self.save()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+        for future in self._pending.values():
+            if not future.done():
+                future.set_result(None)
+        self._pending.clear()
+        self._queue.clear()
+        await self.save()
+
+    def stats(self):
+        return {'items': len(self._items),
+                'queued': self.queued,
+                'hits': self.hits,
+                'misses': self.misses,
+                'analysed': self.analysed,
+                'failed': self.failed,
+                'analysis_time': self.analysis_time.to_dict()}
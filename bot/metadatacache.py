@@ -0,0 +1,223 @@
+"""
+Cache for the results of youtube_dl extract_info.
+
+Every play, autoplaylist pick and playlist expansion used to extract the
+info of the url again even though the same autoplaylist songs come up over
+and over. The metadata of a video rarely changes so it's kept for a long
+time. The stream url youtube gives expires after a few hours so it has its
+own shorter ttl, taken from the url itself when possible. Infos with a
+stream url are returned with the time they were extracted in the FETCHED
+key so the song doesn't think an old stream url was just fetched.
+"""
+
+import copy
+import json
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger('audio')
+terminal = logging.getLogger('terminal')
+
+_youtube_id = re.compile(r'(?:youtube\.com/.*?[?&]v=|youtu\.be/|youtube\.com/embed/)([\w-]{11})')
+_expire = re.compile(r'[?&/]expire[=/](\d+)')
+
+# Keys of the info dicts that are kept. The rest are never used and some
+# of them like the full format lists are big
+INFO_KEYS = ('id', 'title', 'url', 'webpage_url', 'duration', 'uploader', 'is_live',
+             'extractor', 'extractor_key', 'ie_key', 'ext', '_type', 'format_id',
+             'abr', 'acodec', 'http_headers', 'entries', 'formats')
+FORMAT_KEYS = ('format_id', 'url', 'ext', 'abr', 'acodec', 'vcodec', 'http_headers')
+ENTRY_KEYS = ('id', 'title', 'url', 'ie_key', 'duration', 'uploader', '_type')
+# Time the stream url of a cached info was extracted
+FETCHED = '_fetched'
+
+
+def normalize_url(url):
+    """Same key for the different forms of a youtube url"""
+    url = url.strip()
+    match = _youtube_id.search(url)
+    if match:
+        return 'youtube:' + match.group(1)
+
+    return url
+
+
+def trim_info(info):
+    trimmed = {k: info[k] for k in INFO_KEYS if k in info}
+    if trimmed.get('formats'):
+        trimmed['formats'] = [{k: f[k] for k in FORMAT_KEYS if k in f} for f in trimmed['formats']]
+    if trimmed.get('entries'):
+        trimmed['entries'] = [{k: e[k] for k in ENTRY_KEYS if k in e} for e in trimmed['entries'] if e]
+
+    return trimmed
+
+
+def strip_stream(info):
+    """Info without the stream urls"""
+    info = dict(info)
+    info.pop('url', None)
+    if info.get('formats'):
+        info['formats'] = [{k: v for k, v in f.items() if k != 'url'} for f in info['formats']]
+
+    return info
+
+
+class MetadataCache:
+    """
+    extract_info results keyed by the normalized url and whether the
+    playlist entries were extracted flat. Saved to a json file so they
+    survive restarts.
+
+    static_ttl is how long the metadata is valid, playlist_ttl the same for
+    playlists since their entries change more often and stream_ttl how long
+    the stream url is valid if the url doesn't tell when it expires. Stream urls
+    are considered expired stream_margin seconds early so they don't
+    expire in the middle of a song
+    """
+    def __init__(self, path, static_ttl=7*86400, playlist_ttl=3600, stream_ttl=7200, stream_margin=1200,
+                 max_items=20000, save_interval=300):
+        self.path = path
+        self.static_ttl = static_ttl
+        self.playlist_ttl = playlist_ttl
+        self.stream_ttl = stream_ttl
+        self.stream_margin = stream_margin
+        self.max_items = max_items
+        self.save_interval = save_interval
+
+        # key: {'info': info, 'added': time, 'stream_expires': time}
+        self._items = OrderedDict()
+        self._dirty = False
+        self._last_save = time.monotonic()
+
+        self.hits = 0
+        self.stale_streams = 0
+        self.misses = 0
+        self.coalesced = 0
+
+        self._load()
+
+    def __len__(self):
+        return len(self._items)
+
+    @staticmethod
+    def key(url, extract_flat=True):
+        return f'{"flat" if extract_flat else "full"}:{normalize_url(url)}'
+
+    def _load(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                items = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            terminal.exception(f'Failed to load metadata cache from {self.path}')
+            return
+
+        now = time.time()
+        for key, item in items.items():
+            if now - item['added'] <= self._ttl(item['info']):
+                self._items[key] = item
+
+        terminal.info(f'Loaded the metadata of {len(self._items)} urls')
+
+    def _ttl(self, info):
+        return self.playlist_ttl if 'entries' in info else self.static_ttl
+
+    def _stream_expires(self, info, now):
+        """When the stream url expires or None if there is no stream url"""
+        url = info.get('url')
+        if not url:
+            return
+
+        match = _expire.search(url)
+        if match:
+            return int(match.group(1)) - self.stream_margin
+
+        return now + self.stream_ttl - self.stream_margin
+
+    def get(self, key, require_stream=True):
+        """
+        Cached info of key or None. If the stream url has expired the info is
+        returned without it when require_stream is False
+        """
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            return
+
+        now = time.time()
+        info = item['info']
+        if now - item['added'] > self._ttl(info):
+            self._items.pop(key)
+            self._dirty = True
+            self.misses += 1
+            return
+
+        self._items.move_to_end(key)
+        expires = item['stream_expires']
+        if expires is not None and now > expires:
+            if require_stream:
+                self.misses += 1
+                return
+
+            self.stale_streams += 1
+            return strip_stream(info)
+
+        self.hits += 1
+        info = copy.deepcopy(info)
+        if expires is not None:
+            info[FETCHED] = item['added']
+        return info
+
+    def add(self, key, info):
+        if not isinstance(info, dict) or info.get('is_live'):
+            return
+
+        now = time.time()
+        info = trim_info(info)
+        self._items[key] = {'info': info,
+                            'added': now,
+                            'stream_expires': self._stream_expires(info, now)}
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+        self._dirty = True
+
+    @property
+    def needs_save(self):
+        return self._dirty and time.monotonic() - self._last_save > self.save_interval
+
+    def snapshot(self):
+        """Copy of the items that can be saved with save from another thread"""
+        self._dirty = False
+        self._last_save = time.monotonic()
+        return dict(self._items)
+
+    def save(self, items=None):
+        if items is None:
+            if not self._dirty:
+                return
+            items = self.snapshot()
+
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(items, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            terminal.exception('Failed to save metadata cache')
+
+    def clear(self):
+        self._items.clear()
+        self._dirty = True
+
+    def stats(self):
+        return {'items': len(self._items),
+                'hits': self.hits,
+                'stale_streams': self.stale_streams,
+                'misses': self.misses,
+                'coalesced': self.coalesced}
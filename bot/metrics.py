@@ -0,0 +1,94 @@
+import bisect
+
+
+class Histogram:
+    """
+    Fixed bucket histogram for timings. Values are given in milliseconds.
+    Keeps count, sum and max so mean can be calculated without storing every value
+    """
+    BUCKETS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    __slots__ = ('buckets', 'counts', 'count', 'total', 'max')
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.BUCKETS)
+        # Last slot is for values bigger than the biggest bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0
+
+    def percentile(self, p):
+        """
+        Upper bound of the bucket where the given percentile (0-100) falls in.
+        For values over the biggest bucket the max value is returned
+        """
+        if not self.count:
+            return 0
+
+        target = self.count * p / 100
+        seen = 0
+        for idx, c in enumerate(self.counts):
+            seen += c
+            if seen >= target and c:
+                if idx >= len(self.buckets):
+                    return self.max
+                return min(self.buckets[idx], self.max)
+
+        return self.max
+
+    def reset(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def to_dict(self):
+        return {'count': self.count,
+                'mean': round(self.mean, 3),
+                'p50': self.percentile(50),
+                'p95': self.percentile(95),
+                'p99': self.percentile(99),
+                'max': round(self.max, 3),
+                'buckets': dict(zip(map(str, self.buckets + ('inf',)), self.counts))}
+
+    def __str__(self):
+        return 'n={0.count} mean={0.mean:.1f}ms p95={1:.1f}ms max={0.max:.1f}ms'.format(self, self.percentile(95))
+
+
+class HistogramGroup:
+    """Histograms grouped under names which are created when they're first used"""
+    def __init__(self, buckets=None):
+        self._buckets = buckets
+        self._histograms = {}
+
+    def __getitem__(self, name):
+        h = self._histograms.get(name)
+        if h is None:
+            h = Histogram(self._buckets)
+            self._histograms[name] = h
+
+        return h
+
+    def add(self, name, value):
+        self[name].add(value)
+
+    def items(self):
+        return self._histograms.items()
+
+    def reset(self):
+        self._histograms.clear()
+
+    def to_dict(self):
+        return {k: h.to_dict() for k, h in self._histograms.items()}
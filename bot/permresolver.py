@@ -0,0 +1,161 @@
+from bot.globals import BlacklistTypes, PermValues
+
+
+class PermResolver:
+    """
+    Compiled command_blacklist rows of one guild.
+
+    Rows are indexed by command and the scope they apply to (user, role, channel or guild)
+    so resolving the active permission is a few dict lookups per role of the member
+    instead of a query and a scan over every matching row.
+    The result is the same as running the rows through utils.utilities.check_perms
+    """
+    USER = 'user'
+    ROLE = 'role'
+    CHANNEL = 'channel'
+    GUILD = 'guild'
+
+    def __init__(self, rows=()):
+        self._rows = {}
+        # {command: {scope: {target_id: {row_id: value}}}}
+        self._index = {}
+        # Rows that have more than one of user, role and channel set.
+        # Those are never created by the bot but they're still checked to keep results identical
+        self._complex = {}
+        for row in rows:
+            self.add_row(row)
+
+    def __len__(self):
+        return len(self._rows)
+
+    @staticmethod
+    def get_scope(row):
+        """Returns the scope of the row and the id it targets"""
+        if row['user'] is not None:
+            return PermResolver.USER, row['user']
+        elif row['role'] is not None:
+            return PermResolver.ROLE, row['role']
+        elif row['channel'] is not None:
+            return PermResolver.CHANNEL, row['channel']
+        else:
+            return PermResolver.GUILD, None
+
+    @staticmethod
+    def get_value(row):
+        if row['type'] == BlacklistTypes.WHITELIST:
+            v1 = PermValues.VALUES['whitelist']
+        else:
+            v1 = PermValues.VALUES['blacklist']
+
+        scope, _ = PermResolver.get_scope(row)
+        return v1 | PermValues.VALUES[scope]
+
+    @staticmethod
+    def _is_complex(row):
+        return sum(row[k] is not None for k in ('user', 'role', 'channel')) > 1
+
+    def add_row(self, row):
+        """Adds a new row or replaces the row with the same id"""
+        row_id = row['id']
+        if row_id in self._rows:
+            self.remove_row(row_id)
+
+        row = {k: row[k] for k in ('id', 'type', 'command', 'user', 'role', 'channel')}
+        self._rows[row_id] = row
+        if self._is_complex(row):
+            self._complex[row_id] = row
+            return
+
+        scope, target = self.get_scope(row)
+        scopes = self._index.setdefault(row['command'], {})
+        targets = scopes.setdefault(scope, {})
+        targets.setdefault(target, {})[row_id] = self.get_value(row)
+
+    def remove_row(self, row_id):
+        row = self._rows.pop(row_id, None)
+        if row is None:
+            return
+
+        if self._complex.pop(row_id, None) is not None:
+            return
+
+        scope, target = self.get_scope(row)
+        scopes = self._index[row['command']]
+        targets = scopes[scope]
+        values = targets[target]
+        values.pop(row_id, None)
+
+        # Clean up empty containers so the index doesn't grow forever
+        if not values:
+            del targets[target]
+            if not targets:
+                del scopes[scope]
+                if not scopes:
+                    del self._index[row['command']]
+
+    def resolve(self, command, user_id, role_ids, channel_id, return_raw=False):
+        """
+        Args:
+            command: Name of the command
+            user_id: id of the user
+            role_ids: iterable of role ids the user has
+            channel_id: id of the channel the command was used in
+
+        Returns:
+            None if no rows apply. Otherwise the same value check_perms would return
+        """
+        smallest = None
+
+        def update(values):
+            nonlocal smallest
+            if not values:
+                return
+
+            v = min(values.values())
+            if smallest is None or v < smallest:
+                smallest = v
+
+        for name in (command, None):
+            scopes = self._index.get(name)
+            if not scopes:
+                continue
+
+            targets = scopes.get(self.USER)
+            if targets:
+                update(targets.get(user_id))
+
+            targets = scopes.get(self.ROLE)
+            if targets:
+                for role_id in role_ids:
+                    update(targets.get(role_id))
+
+            targets = scopes.get(self.CHANNEL)
+            if targets:
+                update(targets.get(channel_id))
+
+            targets = scopes.get(self.GUILD)
+            if targets:
+                update(targets.get(None))
+
+        if self._complex:
+            role_ids = set(role_ids)
+            for row in self._complex.values():
+                if row['command'] not in (command, None):
+                    continue
+                if row['user'] not in (user_id, None):
+                    continue
+                if row['role'] is not None and row['role'] not in role_ids:
+                    continue
+                if row['channel'] not in (channel_id, None):
+                    continue
+
+                v = self.get_value(row)
+                if smallest is None or v < smallest:
+                    smallest = v
+
+        if smallest is None:
+            return None
+
+        # check_perms never goes above 18
+        smallest = min(smallest, 18)
+        return PermValues.RETURNS.get(smallest, False) if not return_raw else smallest
@@ -7,10 +7,52 @@ from discord import player
 from discord.errors import ClientException
 from discord.opus import Encoder as OpusEncoder
 
+from bot.metrics import Histogram
 from utils.utilities import seek_to_sec
 
 log = logging.getLogger('discord')
 
+# Frame timing stats of the players by guild id. Kept between songs
+player_stats = {}
+
+
+class PlayerStats:
+    """
+    Timing stats of the audio packets sent to one guild.
+    jitter is how far off schedule (ms) each packet was sent. A late packet
+    is sent after its scheduled time and an underrun is a late packet
+    that was late because reading it from the source took too long
+    """
+    __slots__ = ('sent', 'late', 'skipped', 'underruns', 'resyncs', 'jitter')
+
+    def __init__(self):
+        self.sent = 0
+        self.late = 0
+        self.skipped = 0
+        self.underruns = 0
+        self.resyncs = 0
+        self.jitter = Histogram((0.5, 1, 2, 5, 10, 20, 50, 100, 250, 1000))
+
+    def to_dict(self):
+        return {'sent': self.sent,
+                'late': self.late,
+                'skipped': self.skipped,
+                'underruns': self.underruns,
+                'resyncs': self.resyncs,
+                'jitter': self.jitter.to_dict()}
+
+    def __str__(self):
+        return f'{self.sent} sent, {self.late} late, {self.skipped} skipped, ' \
+               f'{self.underruns} underruns, {self.resyncs} resyncs, jitter {self.jitter}'
+
+
+def get_player_stats(guild_id):
+    stats = player_stats.get(guild_id)
+    if stats is None:
+        stats = PlayerStats()
+        player_stats[guild_id] = stats
+    return stats
+
 
 class FFmpegPCMAudio(player.FFmpegPCMAudio):
     """An audio source from FFmpeg (or AVConv).
@@ -50,8 +92,18 @@ class FFmpegPCMAudio(player.FFmpegPCMAudio):
     ClientException
         The subprocess failed to be created.
     """
+    # How many frames the read buffer holds
+    BUFFER_FRAMES = 16
+
     def __init__(self, source, *, executable='ffmpeg', pipe=False, stderr=None,
                              before_options=None, after_input=None, options=None, reconnect=True):
+        # Frames are read from the pipe in as big pieces as are available
+        # and handed out 20ms at a time from this buffer
+        self._buffer = bytearray(OpusEncoder.FRAME_SIZE * self.BUFFER_FRAMES)
+        self._view = memoryview(self._buffer)
+        self._buffer_start = 0
+        self._buffer_end = 0
+
         stdin = None if not pipe else source
         args = [executable]
         if reconnect:
@@ -82,15 +134,38 @@ class FFmpegPCMAudio(player.FFmpegPCMAudio):
         except subprocess.SubprocessError as e:
             raise ClientException('Popen failed: {0.__class__.__name__}: {0}'.format(e)) from e
 
+    def _fill(self):
+        """Reads whatever is available from the pipe to the buffer. Returns False on EOF"""
+        if self._buffer_start > 0:
+            # Move the unread part to the start so there's room after it
+            size = self._buffer_end - self._buffer_start
+            self._buffer[:size] = self._view[self._buffer_start:self._buffer_end]
+            self._buffer_start = 0
+            self._buffer_end = size
+
+        n = self._stdout.readinto1(self._view[self._buffer_end:])
+        if not n:
+            return False
+
+        self._buffer_end += n
+        return True
+
     def read(self):
-        ret = self._stdout.read(OpusEncoder.FRAME_SIZE)
-        if len(ret) != OpusEncoder.FRAME_SIZE:
-            return b''
-        return ret
+        frame_size = OpusEncoder.FRAME_SIZE
+        while self._buffer_end - self._buffer_start < frame_size:
+            if not self._fill():
+                # Partial frames at the end are dropped like before
+                return b''
+
+        start = self._buffer_start
+        self._buffer_start += frame_size
+        return bytes(self._view[start:start + frame_size])
 
 
 class AudioPlayer(player.AudioPlayer):
     DELAY = OpusEncoder.FRAME_LENGTH / 1000.0
+    # When this many frames behind the schedule is reset instead of catching up
+    RESYNC_FRAMES = 50
 
     def __init__(self, source, client, *, after=None, run_loops=0, frameskip=3, speed_mod=1):
         super().__init__(source, client, after=after)
@@ -98,15 +173,36 @@ class AudioPlayer(player.AudioPlayer):
         self.frameskip = frameskip
         self._speed_mod = speed_mod
         self.sfx_source = None
+        guild = getattr(client, 'guild', None)
+        self.stats = get_player_stats(guild.id if guild else None)
 
         self.bitrate = OpusEncoder.FRAME_SIZE / self.DELAY
+        # Start of the sending schedule. Separate from _start which the base
+        # class sets with time.time() while this uses the monotonic clock
+        self._schedule_start = time.perf_counter()
+
+    def resume(self, *args, **kwargs):
+        # Reset before the base class wakes up the player thread
+        self.loops = 0
+        self._schedule_start = time.perf_counter()
+        super().resume(*args, **kwargs)
+
+    def frame_delay(self, now):
+        """How long to sleep after sending frame number loops at now"""
+        next_time = self._schedule_start + self.DELAY * self.loops
+        return self.DELAY + (next_time - now)
 
     def _do_run(self):
+        # Monotonic so changes to the system clock don't mess up the timing
+        clock = time.perf_counter
         self.loops = 0
-        self._start = time.time()
+        self._schedule_start = clock()
         frameskip = 0
         # getattr lookup speed ups
         play_audio = self.client.send_audio_packet
+        stats = self.stats
+        jitter = stats.jitter
+        delay_ = self.DELAY
 
         while not self._end.is_set():
             # are we paused?
@@ -121,10 +217,12 @@ class AudioPlayer(player.AudioPlayer):
                 self._connected.wait()
                 # reset our internal data
                 self.loops = 0
-                self._start = time.time()
+                self._schedule_start = clock()
 
             self.loops += 1
+            read_start = clock()
             data = self.source.read()
+            read_time = clock() - read_start
 
             """
             # sfx in one audio loop
@@ -139,23 +237,41 @@ class AudioPlayer(player.AudioPlayer):
                 data = audioop.add(data, data2, 2)
             """
 
+            if not data:
+                self.stop()
+                break
+
             if frameskip > 0:
                 frameskip -= 1
+                stats.skipped += 1
                 self._run_loops += 1
                 continue
 
-            if not data:
-                self.stop()
-                break
-
             play_audio(data, encode=not self.source.is_opus())
             self._run_loops += 1
-            next_time = self._start + self.DELAY * self.loops
-            delay = max(0, self.DELAY + (next_time - time.time()))
-            if delay < 0:
-                frameskip = min(self.frameskip, abs(int(delay/self.DELAY)))
+            stats.sent += 1
+            now = clock()
+            delay = self.frame_delay(now)
+            jitter.add(abs(min(delay, 0)) * 1000)
+            if delay >= 0:
+                time.sleep(delay)
                 continue
-            time.sleep(delay)
+
+            stats.late += 1
+            if read_time > delay_:
+                stats.underruns += 1
+
+            behind = int(-delay / delay_)
+            if behind >= self.RESYNC_FRAMES:
+                # Probably a long stall. Skipping or rushing that many frames
+                # would sound worse than just continuing from here
+                stats.resyncs += 1
+                self.loops = 0
+                self._schedule_start = now
+            elif behind > 0:
+                # Drop frames to get back on schedule. Anything less than a
+                # frame behind is caught up by sending the next one right away
+                frameskip = min(self.frameskip, behind)
 
     @property
     def run_loops(self):
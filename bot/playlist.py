@@ -34,6 +34,7 @@ import discord
 from validators import url as valid_url
 
 from bot.downloader import Downloader
+from bot.metrics import Histogram
 from bot.globals import CACHE, PLAYLISTS
 from bot.paged_message import PagedMessage
 from bot.song import Song
@@ -51,7 +52,8 @@ logger = logging.getLogger('audio')
 
 
 class Playlist:
-    def __init__(self, bot, download=False, channel=None, downloader: Downloader=None):
+    def __init__(self, bot, download=False, channel=None, downloader: Downloader=None,
+                 autoplaylist_store=None, loudness=None):
         self.bot = bot
         self.channel = channel
         self.download = download
@@ -60,8 +62,18 @@ class Playlist:
         self.downloader = Downloader(CACHE) if not downloader else downloader
         self.not_empty = asyncio.Event()
         self.playlist_path = PLAYLISTS
+        self.autoplaylist_store = autoplaylist_store
+        self.loudness = loudness
         self.adding_songs = False
 
+        # Songs being downloaded ahead of time and their tasks
+        self.prefetch_count = bot.config.prefetch_songs
+        self._prefetch = {}
+        self._prefetch_sem = asyncio.Semaphore(self.downloader.max_workers)
+        self.ready_starts = 0
+        self.waited_starts = 0
+        self.wait_time = Histogram()
+
     def __iter__(self):
         return iter(self.playlist)
 
@@ -69,6 +81,62 @@ class Playlist:
         shuffle(self.playlist)
         await self.download_next()
 
+    async def _prefetch_song(self, song):
+        async with self._prefetch_sem:
+            await song.download()
+
+        self.queue_loudness(song)
+
+    def queue_loudness(self, song):
+        """Analyses the loudness of a downloaded song in the background before it plays"""
+        if song.success and self.loudness is not None and self.bot.config.auto_volume:
+            self.loudness.queue_song(song)
+
+    def _prefetch_done(self, song, task):
+        if self._prefetch.get(song) is task:
+            self._prefetch.pop(song)
+
+        if not task.cancelled() and task.exception() is not None:
+            logger.debug(f'Prefetch of {song.webpage_url} failed: {task.exception()}')
+
+    def cancel_removed(self):
+        """Cancels the prefetches of songs that are no longer in the playlist"""
+        queued = set(self.playlist)
+        for song, task in list(self._prefetch.items()):
+            if song not in queued:
+                task.cancel()
+                self._prefetch.pop(song, None)
+
+    def schedule_prefetch(self):
+        """
+        Starts downloading the next prefetch_count songs. At most as many
+        songs as the downloader has threads are downloaded at the same time
+        """
+        for song in list(self.playlist)[:self.prefetch_count]:
+            if not song or song.success or song.downloading or song in self._prefetch:
+                continue
+
+            task = asyncio.ensure_future(self._prefetch_song(song), loop=self.bot.loop)
+            task.add_done_callback(functools.partial(self._prefetch_done, song))
+            self._prefetch[song] = task
+
+    def record_start(self, waited, wait_time=0):
+        """
+        Called when a song starts playing or gives up waiting for it.
+        waited tells if it had to wait for the download
+        """
+        if waited:
+            self.waited_starts += 1
+            self.wait_time.add(wait_time * 1000)
+        else:
+            self.ready_starts += 1
+
+    def prefetch_stats(self):
+        return {'prefetching': len(self._prefetch),
+                'ready_starts': self.ready_starts,
+                'waited_starts': self.waited_starts,
+                'wait_time': self.wait_time.to_dict()}
+
     def peek(self):
         if self.playlist:
             return self.playlist[0]
@@ -79,27 +147,34 @@ class Playlist:
             if not song:
                 return
 
+            task = self._prefetch.get(song)
+            if task is not None:
+                terminal.debug('waiting for prefetch in next_song')
+                await asyncio.wait([task], loop=self.bot.loop)
+
             if not song.success:
                 terminal.debug('downloading from next_song')
                 await song.download()
 
+            self.schedule_prefetch()
             return song
 
     async def download_next(self):
-        next_song = self.peek()
-        if next_song is not None:
-            await next_song.download()
-        return next_song
+        self.schedule_prefetch()
+        return self.peek()
 
     async def clear(self, indexes=None, channel=None):
         if indexes is None:
             self.playlist.clear()
+            self.cancel_removed()
         else:
             if delete_by_indices is not None:
                 songs_left = delete_by_indices(list(self.playlist), indexes)
                 self.playlist.clear()
                 for song in songs_left:
                     self.playlist.append(song)
+                self.cancel_removed()
+                self.schedule_prefetch()
             else:
                 terminal.warning('Numpy is not installed. Cannot delete songs by index')
                 await channel.send('Clearing by indices is not supported')
@@ -144,12 +219,11 @@ class Playlist:
         await message.add_reaction('❌')
 
         def check(reaction, user):
-            return reaction.emoji in emoji and ctx.author.id == user.id and reaction.message.id == message.id
+            return reaction.emoji in emoji and ctx.author.id == user.id
 
         while True:
             try:
-                result = await self.bot.wait_for('reaction_changed', check=check,
-                                                 timeout=60)
+                result = await self.bot.wait_for_reaction(message, check=check, timeout=60)
             except asyncio.TimeoutError:
                 return await ctx.send('Took too long.')
 
@@ -200,7 +274,8 @@ class Playlist:
             channel = self.channel
 
         on_error = functools.partial(self.failed_info, channel=channel)
-        info = await self.downloader.extract_info(self.bot.loop, url=url, download=False, on_error=on_error)
+        info = await self.downloader.extract_info(self.bot.loop, url=url, download=False, on_error=on_error,
+                                                  require_stream=False)
         if info is None:
             return
         await self._add_from_info(channel=channel, priority=priority,
@@ -214,7 +289,8 @@ class Playlist:
         try:
             self.adding_songs = True
             if valid_url(name):
-                info = await self.downloader.extract_info(self.bot.loop, url=name, on_error=on_error, download=False)
+                info = await self.downloader.extract_info(self.bot.loop, url=name, on_error=on_error, download=False,
+                                                          require_stream=False)
             else:
                 info = await self._search(name, on_error=on_error)
             if info is None:
@@ -281,7 +357,7 @@ class Playlist:
                     progress += 1
 
                     info = await self.downloader.extract_info(self.bot.loop, url=url % entry['id'], download=False,
-                                                              on_error=_on_error)
+                                                              on_error=_on_error, require_stream=False)
                     if info is False:
                         continue
 
@@ -405,6 +481,7 @@ class Playlist:
         if not self.playlist or priority:
             terminal.debug(f'Downloading {song.webpage_url}')
             await song.download()
+            self.queue_loudness(song)
 
             if priority:
                 self.playlist.appendleft(song)
@@ -417,6 +494,8 @@ class Playlist:
             self.playlist.append(song)
             self.bot.loop.call_soon_threadsafe(self.not_empty.set)
 
+        self.schedule_prefetch()
+
     async def get_from_url(self, url):
         song = Song(self, webpage_url=url, config=self.bot.config)
         terminal.debug(f'Downloading {song.webpage_url} from url')
@@ -424,6 +503,8 @@ class Playlist:
         await song.on_ready.wait()
         if not song.success:
             return
+
+        self.queue_loudness(song)
         return song
 
     async def get_from_autoplaylist(self):
@@ -437,9 +518,14 @@ class Playlist:
         await song.on_ready.wait()
         if not song.success:
             return
+
+        self.queue_loudness(song)
         return song
 
     def get_random_song(self, playlist):
+        if playlist == 'autoplaylist' and self.autoplaylist_store is not None:
+            return self.autoplaylist_store.random()
+
         songs = self._get_playlist(playlist + '.txt')
         if songs is None:
             return
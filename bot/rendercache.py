@@ -0,0 +1,223 @@
+"""
+Cache for the output of deterministic image commands.
+
+Results are keyed by the command, its arguments and a hash of the source
+image so the same avatar or emote posted from different urls still hits.
+Urls are mapped to the hash of their content for a while so a repeated
+request can skip downloading the image too. Keys also have a render version
+so results cached on disk by older render code aren't served after it changes.
+"""
+
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger('debug')
+terminal = logging.getLogger('terminal')
+
+# Increase when code shared by the renders like the templates or imagetools
+# changes their output. Functions of single commands have their own versions
+RENDER_VERSION = 1
+
+
+class RenderCache:
+    """
+    LRU cache of rendered images held in memory with an optional disk tier.
+    Both tiers are evicted by their total size in bytes. Disk files are
+    written when a result is added and promoted to memory when they're read
+    """
+    def __init__(self, bot, max_bytes=64*1024*1024, disk_path=None, disk_max_bytes=0,
+                 max_item_bytes=8000000, source_ttl=3600, max_sources=10000):
+        self._bot = bot
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.source_ttl = source_ttl
+        self.max_sources = max_sources
+
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        # url: (digest, time added)
+        self._sources = OrderedDict()
+
+        self.disk_path = disk_path if disk_max_bytes > 0 else None
+        self.disk_max_bytes = disk_max_bytes
+        self._disk = OrderedDict()
+        self._disk_size = 0
+        if self.disk_path:
+            self._load_disk_index()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.source_hits = 0
+
+    @property
+    def bot(self):
+        return self._bot
+
+    def _load_disk_index(self):
+        os.makedirs(self.disk_path, exist_ok=True)
+        files = []
+        for entry in os.scandir(self.disk_path):
+            if not entry.is_file():
+                continue
+
+            if entry.name.endswith('.tmp'):
+                os.remove(entry.path)
+                continue
+
+            stat = entry.stat()
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+
+        # Oldest first so they're evicted first
+        files.sort()
+        for _, key, size in files:
+            self._disk[key] = size
+            self._disk_size += size
+
+        self._evict_disk()
+
+    @staticmethod
+    def digest(data):
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    @staticmethod
+    def make_key(command, args, source_digest=None, version=0):
+        """
+        Key of a render result. args must have a stable repr.
+        version is the version of the render code of the command
+        """
+        return hashlib.blake2b(repr((RENDER_VERSION, command, version, args, source_digest)).encode('utf-8'),
+                               digest_size=20).hexdigest()
+
+    def source_digest(self, url):
+        """Digest of the content of url if it was downloaded recently"""
+        source = self._sources.get(url)
+        if source is None:
+            return
+
+        digest, added = source
+        if time.monotonic() - added > self.source_ttl:
+            del self._sources[url]
+            return
+
+        self.source_hits += 1
+        return digest
+
+    def remember_source(self, url, data):
+        """Hash the downloaded data and remember which url it came from"""
+        digest = self.digest(data)
+        self._sources[url] = (digest, time.monotonic())
+        self._sources.move_to_end(url)
+        while len(self._sources) > self.max_sources:
+            self._sources.popitem(last=False)
+
+        return digest
+
+    def _disk_file(self, key):
+        return os.path.join(self.disk_path, key)
+
+    async def get(self, key):
+        data = self._memory.get(key)
+        if data is not None:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            return data
+
+        if self.disk_path and key in self._disk:
+            def read():
+                with open(self._disk_file(key), 'rb') as f:
+                    return f.read()
+
+            try:
+                data = await self.bot.loop.run_in_executor(self.bot.threadpool, read)
+            except OSError:
+                logger.exception('Failed to read cached render')
+                self._remove_disk(key)
+            else:
+                self._disk.move_to_end(key)
+                self.disk_hits += 1
+                self._add_memory(key, data)
+                return data
+
+        self.misses += 1
+
+    def _add_memory(self, key, data):
+        old = self._memory.pop(key, None)
+        if old is not None:
+            self._memory_size -= len(old)
+
+        self._memory[key] = data
+        self._memory_size += len(data)
+        while self._memory_size > self.max_bytes and self._memory:
+            _, old = self._memory.popitem(last=False)
+            self._memory_size -= len(old)
+            self.evictions += 1
+
+    async def put(self, key, data):
+        if not isinstance(data, bytes) or len(data) > self.max_item_bytes:
+            return
+
+        self._add_memory(key, data)
+
+        if not self.disk_path or key in self._disk:
+            return
+
+        path = self._disk_file(key)
+
+        def write():
+            tmp = path + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+
+        try:
+            await self.bot.loop.run_in_executor(self.bot.threadpool, write)
+        except OSError:
+            logger.exception('Failed to write render to disk cache')
+            return
+
+        self._disk[key] = len(data)
+        self._disk_size += len(data)
+        self._evict_disk()
+
+    def _remove_disk(self, key):
+        size = self._disk.pop(key, None)
+        if size is None:
+            return
+
+        self._disk_size -= size
+        try:
+            os.remove(self._disk_file(key))
+        except OSError:
+            pass
+
+    def _evict_disk(self):
+        while self._disk_size > self.disk_max_bytes and self._disk:
+            key = next(iter(self._disk))
+            self._remove_disk(key)
+            self.evictions += 1
+
+    def clear(self):
+        self._memory.clear()
+        self._memory_size = 0
+        self._sources.clear()
+        for key in list(self._disk.keys()):
+            self._remove_disk(key)
+
+    def stats(self):
+        return {'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'source_hits': self.source_hits,
+                'sources': len(self._sources),
+                'memory_items': len(self._memory),
+                'memory_bytes': self._memory_size,
+                'max_bytes': self.max_bytes,
+                'disk_items': len(self._disk),
+                'disk_bytes': self._disk_size,
+                'disk_max_bytes': self.disk_max_bytes}
@@ -0,0 +1,232 @@
+"""
+Process pool that cpu heavy image commands are rendered in.
+
+PIL and numpy hold the GIL for most of their work so rendering in bot.threadpool
+makes a few concurrent gif renders block everything else that uses the pool.
+Render functions are run in worker processes instead. They must be module level
+functions that take and return picklable values (usually image bytes)
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from bot.exceptions import BotException, RenderQueueFull
+from bot.metrics import HistogramGroup
+from utils.templates import templates
+
+logger = logging.getLogger('debug')
+terminal = logging.getLogger('terminal')
+
+
+def _render(func, args, kwargs, process=False):
+    """
+    Runs in the worker. Returns the result, error message, render time in ms
+    and the template counts of the worker process or None when run in a thread
+    """
+    t = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+        error = None
+    except BotException as e:
+        # Most BotException subclasses can't be unpickled because of their
+        # init signatures so only the message is sent back
+        result = None
+        error = str(e)
+
+    render_time = (time.perf_counter() - t) * 1000
+    counts = templates.take_counts() if process else None
+    return result, error, render_time, counts
+
+
+def _noop():
+    pass
+
+
+class RenderPool:
+    """
+    Runs render jobs in worker processes.
+
+    Jobs are queued per guild and guilds take turns when a worker frees up
+    so one guild spamming gifs can't starve the others.
+    At most max_in_flight jobs are given to the workers at once. New jobs are
+    rejected with RenderQueueFull when max_queue jobs are waiting or the guild
+    already has max_per_guild jobs queued or rendering.
+    """
+    def __init__(self, loop, workers=2, max_in_flight=None, max_queue=30, max_per_guild=3):
+        self.loop = loop
+        self.workers = workers
+        self.max_in_flight = max_in_flight or max(workers, 1)
+        self.max_queue = max_queue
+        self.max_per_guild = max_per_guild
+        self.processes = False
+        self._executor = self._create_executor()
+
+        self._queues = OrderedDict()
+        self._queued = 0
+        self._in_flight = 0
+        self._guild_jobs = {}
+        self._closed = False
+
+        self.completed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.queue_time = HistogramGroup()
+        self.render_time = HistogramGroup()
+
+    def _create_executor(self):
+        if self.workers > 0:
+            try:
+                # Workers must be forked. Other start methods would run
+                # the launcher script again in every worker
+                ctx = multiprocessing.get_context('fork')
+            except ValueError:
+                terminal.warning('Forking not supported. Rendering images in threads')
+            else:
+                executor = ProcessPoolExecutor(self.workers, mp_context=ctx)
+                # Fork the workers right away while the bot has as few threads
+                # and open connections as possible
+                executor.submit(_noop)
+                self.processes = True
+                return executor
+
+        self.processes = False
+        return ThreadPoolExecutor(self.max_in_flight, thread_name_prefix='render')
+
+    @property
+    def queue_depth(self):
+        return self._queued
+
+    @property
+    def in_flight(self):
+        return self._in_flight
+
+    def guild_jobs(self, guild_id):
+        """Amount of jobs the guild has queued or rendering"""
+        return self._guild_jobs.get(guild_id, 0)
+
+    async def submit(self, guild_id, name, func, *args, **kwargs):
+        """
+        Render using func(*args, **kwargs) in a worker and return the result.
+        name is used for the timing metrics, usually it's the command name
+        """
+        if self._closed:
+            raise RenderQueueFull('Image rendering is not available right now')
+
+        if self._queued >= self.max_queue or self.guild_jobs(guild_id) >= self.max_per_guild:
+            self.rejected += 1
+            raise RenderQueueFull('Too many images are being rendered right now. Try again in a moment')
+
+        future = self.loop.create_future()
+        job = (name, func, args, kwargs, future, time.perf_counter())
+        self._queues.setdefault(guild_id, deque()).append(job)
+        self._queued += 1
+        self._guild_jobs[guild_id] = self.guild_jobs(guild_id) + 1
+        self._dispatch()
+
+        return await future
+
+    def _release(self, guild_id):
+        jobs = self._guild_jobs.get(guild_id, 0) - 1
+        if jobs > 0:
+            self._guild_jobs[guild_id] = jobs
+        else:
+            self._guild_jobs.pop(guild_id, None)
+
+    def _dispatch(self):
+        while self._in_flight < self.max_in_flight and self._queues:
+            # Take one job from the guild that has waited longest for its turn
+            guild_id, queue = next(iter(self._queues.items()))
+            name, func, args, kwargs, future, queued_at = queue.popleft()
+            if queue:
+                self._queues.move_to_end(guild_id)
+            else:
+                del self._queues[guild_id]
+            self._queued -= 1
+
+            # Command was cancelled while waiting
+            if future.done():
+                self._release(guild_id)
+                continue
+
+            self.queue_time.add(name, (time.perf_counter() - queued_at) * 1000)
+            executor = self._executor
+            try:
+                task = executor.submit(_render, func, args, kwargs, self.processes)
+            except BrokenProcessPool:
+                executor = self._restart(executor)
+                task = executor.submit(_render, func, args, kwargs, self.processes)
+
+            self._in_flight += 1
+            task = asyncio.wrap_future(task, loop=self.loop)
+            task.add_done_callback(partial(self._on_done, executor, guild_id, name, future))
+
+    def _restart(self, broken):
+        # Many jobs can fail because of the same broken pool. Only restart it once
+        if broken is self._executor and not self._closed:
+            terminal.error('Render worker died. Restarting render pool')
+            broken.shutdown(wait=False)
+            self._executor = self._create_executor()
+
+        return self._executor
+
+    def _on_done(self, executor, guild_id, name, future, task):
+        self._in_flight -= 1
+        self._release(guild_id)
+        error = None
+
+        try:
+            result, error_msg, render_time, counts = task.result()
+        except BrokenProcessPool:
+            self._restart(executor)
+            error = BotException('Failed to render image. Try again')
+        except Exception as e:
+            error = e
+        else:
+            self.render_time.add(name, render_time)
+            if counts is not None:
+                templates.add_counts(*counts)
+            if error_msg is not None:
+                error = BotException(error_msg)
+
+        if error is not None:
+            self.failed += 1
+            if not future.done():
+                future.set_exception(error)
+        else:
+            self.completed += 1
+            if not future.done():
+                future.set_result(result)
+
+        if not self._closed:
+            self._dispatch()
+
+    def close(self):
+        self._closed = True
+        for queue in self._queues.values():
+            for job in queue:
+                future = job[4]
+                if not future.done():
+                    future.set_exception(RenderQueueFull('Image rendering was shut down'))
+
+        self._queues.clear()
+        self._queued = 0
+        self._executor.shutdown(wait=False)
+
+    def stats(self):
+        return {'workers': self.workers,
+                'processes': self.processes,
+                'max_in_flight': self.max_in_flight,
+                'in_flight': self._in_flight,
+                'queued': self._queued,
+                'guild_jobs': dict(self._guild_jobs),
+                'completed': self.completed,
+                'rejected': self.rejected,
+                'failed': self.failed,
+                'queue_time': self.queue_time.to_dict(),
+                'render_time': self.render_time.to_dict()}
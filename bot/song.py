@@ -27,6 +27,8 @@ import logging
 import os
 import time
 
+from bot.metadatacache import FETCHED
+
 logger = logging.getLogger('audio')
 terminal = logging.getLogger('terminal')
 
@@ -101,7 +103,8 @@ class Song:
         self.is_live = kwargs.pop('is_live', True)
 
         if 'url' in kwargs:
-            self.last_update = time.time()
+            # Stream urls from the metadata cache are older than this
+            self.last_update = kwargs.pop(FETCHED, None) or time.time()
             self.success = True
             self.playlist.bot.loop.call_soon_threadsafe(self.on_ready.set)
 
@@ -129,7 +132,11 @@ class Song:
             return False
 
     async def download(self):
-        if time.time() - self.last_update <= 7200 or self._downloading or self.success:
+        if self._downloading:
+            # on_ready is set when the running download finishes
+            return
+
+        if time.time() - self.last_update <= 7200 or self.success:
             self.playlist.bot.loop.call_soon_threadsafe(self.on_ready.set)
             return
 
@@ -149,42 +156,37 @@ class Song:
                     os.makedirs(self.dl_folder)
                     logger.debug(f'Created dir {self.dl_folder}')
 
+                cache = self.playlist.downloader.cache
                 if self.filename is not None and os.path.exists(self.filename):
+                    cache.played(self.id)
                     self.success = True
                     return
 
-                check_dl = False
-                if self.id is not None:
-                    fdir = os.listdir(self.dl_folder)
-                    for f in fdir:
-                        if self.id in f:
-                            check_dl = True
-                            break
-
-                if check_dl and self.filename is None:
-                    logger.debug('Getting and checking info for: {}'.format(self))
-                    info = await self.playlist.downloader.safe_extract_info(loop, url=self.webpage_url, download=False)
-                    logger.debug('Got info')
-                    self.filename = self.playlist.downloader.safe_ytdl.prepare_filename(info)
-                    logger.debug('Filename set to {}'.format(self.filename))
-
-                if self.filename is not None:
-                    if os.path.exists(self.filename):
-                        terminal.info('File exists for %s' % self.title)
-                        logger.debug('File exists for %s' % self.title)
-                        self.success = True
-                        return
+                cached = cache.get(self.id)
+                if cached is not None:
+                    terminal.info('File exists for %s' % self.title)
+                    logger.debug('File exists for %s' % self.title)
+                    self.filename = cached
+                    cache.played(self.id)
+                    self.success = True
+                    return
 
             logger.debug('Getting info and downloading {}'.format(self.webpage_url))
             info = await self.playlist.downloader.extract_info(loop, url=self.webpage_url, download=dl)
             logger.debug('Got info')
 
             self.info_from_dict(**info)
+            if dl:
+                self.playlist.downloader.cache.add(self.id, self.filename)
             terminal.info('Downloaded ' + self.webpage_url)
             logger.debug('Filename set to {}'.format(self.filename))
             self.success = True
             return
 
+        except asyncio.CancelledError:
+            logger.debug(f'Download of {self.webpage_url} cancelled')
+            raise
+
         except Exception as e:
             logger.debug('Download error: {}'.format(e))
             await self.playlist.channel.send('Failed to download {0}\n{1}'.format(self.title, e))
@@ -200,6 +202,7 @@ class Song:
                     return
 
                 os.remove(self.filename)
+                self.playlist.downloader.cache.remove(self.id, delete=False)
                 terminal.info('Deleted ' + self.filename)
                 break
             except PermissionError:
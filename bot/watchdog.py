@@ -0,0 +1,194 @@
+"""
+Detects synchronous code blocking the event loop.
+
+A task on the event loop wakes up every interval and records how late it
+woke up as the loop lag. A separate thread watches when the task last woke
+up and if the loop has been stuck for longer than threshold it takes the
+stack of the loop thread, so the code that blocked the loop shows up in the
+log while it's still blocking. The cog and the listener or command that
+was running are looked up from the stack.
+"""
+
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+
+from bot.metrics import Histogram
+
+terminal = logging.getLogger('terminal')
+
+LAG_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+
+class BlockReport:
+    __slots__ = ('time', 'duration', 'cog', 'function', 'location', 'stack')
+
+    def __init__(self, duration, cog, function, location, stack):
+        self.time = time.time()
+        # Updated to the full duration once the loop gets going again
+        self.duration = duration
+        self.cog = cog
+        self.function = function
+        self.location = location
+        self.stack = stack
+
+    @property
+    def source(self):
+        if self.cog:
+            return f'{self.cog} {self.function}'
+        return self.function or 'unknown'
+
+    def __str__(self):
+        return f'{self.duration:.0f}ms in {self.source} at {self.location}'
+
+
+def describe_stack(frame):
+    """
+    Finds the cog and the listener or command running in the stack of frame.
+    Returns the cog module, the function, the location of the innermost
+    frame and the formatted stack. The function is the outermost one from
+    a cog or if there are none from the bot package
+    """
+    stack = traceback.extract_stack(frame)
+    location = f'{stack[-1].filename}:{stack[-1].lineno} {stack[-1].name}' if stack else None
+
+    cog = None
+    function = None
+    bot_function = None
+    # Locals aren't read since the frames are still running in the loop thread
+    while frame is not None:
+        code = frame.f_code
+        module = frame.f_globals.get('__name__', '')
+        name = getattr(code, 'co_qualname', code.co_name)
+        if module.startswith('cogs.'):
+            cog = module
+            function = name
+        elif module.startswith('bot.'):
+            bot_function = f'{module}.{name}'
+
+        frame = frame.f_back
+
+    return cog, function or bot_function, location, ''.join(traceback.format_list(stack))
+
+
+class LoopWatchdog:
+    """
+    Records the lag of the event loop and reports when it's blocked for
+    longer than threshold seconds. Lag is kept in a histogram for the current
+    window and the previous one so the stats show recent behaviour
+    """
+    def __init__(self, loop, interval=0.1, threshold=0.25, window=600, max_reports=50):
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self.window = window
+
+        self.lag = Histogram(LAG_BUCKETS)
+        self.previous_lag = None
+        self._window_start = time.monotonic()
+
+        self.reports = deque(maxlen=max_reports)
+        self.sources = Counter()
+        self.blocked = 0
+
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+        self._loop_thread = None
+        self._beat = None
+        self._reported_beat = None
+        self._last_report = None
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def start(self):
+        if self.running:
+            return
+
+        self._stopped.clear()
+        self._task = asyncio.ensure_future(self._run(), loop=self.loop)
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _rotate(self, now):
+        if now - self._window_start > self.window:
+            self.previous_lag = self.lag
+            self.lag = Histogram(LAG_BUCKETS)
+            self._window_start = now
+
+    async def _run(self):
+        self._loop_thread = threading.get_ident()
+        clock = time.monotonic
+        self._beat = clock()
+        while True:
+            await asyncio.sleep(self.interval)
+            now = clock()
+            lag = max(now - self._beat - self.interval, 0) * 1000
+            self._beat = now
+
+            self._rotate(now)
+            self.lag.add(lag)
+
+            report = self._last_report
+            if report is not None:
+                # The block that was reported has ended
+                report.duration = max(report.duration, lag)
+                self._last_report = None
+
+    def _watch(self):
+        check = max(min(self.threshold / 2, self.interval), 0.01)
+        while not self._stopped.wait(check):
+            beat = self._beat
+            if beat is None or beat == self._reported_beat:
+                continue
+
+            blocked = time.monotonic() - beat - self.interval
+            if blocked < self.threshold:
+                continue
+
+            self._reported_beat = beat
+            frame = sys._current_frames().get(self._loop_thread)
+            if frame is None:
+                continue
+
+            try:
+                cog, function, location, stack = describe_stack(frame)
+            except Exception:
+                terminal.exception('Failed to read the stack of the event loop')
+                continue
+            finally:
+                del frame
+
+            report = BlockReport(blocked * 1000, cog, function, location, stack)
+            self.blocked += 1
+            self.sources[report.source] += 1
+            self.reports.append(report)
+            self._last_report = report
+            terminal.warning(f'Event loop blocked for over {blocked*1000:.0f}ms in {report.source}\n{stack}')
+
+    def reset(self):
+        self.lag = Histogram(LAG_BUCKETS)
+        self.previous_lag = None
+        self._window_start = time.monotonic()
+        self.reports.clear()
+        self.sources.clear()
+        self.blocked = 0
+
+    def stats(self):
+        return {'lag': self.lag.to_dict(),
+                'previous_lag': self.previous_lag.to_dict() if self.previous_lag else None,
+                'blocked': self.blocked,
+                'sources': dict(self.sources.most_common())}
@@ -27,6 +27,7 @@ import logging
 import os
 import random
 import re
+import time
 import weakref
 from collections import deque
 from functools import partial
@@ -44,7 +45,9 @@ from bot import player
 from bot.bot import command, cooldown
 from bot.downloader import Downloader
 from bot.globals import ADD_AUTOPLAYLIST, DELETE_AUTOPLAYLIST
-from bot.globals import Auth
+from bot.autoplaylist import AutoplaylistStore
+from bot.globals import Auth, CACHE, METADATA_CACHE
+from bot.loudness import LoudnessCache
 from bot.playlist import Playlist
 from bot.song import Song
 from bot.youtube import url2id, get_related_vids, id2url
@@ -83,7 +86,8 @@ class MusicPlayer:
         for inst in cls.__instances__:
             yield inst
 
-    def __init__(self, bot, disconnect, channel=None, downloader=None):
+    def __init__(self, bot, disconnect, channel=None, downloader=None, loudness=None,
+                 autoplaylist_store=None):
         self.__instances__.add(self)
         self.bot = bot
         self.play_next = asyncio.Event()
@@ -93,11 +97,13 @@ class MusicPlayer:
         self.repeat = False
         self._disconnect = disconnect
 
-        self.playlist = Playlist(bot, channel=self.channel, downloader=downloader)
+        self.playlist = Playlist(bot, channel=self.channel, downloader=downloader,
+                                 autoplaylist_store=autoplaylist_store, loudness=loudness)
         self.autoplaylist = bot.config.autoplaylist
         self.autoplay = False  # Youtube autoplay
         self.volume = self.bot.config.default_volume
         self.volume_multiplier = bot.config.volume_multiplier
+        self.loudness = loudness
         self.audio_player = None
         self.activity_check = None
         self._speed_mod = 1
@@ -157,8 +163,23 @@ class MusicPlayer:
         rms = pow(10, db / 20) * 32767
         return 1 / rms * self.volume_multiplier
 
+    def _get_volume_from_stats(self, stats):
+        if stats is None or abs(stats['mean']) < 0.1:
+            return
+
+        return self._get_volume_from_db(stats['mean'])
+
     async def set_mean_volume(self, file):
         try:
+            if self.loudness is not None:
+                # Shielded so skipping the song doesn't cancel the analysis that gets cached
+                stats = await asyncio.shield(self.loudness.analyse(self.current, file, priority=True))
+                volume = self._get_volume_from_stats(stats)
+                if volume is not None:
+                    logger.debug(f'parsed volume {volume}')
+                    self.current_volume = volume
+                return
+
             db = await asyncio.wait_for(mean_volume(file, self.bot.loop, self.bot.threadpool,
                                         duration=self.current.duration), timeout=20, loop=self.bot.loop)
             if db is not None and abs(db) >= 0.1:
@@ -191,8 +212,14 @@ class MusicPlayer:
     async def _play_audio(self):
         while self.voice and self.voice.is_connected():
             self.play_next.clear()
+            # Time from picking the next song until it can be played
+            wait_start = time.perf_counter()
+            waited = False
             if self.current is None:
-                if self.playlist.peek() is None:
+                next_song = self.playlist.peek()
+                # Autoplay and autoplaylist songs are always downloaded when they're needed
+                waited = next_song is None or not next_song.success
+                if next_song is None:
                     if self.autoplay and self.last:
                         vid_id = url2id(self.last.webpage_url)
                         history = [url2id(s.webpage_url) for s in self.history]
@@ -235,10 +262,13 @@ class MusicPlayer:
             logger.debug(f'Next song is {self.current}')
             logger.debug('Waiting for dl')
 
+            waited = waited or not self.current.on_ready.is_set()
             try:
                 await asyncio.wait_for(self.current.on_ready.wait(), timeout=15,
                                        loop=self.bot.loop)
+                self.playlist.record_start(waited, time.perf_counter() - wait_start)
             except asyncio.TimeoutError:
+                self.playlist.record_start(True, time.perf_counter() - wait_start)
                 logger.debug(f'Song {self.current.webpage_url} download timed out')
                 await self.send(f'Failed to download {self.current}')
                 self.current = None
@@ -263,10 +293,16 @@ class MusicPlayer:
             source = player.FFmpegPCMAudio(file, before_options=self.current.before_options,
                                                  options=self.current.options)
             source = PCMVolumeTransformer(source)
+            volume_task = None
             if self.current.volume is None and self.bot.config.auto_volume and isinstance(file, str) and not self.current.is_live:
-                volume_task = asyncio.ensure_future(self.set_mean_volume(file))
-            else:
-                volume_task = None
+                stats = self.loudness.get(self.current) if self.loudness is not None else None
+                if stats is not None:
+                    volume = self._get_volume_from_stats(stats)
+                    if volume is not None:
+                        # Same limit as the current_volume setter
+                        self.current.volume = min(2, volume)
+                else:
+                    volume_task = asyncio.ensure_future(self.set_mean_volume(file))
 
             source.volume = self.current.volume or self.volume
 
@@ -644,7 +680,11 @@ class Audio:
     def __init__(self, bot):
         self.bot = bot
         self.musicplayers = self.bot.playlists
-        self.downloader = Downloader()
+        self.downloader = Downloader(CACHE, cache_size=bot.config.audio_cache_size,
+                                     metadata_path=METADATA_CACHE)
+        self.downloader.cache.keep = self._queued_ids
+        self.loudness = LoudnessCache(bot)
+        self.autoplaylist_store = AutoplaylistStore()
 
     def get_musicplayer(self, guild_id):
         musicplayer = self.musicplayers.get(guild_id)
@@ -978,7 +1018,8 @@ class Audio:
         musicplayer = self.get_musicplayer(ctx.guild.id)
         if musicplayer is None:
             musicplayer = MusicPlayer(self.bot, self.disconnect_voice, channel=ctx.channel,
-                                      downloader=self.downloader)
+                                      downloader=self.downloader, loudness=self.loudness,
+                                      autoplaylist_store=self.autoplaylist_store)
             self.musicplayers[ctx.guild.id] = musicplayer
         else:
             musicplayer.change_channel(ctx.channel)
@@ -1337,6 +1378,9 @@ class Audio:
 
     async def shutdown(self):
         self.clear_cache()
+        await self.loudness.close()
+        if self.downloader.metadata is not None:
+            self.downloader.metadata.save()
 
     @staticmethod
     async def close_player(musicplayer):
@@ -1501,6 +1545,34 @@ class Audio:
 
         return await ctx.send('The length of the playlist is about {0}h {1}m {2}s'.format(hours, minutes, seconds))
 
+    @command(no_pm=True, ignore_extra=True, owner_only=True)
+    async def audio_stats(self, ctx):
+        """Shows how well songs are prefetched and cached"""
+        s = ''
+        musicplayer = self.get_musicplayer(ctx.guild.id)
+        if musicplayer is not None:
+            prefetch = musicplayer.playlist.prefetch_stats()
+            s += 'Prefetch: {prefetching} downloading, {ready_starts} songs started right away, ' \
+                 '{waited_starts} had to wait'.format(**prefetch)
+            s += f' ({musicplayer.playlist.wait_time})\n'
+
+        player_stats = player.get_player_stats(ctx.guild.id)
+        if player_stats.sent:
+            s += f'Playback: {player_stats}\n'
+
+        cache = self.downloader.cache.stats()
+        s += 'Audio cache: {files} files, {mb:.0f}MB, {hits} hits, {misses} misses, {evicted} evicted\n'.format(
+            mb=cache['bytes'] / 1024**2, **cache)
+
+        if self.downloader.metadata is not None:
+            s += 'Metadata: {items} urls, {hits} hits, {stale_streams} with expired stream, {misses} misses, ' \
+                 '{coalesced} coalesced\n'.format(**self.downloader.metadata.stats())
+
+        loudness = self.loudness.stats()
+        s += 'Loudness: {items} songs, {queued} queued, {hits} hits, {misses} misses, ' \
+             '{analysed} analysed, {failed} failed'.format(**loudness)
+        await ctx.send(f'```\n{s}\n```')
+
     @command(no_pm=True, ignore_extra=True, auth=Auth.BOT_MOD)
     async def ds(self, ctx):
         """Delete song from autoplaylist and skip it"""
@@ -1677,34 +1749,20 @@ class Audio:
 
         await ctx.send('Autoplaylist set %s' % option)
 
-    def clear_cache(self):
-        songs = []
+    def _queued_ids(self):
+        """Ids of the songs that are playing or queued in any musicplayer"""
+        ids = set()
         for musicplayer in self.musicplayers.values():
+            if musicplayer.current is not None:
+                ids.add(musicplayer.current.id)
             for song in musicplayer.playlist.playlist:
-                songs += [song.id]
-        cachedir = os.path.join(os.getcwd(), 'data', 'audio', 'cache')
-        try:
-            files = os.listdir(cachedir)
-        except (OSError, FileNotFoundError):
-            return
-
-        def check_list(string):
-            if song.id is not None and song.id in string:
-                return True
-            return False
+                ids.add(song.id)
 
-        dont_delete = []
-        for song in songs:
-            file = list(filter(check_list, files))
-            if file:
-                dont_delete += file
+        return ids
 
-        for file in files:
-            if file not in dont_delete:
-                try:
-                    os.remove(os.path.join(cachedir, file))
-                except os.error:
-                    pass
+    def clear_cache(self):
+        deleted = self.downloader.cache.clear()
+        terminal.info(f'Deleted {deleted} songs from the audio cache')
 
 
 def setup(bot):
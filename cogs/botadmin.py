@@ -1,6 +1,7 @@
 import asyncio
 import functools
 import inspect
+import json
 import logging
 import os
 import pprint
@@ -390,6 +391,8 @@ class BotAdmin(Cog):
             if audio:
                 await audio.shutdown()
 
+            await self.bot.command_stats.flush()
+
             try:
                 logger.info('Logging out')
                 await self.bot.logout()
@@ -398,12 +401,19 @@ class BotAdmin(Cog):
                 pass
 
 
+            render_pool = getattr(self.bot, 'render_pool', None)
+            if render_pool:
+                render_pool.close()
+
+            self.bot.watchdog.stop()
+
             try:
                 session = self.bot._Session
                 engine = self.bot._engine
 
                 session.close_all()
                 engine.dispose()
+                await self.bot.db_backend.close()
             except:
                 logger.exception('Failed to shut db down gracefully')
             logger.info('Closed db connection')
@@ -600,6 +610,20 @@ class BotAdmin(Cog):
 
         await ctx.send(f'Removed the botban of {name}`{user_id}`')
 
+    @command(owner_only=True)
+    async def auth_cache(self, ctx, clear: bool=False):
+        """
+        Show hit and miss stats of the authorization cache.
+        If clear is True the cache is emptied. Use it after editing bot staff manually
+        """
+        cache = self.bot.auth_cache
+        if clear:
+            cache.clear()
+
+        stats = cache.stats()
+        s = '\n'.join(f'{k}: {v}' for k, v in stats.items())
+        await ctx.send(f'```\n{s}\n```')
+
     @command(owner_only=True)
     async def leave_guild(self, ctx, guild_id: int):
         g = self.bot.get_guild(guild_id)
@@ -652,10 +676,121 @@ class BotAdmin(Cog):
             del engine
             return (time.perf_counter()-t)*1000
 
+        backend = self.bot.db_backend
         t = await self.bot.loop.run_in_executor(self.bot.threadpool, reconnect)
+        try:
+            await backend.close()
+        except:
+            logger.exception('Failed to close old database backend')
 
         await ctx.send(f'Reconnected to db in {t:.0f}ms')
 
+    @command(owner_only=True, ignore_extra=True)
+    async def db_stats(self, ctx):
+        """Show connection pool wait times and query latencies"""
+        backend = self.bot.db_backend
+        stats = backend.stats()
+        s = f'Backend {backend.name} with {backend.min_connections}-{backend.max_connections} connections\n'
+        s += f'Errors: {stats["errors"]}\n'
+        s += f'Pool wait: {backend.pool_wait}\n'
+        s += f'Query latency: {backend.query_latency}'
+        await ctx.send(f'```\n{s}\n```')
+
+    @command(owner_only=True, ignore_extra=True)
+    async def command_stats(self, ctx, *, name=None):
+        """
+        Show how long the phases of commands take.
+        Without a name shows all commands combined and the slowest commands.
+        Use `{prefix}{name} json` to get all of the stats as a json file
+        or `{prefix}{name} reset` to reset them
+        """
+        stats = self.bot.command_stats
+        if name == 'json':
+            data = json.dumps(stats.to_dict(), indent=2).encode('utf-8')
+            return await ctx.send(file=discord.File(BytesIO(data), filename='command_stats.json'))
+
+        if name == 'reset':
+            stats.reset()
+            return await ctx.send('Command stats reset')
+
+        def phases(histograms):
+            return ''.join(f'{phase}: {h}\n' for phase, h in histograms.items())
+
+        if name is not None:
+            histograms = stats.commands.get(name)
+            if histograms is None:
+                return await ctx.send(f'No stats for {name}')
+
+            s = f'{name}: {stats.invocations[name]} uses, {stats.errors[name]} errors\n'
+            s += phases(histograms)
+        else:
+            s = f'Prefix (all messages): {stats.prefix}\n'
+            s += phases(stats.all)
+            slowest = sorted(stats.commands.items(), key=lambda i: i[1]['total'].mean, reverse=True)
+            s += '\nSlowest by mean total:\n'
+            for cmd, histograms in slowest[:10]:
+                s += f'{cmd}: {histograms["total"]}\n'
+
+        for msg in split_string(s, splitter='\n', maxlen=1990):
+            await ctx.send(f'```\n{msg}\n```')
+
+    @command(owner_only=True, ignore_extra=True)
+    async def loop_stats(self, ctx, reset: bool=False):
+        """
+        Show the lag of the event loop and what has blocked it recently.
+        Stacks of the blocks are in the log
+        """
+        watchdog = self.bot.watchdog
+        if reset:
+            watchdog.reset()
+
+        if not watchdog.running:
+            return await ctx.send('Watchdog is not running')
+
+        s = f'Lag: {watchdog.lag}\n'
+        if watchdog.previous_lag is not None:
+            s += f'Previous {watchdog.window // 60}min: {watchdog.previous_lag}\n'
+
+        s += f'Blocked over {watchdog.threshold * 1000:.0f}ms {watchdog.blocked} times\n'
+        for source, count in watchdog.sources.most_common(10):
+            s += f'  {count}x {source}\n'
+
+        if watchdog.reports:
+            s += 'Latest:\n'
+            for report in reversed(list(watchdog.reports)[-5:]):
+                s += f'  {report}\n'
+
+        for msg in split_string(s, splitter='\n', maxlen=1990):
+            await ctx.send(f'```\n{msg}\n```')
+
+    @command(owner_only=True, ignore_extra=True)
+    async def render_stats(self, ctx, clear_cache: bool=False):
+        """Show queue and render times, render cache usage and image downloads of image commands"""
+        if clear_cache:
+            self.bot.render_cache.clear()
+            self.bot.image_fetcher.clear()
+
+        pool = self.bot.render_pool
+        kind = 'processes' if pool.processes else 'threads'
+        s = f'{pool.workers} {kind}, {pool.in_flight}/{pool.max_in_flight} rendering, '
+        s += f'{pool.queue_depth}/{pool.max_queue} queued\n'
+        s += f'Completed: {pool.completed} Rejected: {pool.rejected} Failed: {pool.failed}\n'
+        cache = self.bot.render_cache.stats()
+        s += 'Cache: {hits} hits, {disk_hits} disk hits, {misses} misses, {source_hits} skipped downloads\n' \
+             'Memory {memory_items} items {memory_bytes}/{max_bytes} bytes, ' \
+             'disk {disk_items} items {disk_bytes}/{disk_max_bytes} bytes\n'.format(**cache)
+        fetcher = self.bot.image_fetcher
+        fetch = fetcher.stats()
+        s += 'Downloads: {hits} hits, {misses} misses, {coalesced} coalesced, {failed} failed, ' \
+             '{in_flight} in flight\n' \
+             'Memory {items} items {bytes}/{max_bytes} bytes, {downloaded_bytes} bytes downloaded\n'.format(**fetch)
+        s += f'Download time: {fetcher.download_time}\n'
+        for name, h in sorted(pool.render_time.items()):
+            s += f'{name}\n  queue: {pool.queue_time[name]}\n  render: {h}\n'
+
+        for msg in split_string(s, splitter='\n', maxlen=1990):
+            await ctx.send(f'```\n{msg}\n```')
+
     def remove_call(self, _, msg_id):
         self.bot.call_laters.pop(msg_id, None)
 
@@ -3,13 +3,15 @@ import json
 import logging
 import os
 import shlex
+import time
+from collections import OrderedDict
 from io import BytesIO
 from math import ceil, sqrt
 
 import discord
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 from colormath.color_conversions import convert_color
-from colormath.color_diff import delta_e_cie2000
 from colormath.color_objects import LabColor, sRGBColor
 from colour import Color as Colour
 from discord.errors import InvalidArgument
@@ -20,6 +22,7 @@ from sqlalchemy.exc import SQLAlchemyError
 from bot.globals import WORKING_DIR
 from bot.bot import command, has_permissions, cooldown
 from cogs.cog import Cog
+from utils.colorindex import ColorIndex, ColorNameIndex, rgb_to_lab
 from utils.utilities import (split_string, get_role, y_n_check, y_check,
                              Snowflake, check_botperm)
 import re
@@ -57,12 +60,23 @@ class Colors(Cog):
     def __init__(self, bot):
         super().__init__(bot)
         self._colors = {}
+        self._color_indexes = {}
+        # Rendered color palettes and the raw pixels of their swatches.
+        # Swatches are kept for the palette_guilds guilds that used them last
+        self._palettes = {}
+        self._palette_tiles = OrderedDict()
+        self.palette_guilds = bot.config.palette_guilds
+        self._color_versions = {}
         self.bot.colors = self._colors
+        self.warmup_stats = None
         asyncio.run_coroutine_threadsafe(self._cache_colors(), self.bot.loop)
 
         with open(os.path.join(os.getcwd(), 'data', 'color_names.json'), 'r', encoding='utf-8') as f:
             self._color_names = json.load(f)
 
+        self._name_index = ColorNameIndex(self._color_names, self.named_rgb2lab)
+        terminal.info(f'Indexed {len(self._name_index)} color names in {self._name_index.build_time:.0f}ms')
+
     async def _cache_colors(self):
         sql = 'SELECT colors.id, colors.name, colors.value, roles.guild, colors.lab_l, colors.lab_a, colors.lab_b FROM ' \
               'colors LEFT OUTER JOIN roles on roles.id=colors.id'
@@ -73,11 +87,76 @@ class Colors(Cog):
             logger.exception('Failed to cache colors')
             return
 
+        t = time.perf_counter()
+        drifted = []
+        guilds = set()
         for row in rows:
-            if not self.bot.get_guild(row['guild']):
+            guild = self.bot.get_guild(row['guild'])
+            if not guild:
+                continue
+
+            role = guild.get_role(row['id'])
+            if role is None:
                 continue
 
-            await self._add_color(**row)
+            color = Color(row['id'], row['name'], row['value'], guild.id,
+                          (row['lab_l'], row['lab_a'], row['lab_b']))
+            self._colors.setdefault(guild.id, {})[color.role_id] = color
+            guilds.add(guild.id)
+            if role.color.value != color.value:
+                color.value = role.color.value
+                drifted.append(color)
+
+        if drifted:
+            # Lab values of all the changed role colors in one go
+            rgb = np.array([c.to_rgb() for c in drifted], dtype=np.float64) / 255
+            # Same as check_rgb with to_role=True
+            rgb[rgb.max(axis=1) == 0] = (0, 0, 1/255)
+            for color, lab in zip(drifted, rgb_to_lab(rgb)):
+                color.lab = LabColor(*lab)
+
+        for guild_id in guilds:
+            self._colors_changed(guild_id)
+
+        # The roles are already in the db since the rows were joined with them
+        updated = await self._update_colors2db(drifted)
+        elapsed = (time.perf_counter() - t) * 1000
+        self.warmup_stats = {'rows': len(rows),
+                             'cached': sum(len(self._colors.get(g, ())) for g in guilds),
+                             'guilds': len(guilds),
+                             'drifted': len(drifted),
+                             'updated': updated,
+                             'time': elapsed}
+        terminal.info(f'Cached {self.warmup_stats["cached"]} colors from {len(guilds)} guilds in {elapsed:.0f}ms. '
+                      f'{len(drifted)} colors had changed')
+
+    @staticmethod
+    def _color_params(color):
+        return {'id': color.role_id,
+                'name': color.name,
+                'value': color.value,
+                'lab_l': color.lab.lab_l,
+                'lab_a': color.lab.lab_a,
+                'lab_b': color.lab.lab_b}
+
+    async def _update_colors2db(self, colors):
+        """Upserts all of the given colors in one query. Returns the number of colors written"""
+        if not colors:
+            return 0
+
+        sql = 'INSERT INTO `colors` (`id`, `name`, `value`, `lab_l`, `lab_a`, `lab_b`) VALUES ' \
+              '(:id, :name, :value, :lab_l, :lab_a, :lab_b) ' \
+              'ON DUPLICATE KEY UPDATE name=VALUES(name), value=VALUES(value), ' \
+              'lab_l=VALUES(lab_l), lab_a=VALUES(lab_a), lab_b=VALUES(lab_b)'
+
+        try:
+            await self.bot.dbutil.execute(sql, params=[self._color_params(c) for c in colors],
+                                          commit=True)
+        except SQLAlchemyError:
+            logger.exception('Failed to update colors in db')
+            return 0
+
+        return len(colors)
 
     async def _add_color2db(self, color, update=False):
         await self.bot.dbutils.add_roles(color.guild_id, color.role_id)
@@ -87,12 +166,7 @@ class Colors(Cog):
             sql += ' ON DUPLICATE KEY UPDATE name=:name, value=:value, lab_l=:lab_l, lab_a=:lab_a, lab_b=:lab_b'
 
         try:
-            await self.bot.dbutil.execute(sql, params={'id': color.role_id,
-                                                       'name': color.name,
-                                                       'value': color.value,
-                                                       'lab_l': color.lab.lab_l,
-                                                       'lab_a': color.lab.lab_a,
-                                                       'lab_b': color.lab.lab_b},
+            await self.bot.dbutil.execute(sql, params=self._color_params(color),
                                           commit=True)
         except SQLAlchemyError:
             logger.exception('Failed to add color to db')
@@ -118,8 +192,13 @@ class Colors(Cog):
 
         return rgb
 
-    def rgb2lab(self, rgb, to_role=True):
-        rgb = self.check_rgb(rgb, to_role=to_role)
+    @staticmethod
+    def named_rgb2lab(rgb):
+        return convert_color(sRGBColor(*rgb, is_upscaled=True), LabColor)
+
+    @staticmethod
+    def rgb2lab(rgb, to_role=True):
+        rgb = Colors.check_rgb(rgb, to_role=to_role)
         return convert_color(sRGBColor(*rgb), LabColor)
 
     async def _update_color(self, color, role, to_role=True):
@@ -127,6 +206,7 @@ class Colors(Cog):
         lab = self.rgb2lab((r/255, g/255, b/255), to_role=to_role)
         color.value = role.color.value
         color.lab = lab
+        self._colors_changed(color.guild_id)
         await self._add_color2db(color, update=True)
         return color
 
@@ -148,6 +228,7 @@ class Colors(Cog):
             self._colors[guild_id][id] = color
         else:
             self._colors[guild_id] = {id: color}
+        self._colors_changed(guild_id)
 
         if role.color.value != value:
             await self._update_color(color, role)
@@ -157,12 +238,29 @@ class Colors(Cog):
     async def _delete_color(self, guild_id, role_id):
         try:
             color = self._colors[guild_id].pop(role_id)
+            self._colors_changed(guild_id)
             logger.debug(f'Deleting color {color.name} with value {color.value} from guild {guild_id}')
         except KeyError:
             logger.debug(f'Deleting color {role_id} from guild {guild_id} if it existed')
 
         await self.bot.dbutils.delete_role(role_id, guild_id)
 
+    def _colors_changed(self, guild_id):
+        """Must be called every time the colors of a guild are changed"""
+        self._color_indexes.pop(guild_id, None)
+        # Swatch tiles are kept so only the changed ones need to be redrawn
+        self._palettes.pop(guild_id, None)
+        self._color_versions[guild_id] = self._color_versions.get(guild_id, 0) + 1
+
+    def _get_index(self, guild_id):
+        index = self._color_indexes.get(guild_id)
+        colors = self._colors.get(guild_id, {})
+        if index is None or len(index) != len(colors):
+            index = ColorIndex(colors.values())
+            self._color_indexes[guild_id] = index
+
+        return index
+
     def get_color(self, name, guild_id):
         name = name.lower()
         return discord.utils.find(lambda n: str(n[1]).lower() == name,
@@ -170,18 +268,16 @@ class Colors(Cog):
 
     def search_color_(self, name):
         name = name.lower()
-        names = list(self._color_names.keys())
-        if name in names:
+        if name in self._color_names:
             return name, self._color_names[name]
 
-        else:
-            matches = [n for n in names if name in n]
-            if not matches:
-                return
-            if len(matches) == 1:
-                return matches[0], self._color_names[matches[0]]
+        matches = self._name_index.search(name)
+        if not matches:
+            return
+        if len(matches) == 1:
+            return matches[0], self._color_names[matches[0]]
 
-            return matches
+        return matches
 
     def match_color(self, color, convert2discord=True):
         color = color.lower()
@@ -213,15 +309,7 @@ class Colors(Cog):
         else:
             lab = color
 
-        closest_match = None
-        similarity = 0
-        for c in colors:
-            d = 100 - delta_e_cie2000(c.lab, lab)
-            if d > similarity:
-                similarity = d
-                closest_match = c
-
-        return closest_match, similarity
+        return ColorIndex(colors).closest(lab)
 
     def closest_match(self, color, guild):
         colors = self._colors.get(guild.id)
@@ -233,11 +321,16 @@ class Colors(Cog):
             return
 
         color = self.rgb2lab(rgb)
-        return self.closest_color_match(color, colors.values())
+        return self._get_index(guild.id).closest(color)
 
     async def on_guild_role_delete(self, role):
         await self._delete_color(role.guild.id, role.id)
 
+    async def on_guild_remove(self, guild):
+        self._color_indexes.pop(guild.id, None)
+        self._palettes.pop(guild.id, None)
+        self._palette_tiles.pop(guild.id, None)
+
     async def on_guild_role_update(self, before, after):
         if before.color.value != after.color.value:
             color = self._colors.get(before.guild.id, {}).get(before.id)
@@ -272,6 +365,7 @@ class Colors(Cog):
             if await self._add_color2db(color):
                 await ctx.send('Color {} created'.format(role))
                 colors[role.id] = color
+                self._colors_changed(guild.id)
             else:
                 await ctx.send('Failed to create color {0.name}'.format(role))
 
@@ -312,6 +406,19 @@ class Colors(Cog):
             rgb = (rgb[0], *rgb[2:])
             return tuple(map(int, rgb))
 
+    def _parse_rgb(self, s):
+        """Rgb tuple (0-255) from a hex or rgb value or None"""
+        s = s.strip().lower().replace('0x', '#')
+        if s.startswith('#'):
+            try:
+                return tuple(round(c*255) for c in Colour(s).rgb)
+            except (ValueError, AttributeError):
+                return
+
+        rgb = self.split_rgb(s.strip('()[]{}').replace(', ', ','))
+        if rgb and all(0 <= c < 256 for c in rgb):
+            return rgb
+
     @staticmethod
     def rgb2hex(*rgb):
         rgb = map(lambda c: hex(c)[2:].zfill(2), rgb)
@@ -525,18 +632,15 @@ class Colors(Cog):
         s = split_string(s, maxlen=2000, splitter=', ')
         return s
 
-    def sort_by_color(self, colors):
-        start = self.rgb2lab((0,0,0))
-        color, _ = self.closest_color_match(start, colors)
-        sorted_colors = [color]
-        colors.remove(color)
-
-        while colors:
-            closest, _ = self.closest_color_match(sorted_colors[-1], colors)
-            colors.remove(closest)
-            sorted_colors.append(closest)
-
-        return sorted_colors
+    @staticmethod
+    def sort_by_color(colors, index=None):
+        """
+        Sort colors starting from black and always taking the color closest to the previous one next.
+        If index is given the sorted order is cached in it
+        """
+        if index is None:
+            index = ColorIndex(colors)
+        return index.sorted(Colors.rgb2lab((0, 0, 0)))
 
     # https://stackoverflow.com/a/3943023/6046713
     @staticmethod
@@ -547,13 +651,14 @@ class Colors(Cog):
 
         return '#FFFFFF'
 
-    def draw_text(self, color: Color, size, font: ImageFont.FreeTypeFont):
+    @staticmethod
+    def draw_text(color: Color, size, font: ImageFont.FreeTypeFont):
         im = Image.new('RGB', size, color.rgb)
 
         draw = ImageDraw.Draw(im)
         name = str(color)
         text_size = font.getsize(name)
-        text_color = self.text_color(color)
+        text_color = Colors.text_color(color)
         if text_size[0] > size[0]:
             all_lines = []
             lines = split_string(name, maxlen=len(name)//(text_size[0]/size[0]))
@@ -597,47 +702,63 @@ class Colors(Cog):
 
             return
 
-        def do_the_thing():
-            nonlocal colors
-            size = (100, 100)
-            colors = list(colors.values())
-            colors = self.sort_by_color(colors)
-            side = ceil(sqrt(len(colors)))
-            font = ImageFont.truetype(os.path.join(WORKING_DIR, 'M-1c', 'mplus-1c-bold.ttf'),
-                                          encoding='utf-8', size=17)
-
-            images = []
-            for i in range(0, len(colors), side):
-                color_range = colors[i:i+side]
-                ims = []
-                for color in color_range:
-                    ims.append(self.draw_text(color, size, font))
-
-                if not ims:
-                    continue
-                images.append(self.concatenate_colors(ims, width=size[0]))
-
-            stack = self.stack_colors(images, size[1])
-
-            data = BytesIO()
-            stack.save(data, 'PNG')
-            data.seek(0)
-            return data
-
-        data = await self.bot.loop.run_in_executor(self.bot.threadpool, do_the_thing)
-        await ctx.send(file=discord.File(data, 'colors.png'))
+        data = self._palettes.get(guild.id)
+        if data is None:
+            async with ctx.typing():
+                data = await self._render_palette(ctx)
+
+        await ctx.send(file=discord.File(BytesIO(data), 'colors.png'))
+
+    async def _render_palette(self, ctx):
+        guild_id = ctx.guild.id
+        version = self._color_versions.get(guild_id, 0)
+        index = self._get_index(guild_id)
+        sorted_colors = await self.bot.loop.run_in_executor(self.bot.threadpool,
+                                                            self.sort_by_color, None, index)
+
+        # Only the swatches of colors the guild still has are sent to the worker
+        # and only the ones it had to draw are sent back
+        old_tiles = self._palette_tiles.get(guild_id) or {}
+        keys = [palette_key(color) for color in sorted_colors]
+        tiles = {key: old_tiles[key] for key in keys if key in old_tiles}
+        data, drawn = await self.bot.render_pool.submit(guild_id, ctx.command.qualified_name,
+                                                        render_colors, sorted_colors, tiles)
+        tiles.update(drawn)
+
+        # Don't cache the palette if the colors changed while it was rendering
+        if self._color_versions.get(guild_id, 0) == version:
+            self._palettes[guild_id] = data
+            self._palette_tiles[guild_id] = tiles
+            self._palette_tiles.move_to_end(guild_id)
+            while len(self._palette_tiles) > self.palette_guilds:
+                evicted, _ = self._palette_tiles.popitem(last=False)
+                self._palettes.pop(evicted, None)
+
+        return data
 
     @command(aliases=['search_colour'])
     @cooldown(1, 3, BucketType.user)
     async def search_color(self, ctx, *, name):
-        """Search a color using a name and return it's hex value if found"""
+        """Search a color using a name and return it's hex value if found.
+        Searching with a hex or rgb value gives the closest named color"""
         matches = self.search_color_(name)
         if matches is None:
+            rgb = self._parse_rgb(name)
+            if rgb is not None:
+                match, similarity = self._name_index.nearest(self.named_rgb2lab(rgb))
+                return await ctx.send('Closest named color to {0} is {1} {2[hex]} with {3:.02f}% similarity'.format(
+                                      name, match, self._color_names[match], similarity))
+
+            fuzzy = self._name_index.fuzzy(name, limit=5)
+            if fuzzy:
+                return await ctx.send('No colors found with {}. Did you mean\n{}'.format(
+                                      name, '\n'.join(n for n, _ in fuzzy)))
+
             return await ctx.send('No colors found with {}'.format(name))
 
         if isinstance(matches, list):
             total = len(matches)
-            matches = choice(matches, 10)
+            matches = matches[:10]
             return await ctx.send('Found matches a total of {0} matches\n{1}\n{2} of {0}'.format(total, '\n'.join(matches), len(matches)))
 
         name, match = matches
@@ -669,6 +790,7 @@ class Colors(Cog):
                 return await ctx.send('This color already exists')
             else:
                 self._colors.get(guild.id, {}).pop(k, None)
+                self._colors_changed(guild.id)
 
         color = lab
 
@@ -700,6 +822,7 @@ class Colors(Cog):
             self._colors[guild.id][color_role.id] = color_
         else:
             self._colors[guild.id] = {color_role.id: color_}
+        self._colors_changed(guild.id)
 
         await ctx.send('Added color {} {}'.format(name, str(d_color)))
 
@@ -820,6 +943,23 @@ class Colors(Cog):
         for embed in embeds:
             await ctx.send(embed=embed)
 
+    @command(owner_only=True)
+    async def color_name_stats(self, ctx, *, query='blue'):
+        """Show the size of the color name index and search times for query"""
+        index = self._name_index
+        t = time.perf_counter()
+        matches = index.search(query)
+        search_time = (time.perf_counter() - t) * 1000
+        t = time.perf_counter()
+        index.fuzzy(query)
+        fuzzy_time = (time.perf_counter() - t) * 1000
+
+        memory = index.memory()
+        s = f'{len(index)} names indexed in {index.build_time:.0f}ms\n'
+        s += 'Memory: {names} names, {name_ids} ids, {trigrams} trigrams, {lab} lab. {total} bytes total\n'.format(**memory)
+        s += f'Search {query}: {len(matches)} matches in {search_time:.3f}ms, fuzzy {fuzzy_time:.3f}ms'
+        await ctx.send(f'```\n{s}\n```')
+
     @command(owner_only=True)
     async def color_uncolored(self, ctx):
         """Color users that don't have a color role"""
@@ -862,5 +1002,51 @@ class Colors(Cog):
                        'Removed duplicate colors from %s user(s)' % (colored, duplicate_colors))
 
 
+_font = None
+
+
+def _palette_font():
+    # Loaded once per worker process
+    global _font
+    if _font is None:
+        _font = ImageFont.truetype(os.path.join(WORKING_DIR, 'M-1c', 'mplus-1c-bold.ttf'),
+                                   encoding='utf-8', size=17)
+    return _font
+
+
+def palette_key(color):
+    """Key of the swatch of a color in the palette tiles"""
+    return str(color), color.value
+
+
+def render_colors(colors, tiles=None):
+    """
+    Draws the color palette of a guild from sorted colors. Run in the render pool.
+    tiles has the raw pixels of previously drawn swatches by palette_key.
+    Only swatches that aren't in it are drawn.
+    Returns the png data and the tiles that were drawn
+    """
+    size = (100, 100)
+    tiles = tiles or {}
+    side = ceil(sqrt(len(colors)))
+    rows = ceil(len(colors) / side)
+
+    palette = Image.new('RGBA', (side*size[0], rows*size[1]), (0, 0, 0, 0))
+    new_tiles = {}
+    for idx, color in enumerate(colors):
+        key = palette_key(color)
+        tile = tiles.get(key)
+        if tile is None:
+            tile = Colors.draw_text(color, size, _palette_font()).tobytes()
+            new_tiles[key] = tile
+
+        y, x = divmod(idx, side)
+        palette.paste(Image.frombytes('RGB', size, tile), (x*size[0], y*size[1]))
+
+    data = BytesIO()
+    palette.save(data, 'PNG')
+    return data.getvalue(), new_tiles
+
+
 def setup(bot):
     bot.add_cog(Colors(bot))
@@ -1,5 +1,7 @@
 import logging
+import random
 from functools import partial
+from types import SimpleNamespace
 
 import discord
 from discord.ext.commands import BucketType, has_permissions
@@ -225,12 +227,15 @@ class CommandBlacklist(Cog):
                  False when operation failed
         """
         type_string = 'blacklist' if type_ == BlacklistTypes.BLACKLIST else 'whitelist'
-        sql = 'SELECT `id`, `type` FROM `command_blacklist` WHERE %s' % whereclause
+        guild = values.get('guild')
+        auth_cache = self.bot.auth_cache
+        sql = 'SELECT * FROM `command_blacklist` WHERE %s' % whereclause
         try:
             row = (await self.bot.dbutil.execute(sql, values)).first()
         except SQLAlchemyError:
             logger.exception('Failed to remove blacklist')
             await ctx.send('Failed to remove %s' % type_string)
+            return False
 
         if row:
             if row['type'] == type_:
@@ -240,8 +245,10 @@ class CommandBlacklist(Cog):
                 except SQLAlchemyError:
                     logger.exception('Could not update %s with whereclause %s' % (type_string, whereclause))
                     await ctx.send('Failed to remove %s' % type_string)
+                    auth_cache.invalidate_blacklist(guild)
                     return False
                 else:
+                    auth_cache.remove_blacklist_row(guild, row['id'])
                     return
             else:
                 sql = 'UPDATE `command_blacklist` SET type=:type WHERE id=:id'
@@ -250,8 +257,10 @@ class CommandBlacklist(Cog):
                 except SQLAlchemyError:
                     logger.exception('Could not update %s with whereclause %s' % (type_string, whereclause))
                     await ctx.send('Failed to remove %s' % type_string)
+                    auth_cache.invalidate_blacklist(guild)
                     return False
                 else:
+                    auth_cache.set_blacklist_row(guild, {**row, 'type': type_})
                     return True
         else:
             sql = 'INSERT INTO `command_blacklist` ('
@@ -268,12 +277,17 @@ class CommandBlacklist(Cog):
 
             sql += ') VALUES ' + val + ')'
             try:
-                await self.bot.dbutil.execute(sql, values, commit=True)
+                row_id = (await self.bot.dbutil.execute(sql, values, commit=True)).lastrowid
             except SQLAlchemyError:
                 logger.exception('Could not set values %s' % values)
                 await ctx.send('Failed to set %s' % type_string)
+                auth_cache.invalidate_blacklist(guild)
                 return False
 
+            row = {'id': row_id, 'command': None, 'user': None, 'role': None, 'channel': None}
+            row.update(values)
+            auth_cache.set_blacklist_row(guild, row)
+
         return True
 
     async def _add_user_blacklist(self, ctx, command_name, user, guild):
@@ -354,6 +368,37 @@ class CommandBlacklist(Cog):
         value = await self.bot.dbutil.check_blacklist(f'(command="{command_}" OR command IS NULL)', user, ctx, True)
         await ctx.send(value or 'No special perms')
 
+    @command(owner_only=True, no_pm=True)
+    async def verify_perms(self, ctx, samples: int=200):
+        """
+        Compares the in memory permission resolver against the sql check_blacklist
+        using random members, channels and commands of this guild
+        """
+        guild = ctx.guild
+        self.bot.auth_cache.invalidate_blacklist(guild.id)
+        rows = await self.bot.dbutil.execute('SELECT DISTINCT `command` FROM `command_blacklist` WHERE guild=%s' % guild.id)
+        names = [r['command'] for r in rows if r['command'] is not None]
+        names.extend(random.sample(list(self.bot.all_commands.keys()), min(10, len(self.bot.all_commands))))
+        members = list(guild.members)
+        channels = list(guild.text_channels)
+        if not names or not members or not channels:
+            return await ctx.send('Nothing to compare')
+
+        mismatches = []
+        for _ in range(samples):
+            name = random.choice(names)
+            member = random.choice(members)
+            fake_ctx = SimpleNamespace(guild=guild, channel=random.choice(channels))
+            expected = await self.bot.dbutil.check_blacklist(f'(command="{name}" OR command IS NULL)', member, fake_ctx, True)
+            value = await self.bot.auth_cache.check_blacklist(name, member, fake_ctx, True)
+            if value != expected:
+                mismatches.append(f'{name} {member.id} {fake_ctx.channel.id}: sql {expected} resolver {value}')
+
+        if not mismatches:
+            return await ctx.send(f'All {samples} samples matched')
+
+        await ctx.send(f'{len(mismatches)}/{samples} samples differed\n' + '\n'.join(mismatches[:10]))
+
     def get_rows(self, whereclause, select='*'):
         session = self.bot.get_session
         sql = 'SELECT %s FROM `command_blacklist` WHERE %s' % (select, whereclause)
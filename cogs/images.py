@@ -1,14 +1,14 @@
 import base64
+import json
 import logging
 import os
+import threading
 import time
 from asyncio import Lock
-from functools import partial
 from io import BytesIO
 from random import randint
 
-from PIL import Image, ImageSequence, ImageFont, ImageDraw, ImageChops, \
-    GifImagePlugin
+from PIL import Image, ImageFont, ImageDraw, ImageChops
 from bs4 import BeautifulSoup
 from discord import File
 from discord.ext.commands import BucketType, BotMissingPermissions
@@ -19,20 +19,408 @@ from selenium.webdriver import Chrome
 from selenium.webdriver.chrome.options import Options
 
 from bot.bot import command, cooldown
+from bot.browserpool import BrowserPool
 from bot.exceptions import NoPokeFoundException, BotException
 from cogs.cog import Cog
-from utils.imagetools import (resize_keep_aspect_ratio, image_from_url,
-                              gradient_flash, sepia, optimize_gif, func_to_gif,
-                              get_duration, convert_frames, apply_transparency)
+from utils.imagetools import (resize_keep_aspect_ratio, gradient_flash, sepia,
+                              optimize_gif, func_to_gif, encode_gif,
+                              get_duration, convert_frames,
+                              apply_transparency, tint_frames)
+from utils.templates import templates
 from utils.utilities import get_image_from_message, find_coeffs, check_botperm
 
 logger = logging.getLogger('debug')
 terminal = logging.getLogger('terminal')
-TEMPLATES = os.path.join('data', 'templates')
+
+BLURPLE = (0x72, 0x89, 0xDA)
+
+
+def render_version(func):
+    """
+    Version of a render function used in its render cache keys. Set
+    func.render_version to a higher number when the output of func changes
+    """
+    return getattr(func, 'render_version', 0)
+
+
+# Render functions are run in the render pool worker processes.
+# They take the raw image data and return the rendered image as bytes
+
+
+def _open(data):
+    return Image.open(BytesIO(data))
+
+
+def _to_bytes(img, format='PNG'):
+    data = BytesIO()
+    img.save(data, format)
+    return data.getvalue()
+
+
+def render_anime_deaths(data, template):
+    x, y = 9, 10
+    w, h = 854, 480
+    template = templates.get(template)
+    img = resize_keep_aspect_ratio(_open(data), (w, h), can_be_bigger=False, resample=Image.BILINEAR)
+    new_w, new_h = img.width, img.height
+    if new_w != w:
+        x += int((w - new_w)/2)
+
+    if new_h != h:
+        y += int((h - new_h) / 2)
+
+    img = img.convert("RGBA")
+    template.paste(img, (x, y), img)
+    return _to_bytes(template)
+
+
+def render_trap(data):
+    img = _open(data).convert("RGBA")
+    x, y = 820, 396
+    w, h = 355, 505
+    rotation = -22.5
+
+    img = resize_keep_aspect_ratio(img, (w, h), can_be_bigger=False,
+                                   resample=Image.BILINEAR)
+    img = img.rotate(rotation, expand=True, resample=Image.BILINEAR)
+    x_place = x - int(img.width / 2)
+    y_place = y - int(img.height / 2)
+
+    template = templates.get('is_it_a_trap.png')
+
+    template.paste(img, (x_place, y_place), img)
+    layer = 'is_it_a_trap_layer.png'
+    template.paste(templates.shared(layer), (0, 0), templates.mask(layer))
+    return _to_bytes(template)
+
+
+def render_jotaro(data):
+    img = _open(data)
+    # The size we want from the transformation
+    width = 524
+    height = 326
+    d_x = 90
+    w, h = img.size
+
+    coeffs = find_coeffs(
+        [(d_x, 0), (width - d_x, 0), (width, height), (0, height)],
+        [(0, 0), (w, 0), (w, h), (0, h)])
+
+    img = img.transform((width, height), Image.PERSPECTIVE, coeffs,
+                        Image.BICUBIC)
+
+    template = templates.shared('jotaro.png')
+
+    white = Image.new('RGBA', template.size, 'white')
+
+    x, y = 9, 351
+    white.paste(img, (x, y))
+    white.paste(template, mask=templates.mask('jotaro.png'))
+
+    return _to_bytes(white)
+
+
+def render_jotaro_photo(data, use_webp=False):
+    extension = 'webp' if use_webp else 'gif'
+    r = 34.7
+    x = 6
+    y = -165
+    width = 468
+    height = 439
+    duration = [120, 120, 120, 120, 120, 120, 120, 120, 120, 120, 120, 120,
+                80, 120, 120, 120, 120, 120, 30, 120, 120, 120, 120, 120,
+                120, 120, 760, 2000]  # Frame timing
+
+    frames = templates.frames('jotaro_photo.gif')
+    im = templates.get('photo.png')
+    img = _open(data).convert('RGBA')
+    img = resize_keep_aspect_ratio(img, (width, height), resample=Image.BICUBIC,
+                                   can_be_bigger=False, crop_to_size=True,
+                                   center_cropped=True, background_color='black')
+    w, h = img.size
+    width, height = (472, 441)
+    coeffs = find_coeffs(
+        [(0, 0), (437, 0), (width, height), (0, height)],
+        [(0, 0), (w, 0), (w, h), (0, h)])
+    img = img.transform((width, height), Image.PERSPECTIVE, coeffs,
+                        Image.BICUBIC)
+    img = img.rotate(r, resample=Image.BICUBIC, expand=True)
+    im.paste(img, box=(x, y), mask=img)
+    im.paste(templates.shared('finger.png'), mask=templates.mask('finger.png'))
+    frames[-1] = im
+
+    if not use_webp:
+        # The template only plays once so no loop
+        data = encode_gif(frames, duration, loop=None).getvalue()
+        if len(data) > 8000000:
+            raise BotException('Generated image was too big in filesize')
+
+        return data
+
+    # We save room for some colors when not using the shadow in a gif
+    im.alpha_composite(templates.shared('shadow.png'))
+    file = BytesIO()
+    frames[0].save(file, format=extension, save_all=True, append_images=frames[1:], duration=duration)
+    if file.tell() > 8000000:
+        raise BotException('Generated image was too big in filesize')
+
+    return optimize_gif(file.getvalue()).getvalue()
+
+
+def render_jotaro_smile(data):
+    im = templates.shared('jotaro_smile.png')
+    img = _open(data).convert('RGBA')
+    i = Image.new('RGBA', im.size, 'black')
+    size = (max(img.size), max(img.size))
+    img = resize_keep_aspect_ratio(img, size, can_be_bigger=False,
+                                   crop_to_size=True, center_cropped=True)
+    coeffs = find_coeffs([(0, 68), (358, 0), (410, 335), (80, 435)],
+                         [(0, 0), (img.width, 0), size, (0, img.height)])
+    img = img.transform((410, 435), Image.PERSPECTIVE, coeffs,
+                        Image.BICUBIC)
+    x, y = (178, 479)
+    i.paste(img, (x, y), mask=img)
+    i.paste(im, mask=templates.mask('jotaro_smile.png'))
+
+    return _to_bytes(i)
+
+
+def render_tobecontinued(data, no_sepia=False):
+    img = _open(data)
+    if not no_sepia:
+        img = sepia(img)
+
+    width, height = img.width, img.height
+    if width < 300:
+        width = 300
+
+    if height < 200:
+        height = 200
+
+    img = resize_keep_aspect_ratio(img, (width, height), resample=Image.BILINEAR)
+    width, height = img.width, img.height
+    tbc = templates.shared('tbc.png')
+    x = int(width * 0.09)
+    y = int(height * 0.90)
+    tbc = resize_keep_aspect_ratio(tbc, (width * 0.5, height * 0.3),
+                                   can_be_bigger=False, resample=Image.BILINEAR)
+
+    if y + tbc.height > height:
+        y = height - tbc.height - 10
+
+    img.paste(tbc, (x, y), tbc)
+
+    return _to_bytes(img)
+
+
+def render_overheaven(data):
+    overlay = templates.shared('heaven.png')
+    base = templates.get('heaven_base.png')
+    size = (750, 750)
+    img = resize_keep_aspect_ratio(_open(data), size, can_be_bigger=False,
+                                   crop_to_size=True, center_cropped=True)
+
+    img = img.convert('RGBA')
+    x, y = (200, 160)
+    base.paste(img, (x, y), mask=img)
+    base.alpha_composite(overlay)
+    return _to_bytes(base)
+
+
+def render_pucci(data):
+    img = _open(data).convert('RGBA')
+    im = templates.get('pucci_bg.png')
+    overlay = templates.shared('pucci_faded.png')
+    size = (682, 399)
+    img = resize_keep_aspect_ratio(img, size, can_be_bigger=False,
+                                   crop_to_size=True, center_cropped=True)
+    x, y = (0, 367)
+    im.paste(img, (x, y), mask=img)
+    im.alpha_composite(overlay)
+    return _to_bytes(im)
+
+
+def render_party(data, transparency=None):
+    return gradient_flash(_open(data), get_raw=True, transparency=transparency).getvalue()
+
+
+def render_blurple(data):
+    img = _open(data)
+    # Format must be checked before converting since convert drops it
+    if img.format == 'GIF':
+        def multiply(stack):
+            return tint_frames(stack, BLURPLE)
+
+        return func_to_gif(img, multiply, get_raw=True, batched=True).getvalue()
+
+    im = Image.new('RGBA', img.size, color=BLURPLE)
+    img = ImageChops.multiply(img.convert('RGBA'), im)
+    return _to_bytes(img)
+
+
+def render_gif_speed(data, speed):
+    frames = convert_frames(_open(data), 'RGBA')
+    durations = get_duration(frames)
+
+    def transform(duration):
+        # Frame delay is stored as an unsigned 2 byte int
+        # A delay of 0 would mean that the frame would change as fast
+        # as the pc can do it which is useless. Also rendering engines
+        # like to round delays higher up to 10 and most don't display the
+        # smallest delays
+        duration = min(max(duration//speed, 5), 65535)
+        return duration
+
+    durations = list(map(transform, durations))
+    frames[0].info['duration'] = durations
+    for f, d in zip(frames, durations):
+        f.info['duration'] = d
+
+    frames = apply_transparency(frames)
+    file = BytesIO()
+    frames[0].save(file, format='GIF', duration=durations, save_all=True,
+                   append_images=frames[1:], loop=65535, optimize=False, disposal=2)
+    data = file.getvalue()
+    if len(data) > 8000000:
+        return optimize_gif(data).getvalue()
+
+    return data
+
+
+def render_template_paste(data, template, size, pos, background_color=None):
+    """Used by commands that paste the image under a template at the given position"""
+    template = templates.get(template)
+    img = _open(data).convert('RGBA')
+    img = resize_keep_aspect_ratio(img, size, can_be_bigger=False,
+                                   resample=Image.BICUBIC, crop_to_size=True,
+                                   center_cropped=True, background_color=background_color)
+
+    template.paste(img, pos, img)
+    return _to_bytes(template)
+
+
+def render_template_overlay(data, template, size, pos, bg_color=(0, 0, 0, 0)):
+    """Used by commands that draw the template on top of the image"""
+    template = templates.shared(template)
+    img = _open(data).convert('RGBA')
+    img = resize_keep_aspect_ratio(img, size, can_be_bigger=False,
+                                   resample=Image.BICUBIC, crop_to_size=True,
+                                   center_cropped=True)
+
+    bg = Image.new('RGBA', template.size, bg_color)
+
+    bg.paste(img, pos, img)
+    bg.alpha_composite(template)
+    return _to_bytes(bg)
+
+
+class FusionCache:
+    """
+    Fused sprites from pokefusion keyed by the dex numbers and the color.
+    Sprites are saved as png files in folder and their names and the
+    type sprites they use in an index file next to them. New sprites are
+    appended to the index as json lines so adding one doesn't rewrite the
+    whole index. Methods do file io so they should be run in a thread
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        self.index_path = os.path.join(folder, 'index.jsonl')
+        # key: [name, [type sprite files]]
+        self._index = {}
+        self._lines = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    @staticmethod
+    def key(poke1, poke2, color):
+        return f'{poke1}_{poke2}_{color}'
+
+    def _load(self):
+        broken = False
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    self._lines += 1
+                    try:
+                        key, name, types = json.loads(line)
+                    except ValueError:
+                        # Line cut short by a crash while it was written
+                        broken = True
+                        continue
+                    self._index[key] = [name, types]
+        except FileNotFoundError:
+            return
+        except OSError:
+            terminal.exception('Failed to load pokefusion sprite cache')
+            return
+
+        # Sprites that were added again take more than one line
+        if broken or self._lines > len(self._index) * 2:
+            self._compact()
+
+    def _compact(self):
+        tmp = self.index_path + '.tmp'
+        try:
+            with open(tmp, 'w', encoding='utf-8') as f:
+                for key, (name, types) in self._index.items():
+                    f.write(json.dumps([key, name, types]) + '\n')
+            os.replace(tmp, self.index_path)
+            self._lines = len(self._index)
+        except OSError:
+            terminal.exception('Failed to compact pokefusion sprite cache')
+
+    def get(self, key):
+        """(sprite, name, types) or None if key isn't cached"""
+        entry = self._index.get(key)
+        if entry is None:
+            self.misses += 1
+            return
+
+        try:
+            with open(os.path.join(self.folder, key + '.png'), 'rb') as f:
+                sprite = f.read()
+        except OSError:
+            self.misses += 1
+            with self._lock:
+                self._index.pop(key, None)
+            return
+
+        self.hits += 1
+        return sprite, entry[0], entry[1]
+
+    def add(self, key, sprite, name, types):
+        with self._lock:
+            try:
+                os.makedirs(self.folder, exist_ok=True)
+                with open(os.path.join(self.folder, key + '.png'), 'wb') as f:
+                    f.write(sprite)
+
+                # Index line is written after the sprite so it never points to a missing file
+                with open(self.index_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps([key, name, types]) + '\n')
+                self._index[key] = [name, types]
+                self._lines += 1
+            except OSError:
+                logger.exception('Failed to save fused sprite')
+
+    def stats(self):
+        return {'sprites': len(self._index),
+                'hits': self.hits,
+                'misses': self.misses}
 
 
 class Pokefusion:
     RANDOM = '%'
+    # Increase when _draw_fusion changes so old fusions aren't served from the render cache
+    RENDER_VERSION = 1
 
     def __init__(self, client, bot):
         self._last_dex_number = 0
@@ -41,10 +429,22 @@ class Pokefusion:
         self._last_updated = 0
         self._client = client
         self._data_folder = os.path.join(os.getcwd(), 'data', 'pokefusion')
-        self._driver_lock = Lock(loop=bot.loop)
         self._bot = bot
         self._update_lock = Lock(loop=bot.loop)
 
+        # Type sprites and the background by file name and the name font
+        self._assets = {}
+        self._font = None
+        self.load_assets()
+        self._sprites = FusionCache(os.path.join(self._data_folder, 'fusions'))
+
+        config = self.bot.config
+        self._browsers = BrowserPool(bot, self._create_driver, size=config.pokefusion_browsers,
+                                     max_uses=config.pokefusion_browser_uses)
+        # Start one browser right away so a missing chromedriver is noticed on load
+        self._browsers.prefill(1)
+
+    def _create_driver(self):
         p = self.bot.config.chromedriver
         options = Options()
         options.add_argument('--headless')
@@ -53,7 +453,7 @@ class Pokefusion:
         if binary:
             options.binary_location = binary
 
-        self.driver = Chrome(p, chrome_options=options)
+        return Chrome(p, chrome_options=options)
 
     @property
     def bot(self):
@@ -67,6 +467,31 @@ class Pokefusion:
     def client(self):
         return self._client
 
+    @property
+    def browsers(self):
+        return self._browsers
+
+    def close(self):
+        self._browsers.close()
+
+    def load_assets(self):
+        """Decodes the type sprites, background and font so fusions don't read them from disk"""
+        assets = {}
+        for name in os.listdir(self._data_folder):
+            if name == 'poke_bg.png' or name.startswith('sprPKMType_'):
+                try:
+                    im = Image.open(os.path.join(self._data_folder, name))
+                    im.load()
+                except OSError:
+                    logger.exception(f'Failed to load {name}')
+                    continue
+
+                assets[name] = im
+
+        self._assets = assets
+        if self._font is None:
+            self._font = ImageFont.truetype(os.path.join('M-1c', 'mplus-1c-bold.ttf'), 36)
+
     def is_dex_number(self, s):
         # No need to convert when the number is that big
         if len(s) > 5:
@@ -117,6 +542,7 @@ class Pokefusion:
             self._last_dex_number = len(pokemon) - 1
             types = filter(lambda f: f.startswith('sprPKMType_'), os.listdir(self._data_folder))
             await self.cache_types(start=max(len(list(types)), 1))
+            await self.bot.loop.run_in_executor(self.bot.threadpool, self.load_assets)
             self._last_updated = time.time()
             success = True
         except:
@@ -144,24 +570,67 @@ class Pokefusion:
         else:
             return self.get_by_name(name)
 
-    async def get_url(self, url):
-        # Attempt at making phantomjs async friendly
-        # After visiting the url remember to put 1 item in self.queue
-        # Otherwise the browser will be locked
+    @staticmethod
+    def _fetch_fusion(driver, url):
+        """Runs in the browser pool. Returns the fused sprite, its type sprite files and its name"""
+        try:
+            driver.get(url)
+        except UnexpectedAlertPresentException:
+            driver.switch_to.alert.accept()
+            raise BotException('Invalid pokemon given')
 
-        # If lock is not locked lock it until this operation finishes
-        unlock = False
-        if not self._driver_lock.locked():
-            await self._driver_lock.acquire()
-            unlock = True
+        data = driver.execute_script("return document.getElementById('image1').src")
+        types = driver.execute_script("return document.querySelectorAll('*[width=\"30\"]')")
+        name = driver.execute_script("return document.getElementsByTagName('b')[0].textContent")
 
-        f = partial(self.driver.get, url)
-        await self.bot.loop.run_in_executor(self.bot.threadpool, f)
-        if unlock:
+        types = [tp.get_attribute('src').split('/')[-1].split('?')[0] for tp in types]
+        data = data.replace('data:image/png;base64,', '', 1)
+        return base64.b64decode(data), types, name
+
+    def _get_asset(self, name):
+        im = self._assets.get(name)
+        if im is None:
+            # Type added after the assets were loaded
             try:
-                self._driver_lock.release()
-            except RuntimeError:
-                pass
+                im = Image.open(os.path.join(self._data_folder, name))
+                im.load()
+            except (FileNotFoundError, OSError):
+                raise BotException('Error while getting type images')
+
+            self._assets[name] = im
+
+        return im
+
+    def _draw_fusion(self, sprite, name, types):
+        img = Image.open(BytesIO(sprite))
+        type_imgs = [self._get_asset(tp) for tp in types]
+        bg = self._get_asset('poke_bg.png').copy()
+
+        # Paste pokemon in the middle of the background
+        x, y = (bg.width//2-img.width//2, bg.height//2-img.height//2)
+        bg.paste(img, (x, y), img)
+
+        if type_imgs:
+            w, h = type_imgs[0].size
+            padding = 2
+            # Total width of all type images combined with padding
+            type_w = len(type_imgs) * (w + padding)
+            width = bg.width
+            start_x = (width - type_w)//2
+            y = y + img.height
+
+            for tp in type_imgs:
+                bg.paste(tp, (start_x, y), tp)
+                start_x += w + padding
+
+        font = self._font
+        draw = ImageDraw.Draw(bg)
+        w, h = draw.textsize(name, font)
+        draw.text(((bg.width-w)//2, bg.height//2-img.height//2 - h), name, font=font, fill='black')
+
+        file = BytesIO()
+        bg.save(file, 'PNG')
+        return file.getvalue()
 
     async def fuse(self, poke1=RANDOM, poke2=RANDOM, poke3=None):
         # Update cache once per day
@@ -183,63 +652,43 @@ class Pokefusion:
             if color is None:
                 raise NoPokeFoundException(poke3)
 
-        url = 'http://pokefusion.japeal.com/PKMColourV5.php?ver=3.2&p1={}&p2={}&c={}&e=noone'.format(*dex_n, color)
-        async with self._driver_lock:
-            try:
-                await self.get_url(url)
-            except UnexpectedAlertPresentException:
-                self.driver.switch_to.alert.accept()
-                raise BotException('Invalid pokemon given')
-
-            data = self.driver.execute_script("return document.getElementById('image1').src")
-            types = self.driver.execute_script("return document.querySelectorAll('*[width=\"30\"]')")
-            name = self.driver.execute_script("return document.getElementsByTagName('b')[0].textContent")
-
-        data = data.replace('data:image/png;base64,', '', 1)
-        img = Image.open(BytesIO(base64.b64decode(data)))
-        type_imgs = []
-
-        for tp in types:
-            file = tp.get_attribute('src').split('/')[-1].split('?')[0]
-            try:
-                im = Image.open(os.path.join(self._data_folder, file))
-                type_imgs.append(im)
-            except (FileNotFoundError, OSError):
-                raise BotException('Error while getting type images')
-
-        bg = Image.open(os.path.join(self._data_folder, 'poke_bg.png'))
+        s = 'Fusion of {} and {}'.format(self._poke_reverse[dex_n[0]], self._poke_reverse[dex_n[1]])
+        if color:
+            s += ' using the color palette of {}'.format(self._poke_reverse[color])
 
-        # Paste pokemon in the middle of the background
-        x, y = (bg.width//2-img.width//2, bg.height//2-img.height//2)
-        bg.paste(img, (x, y), img)
+        cache = self.bot.render_cache
+        key = cache.make_key('pokefusion', (*dex_n, color), version=self.RENDER_VERSION)
+        data = await cache.get(key)
+        if data is not None:
+            return data, s
 
-        w, h = type_imgs[0].size
-        padding = 2
-        # Total width of all type images combined with padding
-        type_w = len(type_imgs) * (w + padding)
-        width = bg.width
-        start_x = (width - type_w)//2
-        y = y + img.height
+        loop = self.bot.loop
+        sprite_key = FusionCache.key(*dex_n, color)
+        fusion = None
+        if sprite_key in self._sprites:
+            fusion = await loop.run_in_executor(self.bot.threadpool, self._sprites.get, sprite_key)
 
-        for tp in type_imgs:
-            bg.paste(tp, (start_x, y), tp)
-            start_x += w + padding
+        if fusion is None:
+            url = 'http://pokefusion.japeal.com/PKMColourV5.php?ver=3.2&p1={}&p2={}&c={}&e=noone'.format(*dex_n, color)
+            fusion = await self._browsers.run(self._fetch_fusion, url)
+            await loop.run_in_executor(self.bot.threadpool, self._sprites.add, sprite_key, *fusion)
 
-        font = ImageFont.truetype(os.path.join('M-1c', 'mplus-1c-bold.ttf'), 36)
-        draw = ImageDraw.Draw(bg)
-        w, h = draw.textsize(name, font)
-        draw.text(((bg.width-w)//2, bg.height//2-img.height//2 - h), name, font=font, fill='black')
+        data = await loop.run_in_executor(self.bot.threadpool, self._draw_fusion, *fusion)
+        await cache.put(key, data)
+        return data, s
 
-        s = 'Fusion of {} and {}'.format(self._poke_reverse[dex_n[0]], self._poke_reverse[dex_n[1]])
-        if color:
-            s += ' using the color palette of {}'.format(self._poke_reverse[color])
-        return bg, s
+    def stats(self):
+        return {'browsers': self._browsers.stats(),
+                'sprites': self._sprites.stats(),
+                'assets': len(self._assets)}
 
 
 class Images(Cog):
     def __init__(self, bot):
         super().__init__(bot)
         self.threadpool = bot.threadpool
+        # Usually already done by the bot before the render workers were started
+        templates.preload(bot.config.template_memory*1024*1024)
         try:
             self._pokefusion = Pokefusion(self.bot.aiohttp_client, bot)
         except WebDriverException:
@@ -248,7 +697,7 @@ class Images(Cog):
 
     def __unload(self):
         if self._pokefusion:
-            self._pokefusion.driver.quit()
+            self._pokefusion.close()
 
     @staticmethod
     def __local_check(ctx):
@@ -257,8 +706,48 @@ class Images(Cog):
 
         return True
 
-    async def image_func(self, func, *args, **kwargs):
-        return await self.bot.loop.run_in_executor(self.bot.threadpool, func, *args, **kwargs)
+    async def image_func(self, ctx, func, *args, **kwargs):
+        guild_id = ctx.guild.id if ctx.guild else None
+        return await self.bot.render_pool.submit(guild_id, ctx.command.qualified_name,
+                                                 func, *args, **kwargs)
+
+    async def _render(self, ctx, func, url, *args, **kwargs):
+        """
+        Render the image from url with func or get the result from the render cache.
+        Returns None if the image couldn't be downloaded. Results rendered
+        with an older render_version of func aren't used
+        """
+        cache = self.bot.render_cache
+        params = (args, sorted(kwargs.items()))
+        name = ctx.command.qualified_name
+        version = render_version(func)
+
+        digest = cache.source_digest(url)
+        if digest is not None:
+            data = await cache.get(cache.make_key(name, params, digest, version))
+            if data is not None:
+                return data
+
+        img = await self._dl_image(ctx, url)
+        if img is None:
+            return
+
+        # Same image might be cached from another url
+        key = cache.make_key(name, params, cache.remember_source(url, img), version)
+        data = await cache.get(key)
+        if data is None:
+            data = await self.image_func(ctx, func, img, *args, **kwargs)
+            await cache.put(key, data)
+
+        return data
+
+    async def _send_render(self, ctx, filename, func, url, *args, **kwargs):
+        async with ctx.typing():
+            data = await self._render(ctx, func, url, *args, **kwargs)
+        if data is None:
+            return
+
+        await ctx.send(file=File(BytesIO(data), filename=filename))
 
     @staticmethod
     def save_image(img, format='PNG'):
@@ -267,164 +756,80 @@ class Images(Cog):
         data.seek(0)
         return data
 
-    async def _get_image(self, ctx, image):
-        img = await get_image_from_message(ctx, image)
-        if img is None:
+    async def _get_image_url(self, ctx, image):
+        url = await get_image_from_message(ctx, image)
+        if url is None:
             if image is not None:
                 await ctx.send(f'No image found from {image}')
             else:
                 await ctx.send('Please input a mention, emote or an image when using the command')
 
+        return url
+
+    async def _get_image(self, ctx, image):
+        url = await self._get_image_url(ctx, image)
+        if url is None:
             return
 
-        img = await self._dl_image(ctx, img)
-        return img
+        return await self._dl_image(ctx, url)
 
     async def _dl_image(self, ctx, url):
+        """Returns the raw image data that is passed to the render functions"""
         try:
-            img = await image_from_url(url, self.bot.aiohttp_client)
+            img, _ = await self.bot.image_fetcher.fetch(url)
         except OverflowError:
             await ctx.send('Failed to download. File is too big')
         except TypeError:
             await ctx.send('Link is not a direct link to an image')
         else:
+            if img is None:
+                await ctx.send('Failed to download image')
+                return
+
             return img
 
     @command(ignore_extra=True)
     @cooldown(3, 5, type=BucketType.guild)
     async def anime_deaths(self, ctx, image=None):
         """Generate a top 10 anime deaths image based on provided image"""
-        path = os.path.join(TEMPLATES, 'saddest-anime-deaths.png')
-        img = await self._get_image(ctx, image)
-        if img is None:
+        url = await self._get_image_url(ctx, image)
+        if url is None:
             return
 
-        await ctx.trigger_typing()
-
-        def do_it():
-            nonlocal img
-
-            x, y = 9, 10
-            w, h = 854, 480
-            template = Image.open(path)
-            img = resize_keep_aspect_ratio(img, (w, h), can_be_bigger=False, resample=Image.BILINEAR)
-            new_w, new_h = img.width, img.height
-            if new_w != w:
-                x += int((w - new_w)/2)
-
-            if new_h != h:
-                y += int((h - new_h) / 2)
-
-            img = img.convert("RGBA")
-            template.paste(img, (x, y), img)
-            return self.save_image(template)
-
-        await ctx.send(file=File(await self.image_func(do_it), filename='top10-anime-deaths.png'))
+        await self._send_render(ctx, 'top10-anime-deaths.png', render_anime_deaths,
+                                url, 'saddest-anime-deaths.png')
 
     @command(ignore_extra=True)
     @cooldown(3, 5, type=BucketType.guild)
     async def anime_deaths2(self, ctx, image=None):
         """same as anime_deaths but with a transparent bg"""
-        path = os.path.join(TEMPLATES, 'saddest-anime-deaths2.png')
-        img = await self._get_image(ctx, image)
-        if img is None:
+        url = await self._get_image_url(ctx, image)
+        if url is None:
             return
 
-        await ctx.trigger_typing()
-
-        def do_it():
-            nonlocal img
-
-            x, y = 9, 10
-            w, h = 854, 480
-            template = Image.open(path)
-            img = resize_keep_aspect_ratio(img, (w, h), can_be_bigger=False, resample=Image.BILINEAR)
-            new_w, new_h = img.width, img.height
-            if new_w != w:
-                x += int((w - new_w)/2)
-
-            if new_h != h:
-                y += int((h - new_h) / 2)
-
-            img = img.convert("RGBA")
-            template.paste(img, (x, y), img)
-            return self.save_image(template)
-
-        await ctx.send(file=File(await self.image_func(do_it), filename='top10-anime-deaths.png'))
+        await self._send_render(ctx, 'top10-anime-deaths.png', render_anime_deaths,
+                                url, 'saddest-anime-deaths2.png')
 
     @command(ignore_extra=True)
     @cooldown(3, 5, type=BucketType.guild)
     async def trap(self, ctx, image=None):
         """Is it a trap?
         """
-        img = await self._get_image(ctx, image)
-        if img is None:
+        url = await self._get_image_url(ctx, image)
+        if url is None:
             return
 
-        await ctx.trigger_typing()
-
-        def do_it():
-            nonlocal img
-
-            path = os.path.join(TEMPLATES, 'is_it_a_trap.png')
-            path2 = os.path.join(TEMPLATES, 'is_it_a_trap_layer.png')
-            img = img.convert("RGBA")
-            x, y = 820, 396
-            w, h = 355, 505
-            rotation = -22.5
-
-            img = resize_keep_aspect_ratio(img, (w, h), can_be_bigger=False,
-                                           resample=Image.BILINEAR)
-            img = img.rotate(rotation, expand=True, resample=Image.BILINEAR)
-            x_place = x - int(img.width / 2)
-            y_place = y - int(img.height / 2)
-
-            template = Image.open(path)
-
-            template.paste(img, (x_place, y_place), img)
-            layer = Image.open(path2)
-            template.paste(layer, (0, 0), layer)
-            return self.save_image(template)
-
-        await ctx.send(file=File(await self.image_func(do_it), filename='is_it_a_trap.png'))
+        await self._send_render(ctx, 'is_it_a_trap.png', render_trap, url)
 
     @command(ignore_extra=True, aliases=['jotaro_no'])
     @cooldown(3, 5, BucketType.guild)
     async def jotaro(self, ctx, image=None):
         """Jotaro wasn't pleased"""
-        img = await self._get_image(ctx, image)
-        if img is None:
+        url = await self._get_image_url(ctx, image)
+        if url is None:
             return
-        await ctx.trigger_typing()
 
-        def do_it():
-            nonlocal img
-
-            # The size we want from the transformation
-            width = 524
-            height = 326
-            d_x = 90
-            w, h = img.size
-
-            coeffs = find_coeffs(
-                [(d_x, 0), (width - d_x, 0), (width, height), (0, height)],
-                [(0, 0), (w, 0), (w, h), (0, h)])
-
-            img = img.transform((width, height), Image.PERSPECTIVE, coeffs,
-                                Image.BICUBIC)
-
-            template = os.path.join(TEMPLATES, 'jotaro.png')
-            template = Image.open(template)
-
-            white = Image.new('RGBA', template.size, 'white')
-
-            x, y = 9, 351
-            white.paste(img, (x, y))
-            white.paste(template, mask=template)
-
-            return self.save_image(white)
-
-        await ctx.send(file=File(await self.image_func(do_it), filename='jotaro_no.png'))
+        await self._send_render(ctx, 'jotaro_no.png', render_jotaro, url)
 
     @command(ignore_extra=True, aliases=['jotaro_photo'])
     @cooldown(2, 5, BucketType.guild)
@@ -434,95 +839,22 @@ class Images(Cog):
         # Should be used if it can be embedded since the file size is much smaller
         use_webp = False
 
-        img = await self._get_image(ctx, image)
-        if img is None:
+        url = await self._get_image_url(ctx, image)
+        if url is None:
             return
 
         extension = 'webp' if use_webp else 'gif'
-        await ctx.trigger_typing()
-
-        def do_it():
-            nonlocal img
-
-            r = 34.7
-            x = 6
-            y = -165
-            width = 468
-            height = 439
-            duration = [120, 120, 120, 120, 120, 120, 120, 120, 120, 120, 120, 120,
-                        80, 120, 120, 120, 120, 120, 30, 120, 120, 120, 120, 120,
-                        120, 120, 760, 2000]  # Frame timing
-
-            frames = [frame.copy().convert('RGBA') for frame in ImageSequence.Iterator(Image.open(os.path.join(TEMPLATES, 'jotaro_photo.gif')))]
-            photo = os.path.join(TEMPLATES, 'photo.png')
-            finger = os.path.join(TEMPLATES, 'finger.png')
-
-            im = Image.open(photo)
-            img = img.convert('RGBA')
-            img = resize_keep_aspect_ratio(img, (width, height), resample=Image.BICUBIC,
-                                           can_be_bigger=False, crop_to_size=True,
-                                           center_cropped=True, background_color='black')
-            w, h = img.size
-            width, height = (472, 441)
-            coeffs = find_coeffs(
-                [(0, 0), (437, 0), (width, height), (0, height)],
-                [(0, 0), (w, 0), (w, h), (0, h)])
-            img = img.transform((width, height), Image.PERSPECTIVE, coeffs,
-                                Image.BICUBIC)
-            img = img.rotate(r, resample=Image.BICUBIC, expand=True)
-            im.paste(img, box=(x, y), mask=img)
-            finger = Image.open(finger)
-            im.paste(finger, mask=finger)
-            frames[-1] = im
-
-            if use_webp:
-                # We save room for some colors when not using the shadow in a gif
-                shadow = os.path.join(TEMPLATES, 'photo.png')
-                im.alpha_composite(shadow)
-                kwargs = {}
-            else:
-                # Duration won't work in the save() params when using a gif so I have to do it this way
-                frames[0].info['duration'] = duration
-                kwargs = {'optimize': True}
-
-            file = BytesIO()
-            frames[0].save(file, format=extension, save_all=True, append_images=frames[1:], duration=duration, **kwargs)
-            if file.tell() > 8000000:
-                raise BotException('Generated image was too big in filesize')
-
-            file.seek(0)
-            return optimize_gif(file.getvalue())
-
-        await ctx.send(file=File(await self.image_func(do_it), filename='jotaro_photo.{}'.format(extension)))
+        await self._send_render(ctx, 'jotaro_photo.{}'.format(extension),
+                                render_jotaro_photo, url, use_webp=use_webp)
 
     @command(ignore_extra=True, aliases=['jotaro3'])
     @cooldown(2, 5, BucketType.guild)
     async def jotaro_smile(self, ctx, image=None):
-        img = await self._get_image(ctx, image)
-        if img is None:
+        url = await self._get_image_url(ctx, image)
+        if url is None:
             return
-        await ctx.trigger_typing()
-
-        def do_it():
-            nonlocal img
 
-            im = Image.open(os.path.join(TEMPLATES, 'jotaro_smile.png'))
-            img = img.convert('RGBA')
-            i = Image.new('RGBA', im.size, 'black')
-            size = (max(img.size), max(img.size))
-            img = resize_keep_aspect_ratio(img, size, can_be_bigger=False,
-                                           crop_to_size=True, center_cropped=True)
-            coeffs = find_coeffs([(0, 68), (358, 0), (410, 335), (80, 435)],
-                                 [(0, 0), (img.width, 0), size, (0, img.height)])
-            img = img.transform((410, 435), Image.PERSPECTIVE, coeffs,
-                                Image.BICUBIC)
-            x, y = (178, 479)
-            i.paste(img, (x, y), mask=img)
-            i.paste(im, mask=im)
-
-            return self.save_image(i)
-
-        await ctx.send(file=File(await self.image_func(do_it), filename='jotaro.png'))
+        await self._send_render(ctx, 'jotaro.png', render_jotaro_smile, url)
 
     @command(aliases=['tbc'], ignore_extra=True)
     @cooldown(2, 5, BucketType.guild)
@@ -531,139 +863,70 @@ class Images(Cog):
         Usage: {prefix}{name} `image/emote/mention` `[optional sepia filter off] on/off`
         Sepia filter is on by default
         """
-        img = await self._get_image(ctx, image)
-        if not img:
+        url = await self._get_image_url(ctx, image)
+        if url is None:
             return
 
-        await ctx.trigger_typing()
-
-        def do_it():
-            nonlocal img
-            if not no_sepia:
-                img = sepia(img)
-
-            width, height = img.width, img.height
-            if width < 300:
-                width = 300
-
-            if height < 200:
-                height = 200
-
-            img = resize_keep_aspect_ratio(img, (width, height), resample=Image.BILINEAR)
-            width, height = img.width, img.height
-            tbc = Image.open(os.path.join(TEMPLATES, 'tbc.png'))
-            x = int(width * 0.09)
-            y = int(height * 0.90)
-            tbc = resize_keep_aspect_ratio(tbc, (width * 0.5, height * 0.3),
-                                           can_be_bigger=False, resample=Image.BILINEAR)
-
-            if y + tbc.height > height:
-                y = height - tbc.height - 10
-
-            img.paste(tbc, (x, y), tbc)
-
-            return self.save_image(img)
-
-        await ctx.send(file=File(await self.image_func(do_it), filename='To_be_continued.png'))
+        await self._send_render(ctx, 'To_be_continued.png', render_tobecontinued,
+                                url, no_sepia=no_sepia)
 
     @command(aliases=['heaven', 'heavens_door'], ignore_extra=True)
     @cooldown(2, 5, BucketType.guild)
     async def overheaven(self, ctx, image=None):
-        img = await self._get_image(ctx, image)
-        if not img:
+        url = await self._get_image_url(ctx, image)
+        if url is None:
             return
-        await ctx.trigger_typing()
-
-        def do_it():
-            nonlocal img
-            overlay = Image.open(os.path.join(TEMPLATES, 'heaven.png'))
-            base = Image.open(os.path.join(TEMPLATES, 'heaven_base.png'))
-            size = (750, 750)
-            img = resize_keep_aspect_ratio(img, size, can_be_bigger=False,
-                                           crop_to_size=True, center_cropped=True)
-
-            img = img.convert('RGBA')
-            x, y = (200, 160)
-            base.paste(img, (x, y), mask=img)
-            base.alpha_composite(overlay)
-            return self.save_image(base)
 
-        await ctx.send(file=File(await self.image_func(do_it), filename='overheaven.png'))
+        await self._send_render(ctx, 'overheaven.png', render_overheaven, url)
 
     @command(aliases=['puccireset'], ignore_extra=True)
     @cooldown(2, 5, BucketType.guild)
     async def pucci(self, ctx, image=None):
-        img = await self._get_image(ctx, image)
-        if not img:
+        url = await self._get_image_url(ctx, image)
+        if url is None:
             return
-        await ctx.trigger_typing()
 
-        def do_it():
-            nonlocal img
-            img = img.convert('RGBA')
-            im = Image.open(os.path.join(TEMPLATES, 'pucci_bg.png'))
-            overlay = Image.open(os.path.join(TEMPLATES, 'pucci_faded.png'))
-            size = (682, 399)
-            img = resize_keep_aspect_ratio(img, size, can_be_bigger=False,
-                                           crop_to_size=True, center_cropped=True)
-            x, y = (0, 367)
-            im.paste(img, (x, y), mask=img)
-            im.alpha_composite(overlay)
-            return self.save_image(im)
-
-        await ctx.send(file=File(await self.image_func(do_it), filename='pucci_reset.png'))
+        await self._send_render(ctx, 'pucci_reset.png', render_pucci, url)
 
     @command(ignore_extra=True)
     @cooldown(1, 10, BucketType.guild)
     async def party(self, ctx, image=None):
         """Takes a long ass time to make the gif"""
-        img = await self._get_image(ctx, image)
-        if img is None:
+        url = await self._get_image_url(ctx, image)
+        if url is None:
             return
 
         async with ctx.typing():
-            img = await self.bot.loop.run_in_executor(self.threadpool, partial(gradient_flash, img, get_raw=True))
+            data = await self._render(ctx, render_party, url)
+        if data is None:
+            return
+
         await ctx.send(content=f"Use {ctx.prefix}party2 if transparency guess went wrong",
-                       file=File(img, filename='party.gif'))
+                       file=File(BytesIO(data), filename='party.gif'))
 
     @command(ignore_extra=True)
     @cooldown(1, 10, BucketType.guild)
     async def party2(self, ctx, image=None):
-        img = await self._get_image(ctx, image)
-        if img is None:
+        url = await self._get_image_url(ctx, image)
+        if url is None:
             return
 
-        async with ctx.typing():
-            img = await self.bot.loop.run_in_executor(self.threadpool, partial(gradient_flash, img, get_raw=True, transparency=False))
-        await ctx.send(file=File(img, filename='party.gif'))
+        await self._send_render(ctx, 'party.gif', render_party, url, transparency=False)
 
     @command(ignore_extra=True)
     @cooldown(2, 2, type=BucketType.guild)
     async def blurple(self, ctx, image=None):
-        img = await self._get_image(ctx, image)
-        if img is None:
+        url = await self._get_image_url(ctx, image)
+        if url is None:
             return
 
-        def do_it():
-            nonlocal img
-            im = Image.new('RGBA', img.size, color='#7289DA')
-            img = img.convert('RGBA')
-            if img.format == 'GIF':
-                def multiply(frame):
-                    return ImageChops.multiply(frame, im)
-
-                data = func_to_gif(img, multiply,  get_raw=True)
-                name = 'blurple.gif'
-            else:
-                img = ImageChops.multiply(img, im)
-                data = self.save_image(img)
-                name = 'blurple.png'
-
-            return data, name
-
         async with ctx.typing():
-            file = File(*await self.image_func(do_it))
-        await ctx.send(file=file)
+            data = await self._render(ctx, render_blurple, url)
+        if data is None:
+            return
+
+        name = 'blurple.gif' if data[:3] == b'GIF' else 'blurple.png'
+        await ctx.send(file=File(BytesIO(data), filename=name))
 
     @command(ignore_extra=True, aliases=['gspd', 'gif_spd'])
     @cooldown(2, 5)
@@ -685,7 +948,7 @@ class Images(Cog):
         if img is None:
             return
 
-        if not isinstance(img, GifImagePlugin.GifImageFile):
+        if img[:6] not in (b'GIF87a', b'GIF89a'):
             raise BadArgument('Image must be a gif')
 
         try:
@@ -699,182 +962,72 @@ class Images(Cog):
         if not 0 < speed <= 10:
             raise BadArgument('Speed must be larger than 0 and less or equal to 10')
 
-        def do_speedup():
-            frames = convert_frames(img, 'RGBA')
-            durations = get_duration(frames)
-
-            def transform(duration):
-                # Frame delay is stored as an unsigned 2 byte int
-                # A delay of 0 would mean that the frame would change as fast
-                # as the pc can do it which is useless. Also rendering engines
-                # like to round delays higher up to 10 and most don't display the
-                # smallest delays
-                duration = min(max(duration//speed, 5), 65535)
-                return duration
-
-            durations = list(map(transform, durations))
-            frames[0].info['duration'] = durations
-            for f, d in zip(frames, durations):
-                f.info['duration'] = d
-
-            frames = apply_transparency(frames)
-            file = BytesIO()
-            frames[0].save(file, format='GIF', duration=durations, save_all=True,
-                           append_images=frames[1:], loop=65535, optimize=False, disposal=2)
-            file.seek(0)
-            data = file.getvalue()
-            if len(data) > 8000000:
-                return optimize_gif(file.getvalue())
-
-            return data
-
         async with ctx.typing():
-            file = await self.image_func(do_speedup)
-        await ctx.send(file=File(file, filename='speedup.gif'))
+            data = await self.image_func(ctx, render_gif_speed, img, speed)
+        await ctx.send(file=File(BytesIO(data), filename='speedup.gif'))
 
     @command(ignore_extra=True)
     @cooldown(2, 5, BucketType.guild)
     async def smug(self, ctx, image=None):
-        img = await self._get_image(ctx, image)
+        url = await self._get_image_url(ctx, image)
 
-        if img is None:
+        if url is None:
             return
 
-        def do_it():
-            nonlocal img
-            img = img.convert('RGBA')
-            template = Image.open(os.path.join(TEMPLATES, 'smug_man.png'))
-
-            w, h = 729, 607
-            img = resize_keep_aspect_ratio(img, (w, h), can_be_bigger=False,
-                                           resample=Image.BICUBIC, crop_to_size=True,
-                                           center_cropped=True)
-            template.paste(img, (168, 827), img)
-            return self.save_image(template)
-
-        async with ctx.typing():
-            file = await self.image_func(do_it)
-        await ctx.send(file=File(file, filename='smug_man.png'))
+        await self._send_render(ctx, 'smug_man.png', render_template_paste, url,
+                                'smug_man.png', (729, 607), (168, 827))
 
     @command(ignore_extra=True)
     @cooldown(2, 5, BucketType.guild)
     async def seeyouagain(self, ctx, image=None):
-        img = await self._get_image(ctx, image)
-        if img is None:
+        url = await self._get_image_url(ctx, image)
+        if url is None:
             return
 
-        def do_it():
-            nonlocal img
-            template = Image.open(os.path.join(TEMPLATES, 'seeyouagain.png'))
-            img = img.convert('RGBA')
-            img = resize_keep_aspect_ratio(img, (360, 300), can_be_bigger=False,
-                                           resample=Image.BICUBIC, crop_to_size=True,
-                                           center_cropped=True)
-
-            template.paste(img, (800, 915), img)
-            return self.save_image(template)
-
-        async with ctx.typing():
-            file = await self.image_func(do_it)
-        await ctx.send(file=File(file, filename='see_you_again.png'))
+        await self._send_render(ctx, 'see_you_again.png', render_template_paste, url,
+                                'seeyouagain.png', (360, 300), (800, 915))
 
     @command(ignore_extra=True, aliases=['sha'])
     @cooldown(2, 5, BucketType.guild)
     async def sheer_heart_attack(self, ctx, image=None):
-        img = await self._get_image(ctx, image)
-        if img is None:
+        url = await self._get_image_url(ctx, image)
+        if url is None:
             return
 
-        def do_it():
-            nonlocal img
-            template = Image.open(os.path.join(TEMPLATES, 'sheer_heart_attack.png'))
-            img = img.convert('RGBA')
-            img = resize_keep_aspect_ratio(img, (1000, 567), can_be_bigger=False,
-                                           resample=Image.BICUBIC, crop_to_size=True,
-                                           center_cropped=True, background_color='white')
-
-            template.paste(img, (0, 563), img)
-            return self.save_image(template)
-
-        async with ctx.typing():
-            file = await self.image_func(do_it)
-        await ctx.send(file=File(file, filename='sha.png'))
+        await self._send_render(ctx, 'sha.png', render_template_paste, url,
+                                'sheer_heart_attack.png', (1000, 567), (0, 563),
+                                background_color='white')
 
     @command(ignore_extra=True)
     @cooldown(2, 5, BucketType.guild)
     async def kira(self, ctx, image=None):
-        img = await self._get_image(ctx, image)
-        if img is None:
+        url = await self._get_image_url(ctx, image)
+        if url is None:
             return
 
-        def do_it():
-            nonlocal img
-            template = Image.open(os.path.join(TEMPLATES, 'kira.png'))
-            img = img.convert('RGBA')
-            img = resize_keep_aspect_ratio(img, (810, 980), can_be_bigger=False,
-                                           resample=Image.BICUBIC, crop_to_size=True,
-                                           center_cropped=True)
-
-            bg = Image.new('RGBA', (1918, 2132), (0, 0, 0, 0))
-
-            bg.paste(img, (610, 1125), img)
-            bg.alpha_composite(template)
-            return self.save_image(bg)
-
-        async with ctx.typing():
-            file = await self.image_func(do_it)
-        await ctx.send(file=File(file, filename='kira.png'))
+        await self._send_render(ctx, 'kira.png', render_template_overlay, url,
+                                'kira.png', (810, 980), (610, 1125))
 
     @command(ignore_extra=True)
     @cooldown(2, 5, BucketType.guild)
     async def josuke(self, ctx, image=None):
-        img = await self._get_image(ctx, image)
-        if img is None:
+        url = await self._get_image_url(ctx, image)
+        if url is None:
             return
 
-        def do_it():
-            nonlocal img
-            template = Image.open(os.path.join(TEMPLATES, 'josuke.png'))
-            img = img.convert('RGBA')
-            img = resize_keep_aspect_ratio(img, (198, 250), can_be_bigger=False,
-                                           resample=Image.BICUBIC, crop_to_size=True,
-                                           center_cropped=True)
-
-            bg = Image.new('RGBA', (1920, 1080), (0, 0, 0, 0))
-
-            bg.paste(img, (1000, 155), img)
-            bg.alpha_composite(template)
-            return self.save_image(bg)
-
-        async with ctx.typing():
-            file = await self.image_func(do_it)
-        await ctx.send(file=File(file, filename='josuke.png'))
+        await self._send_render(ctx, 'josuke.png', render_template_overlay, url,
+                                'josuke.png', (198, 250), (1000, 155))
 
     @command(ignore_extra=True, aliases=['josuke2'])
     @cooldown(2, 5, BucketType.guild)
     async def josuke_binoculars(self, ctx, image=None):
-        img = await self._get_image(ctx, image)
-        if img is None:
+        url = await self._get_image_url(ctx, image)
+        if url is None:
             return
 
-        def do_it():
-            nonlocal img
-            template = Image.open(os.path.join(TEMPLATES, 'josuke_binoculars.png'))
-            img = img.convert('RGBA')
-            size = (700, 415)
-            img = resize_keep_aspect_ratio(img, size, can_be_bigger=False,
-                                           resample=Image.BICUBIC, crop_to_size=True,
-                                           center_cropped=True)
-
-            bg = Image.new('RGBA', template.size, (255, 255, 255))
-
-            bg.paste(img, (50, 460), img)
-            bg.alpha_composite(template)
-            return self.save_image(bg)
-
-        async with ctx.typing():
-            file = await self.image_func(do_it)
-        await ctx.send(file=File(file, filename='josuke_binoculars.png'))
+        await self._send_render(ctx, 'josuke_binoculars.png', render_template_overlay, url,
+                                'josuke_binoculars.png', (700, 415), (50, 460),
+                                bg_color=(255, 255, 255))
 
     @command(ignore_extra=True, aliases=['poke'])
     @cooldown(2, 2, type=BucketType.guild)
@@ -889,14 +1042,11 @@ class Images(Cog):
             return await ctx.send('Pokefusion not supported')
         await ctx.trigger_typing()
         try:
-            img, s = await self._pokefusion.fuse(poke1, poke2, color_poke)
+            data, s = await self._pokefusion.fuse(poke1, poke2, color_poke)
         except NoPokeFoundException as e:
             return await ctx.send(str(e))
 
-        file = BytesIO()
-        img.save(file, 'PNG')
-        file.seek(0)
-        await ctx.send(s, file=File(file, filename='pokefusion.png'))
+        await ctx.send(s, file=File(BytesIO(data), filename='pokefusion.png'))
 
     @command(ignore_extra=True, aliases=['get_im'])
     @cooldown(3, 3, BucketType.guild)
@@ -908,6 +1058,35 @@ class Images(Cog):
         s = img if img else 'No image found'
         return await ctx.send(s)
 
+    @command(owner_only=True)
+    async def template_stats(self, ctx):
+        """Show memory usage and load times of image templates"""
+        stats = templates.stats()
+        s = f'{len(stats["templates"])} templates using {stats["memory"]/1024/1024:.1f}/' \
+            f'{stats["max_bytes"]/1024/1024:.0f}MB loaded in {stats["startup_ms"]:.0f}ms\n'
+        s += f'Decoded from disk: {stats["misses"]}\n'
+        if stats['skipped']:
+            s += f'Over budget: {", ".join(stats["skipped"])}\n'
+
+        for name, t in sorted(stats['templates'].items(), key=lambda i: i[1]['bytes'], reverse=True):
+            s += f'{name}: {t["bytes"]/1024/1024:.1f}MB {t["load_ms"]:.0f}ms {t["uses"]} uses\n'
+
+        await ctx.send(f'```\n{s}\n```')
+
+    @command(owner_only=True)
+    async def pokefusion_stats(self, ctx):
+        """Show browser pool usage and the fused sprite cache of pokefusion"""
+        if not self._pokefusion:
+            return await ctx.send('Pokefusion not supported')
+
+        stats = self._pokefusion.stats()
+        browsers = self._pokefusion.browsers
+        s = 'Browsers: {idle}/{size} idle, {created} created, {recycled} recycled, {broken} broken\n'.format(**stats['browsers'])
+        s += f'Wait: {browsers.wait_time}\nPage: {browsers.run_time}\n'
+        s += 'Sprites: {sprites} cached, {hits} hits, {misses} misses\n'.format(**stats['sprites'])
+        s += f'{stats["assets"]} assets loaded'
+        await ctx.send(f'```\n{s}\n```')
+
     @command(owner_only=True)
     async def update_poke_cache(self, ctx):
         if await self._pokefusion.update_cache() is False:
@@ -29,7 +29,6 @@ import logging
 import os
 import sys
 from collections import OrderedDict
-from functools import partial
 from io import BytesIO
 from itertools import zip_longest
 from threading import Lock
@@ -48,7 +47,7 @@ from utils.imagetools import (create_shadow, create_text, create_glow,
                               create_geopattern_background, shift_color,
                               trim_image, remove_background,
                               resize_keep_aspect_ratio, get_color,
-                              IMAGES_PATH, image_from_url, GeoPattern,
+                              IMAGES_PATH, GeoPattern,
                               color_distance, MAX_COLOR_DIFF)
 from utils.utilities import (get_picture_from_msg, y_n_check,
                              check_negative, normalize_text,
@@ -283,7 +282,7 @@ class JoJo:
 
         image_ = await get_image_from_message(ctx, image)
 
-        img = await image_from_url(image_, self.bot.aiohttp_client)
+        img = await self.bot.image_fetcher.image(image_)
         if img is None:
             image = image_ if image is None else image
             return await ctx.send('`{}` Could not extract image from {}. Stopping command'.format(name, image))
@@ -311,7 +310,7 @@ class JoJo:
         if bg is not None:
             try:
                 bg = bg.strip()
-                bg = await image_from_url(bg, self.bot.aiohttp_client)
+                bg = await self.bot.image_fetcher.image(bg)
                 dominant_color = get_color(bg)
                 color = Color(rgb=list(map(lambda c: c/255, dominant_color)))
                 bg = resize_keep_aspect_ratio(bg, size, True)
@@ -437,7 +436,13 @@ class JoJo:
                                                delete_after=20)
 
                 try:
-                    im = await self.bot.loop.run_in_executor(self.bot.threadpool, partial(remove_background, im, **kwargs))
+                    data = BytesIO()
+                    im.save(data, 'PNG')
+                    guild_id = ctx.guild.id if ctx.guild else None
+                    data = await self.bot.render_pool.submit(guild_id, ctx.command.qualified_name,
+                                                             render_remove_background,
+                                                             data.getvalue(), **kwargs)
+                    im = Image.open(BytesIO(data))
                 except Exception as e:
                     await ctx.send('`{}` Could not remove background because of an error {}'.format(name, e),
                                        delete_after=30)
@@ -457,5 +462,13 @@ class JoJo:
         await ctx.send(file=discord.File(file, filename='stand_card.png'))
 
 
+def render_remove_background(data, **kwargs):
+    """Run in the render pool"""
+    im = remove_background(Image.open(BytesIO(data)), **kwargs)
+    data = BytesIO()
+    im.save(data, 'PNG')
+    return data.getvalue()
+
+
 def setup(bot):
     bot.add_cog(JoJo(bot))
@@ -1,13 +1,12 @@
 import asyncio
 import logging
-from queue import Queue
 
 import discord
 from discord.abc import PrivateChannel
 from discord.embeds import EmptyEmbed
-from sqlalchemy import exc
-from sqlalchemy.exc import SQLAlchemyError
 
+from bot.batchwriter import BatchWriter
+from bot.bot import command
 from cogs.cog import Cog
 from utils.utilities import (split_string, format_on_delete, format_on_edit,
                              format_join_leave, get_avatar)
@@ -19,36 +18,27 @@ terminal = logging.getLogger('terminal')
 class Logger(Cog):
     def __init__(self, bot):
         super().__init__(bot)
-        self._q = Queue()
-        self._logging = asyncio.ensure_future(self.bot.loop.run_in_executor(self.bot.threadpool, self._logging_loop), loop=self.bot.loop)
-        self._stop_log = asyncio.Event(loop=self.bot.loop)
+        config = bot.config
+        self._writer = BatchWriter(bot, max_batch=config.log_batch_size,
+                                   flush_interval=config.log_flush_interval,
+                                   max_queue=config.log_max_queue,
+                                   overflow=config.log_overflow)
+        # Cogs are loaded in a thread so schedule the start on the loop
+        self.bot.loop.call_soon_threadsafe(self._writer.start)
 
     def __unload(self):
-        self.bot.loop.call_soon_threadsafe(self._stop_log.set)
-        self._q.put_nowait(1)  # Cause TypeError inside the loop
-        try:
-            self._logging.result(timeout=10)
-        except asyncio.TimeoutError:
-            self._logging.cancel()
-
-    def _logging_loop(self):
-        while hasattr(self, '_stop_log') and not self._stop_log.is_set():
-            try:
-                sql, params = self._q.get()
-            except (ValueError, TypeError):
-                continue
-
-            session = self.bot.get_session
-
-            try:
-                session.execute(sql, params)
-
-                session.commit()
-            except exc.DBAPIError as e:
-                if e.connection_invalidated:
-                    self.bot.engine.connect()
-            except SQLAlchemyError:
-                session.rollback()
+        asyncio.run_coroutine_threadsafe(self._writer.close(), loop=self.bot.loop)
+
+    @command(owner_only=True)
+    async def log_stats(self, ctx):
+        """Show queue depth, batch sizes and flush latency of the message logger"""
+        writer = self._writer
+        batch_size = writer.batch_size
+        s = f'Queue depth: {writer.queue_depth}/{writer.max_queue} ({writer.overflow})\n'
+        s += f'Written: {writer.written} Dropped: {writer.dropped} Failed: {writer.failed} Retried: {writer.retried}\n'
+        s += f'Batch size: n={batch_size.count} mean={batch_size.mean:.1f} max={batch_size.max}\n'
+        s += f'Flush latency: {writer.flush_latency}'
+        await ctx.send(f'```\n{s}\n```')
 
     def format_for_db(self, message):
         is_pm = isinstance(message.channel, PrivateChannel)
@@ -125,26 +115,30 @@ class Logger(Cog):
             data.append({'guild': guild.id, 'role': role.id, 'role_name': role.name})
 
         sql += ' ON DUPLICATE KEY UPDATE amount=amount+1, role_name=VALUES(role_name)'
-        self._q.put_nowait((sql, data))
+        return sql, data
 
     async def on_message(self, message):
-        self.check_mentions(message)
+        mentions = self.check_mentions(message)
+        if mentions:
+            await self._writer.put(*mentions)
+
         sql = "INSERT INTO `messages` (`shard`, `guild`, `channel`, `user`, `user_id`, `message`, `message_id`, `attachment`, `time`) " \
               "VALUES (:shard, :guild, :channel, :user, :user_id, :message, :message_id, :attachment, :time)"
 
         d = self.format_for_db(message)
 
         # terminal.info(str((shard, guild, guild_name, channel, channel_name, user, user_id, message.content, message_id, attachment)))
-        self._q.put_nowait((sql, d))
+        # Image commands look for the latest image from the database so images are written right away
+        await self._writer.put(sql, d, flush=d['attachment'] is not None)
 
     async def on_member_join(self, member):
         guild = member.guild
         sql = "INSERT INTO `join_leave` (`user_id`, `guild`, `value`) VALUES " \
               "(:user_id, :guild, :value) ON DUPLICATE KEY UPDATE value=1"
 
-        self._q.put_nowait((sql, {'user_id': member.id,
-                                  'guild': guild.id,
-                                  'value': 1}))
+        await self._writer.put(sql, {'user_id': member.id,
+                                     'guild': guild.id,
+                                     'value': 1})
 
         channel = self.bot.guild_cache.join_channel(guild.id)
         channel = guild.get_channel(channel)
@@ -171,9 +165,9 @@ class Logger(Cog):
         sql = "INSERT INTO `join_leave` (`user_id`, `guild`, `value`) VALUES " \
               "(:user_id, :guild, :value) ON DUPLICATE KEY UPDATE value=-1"
 
-        self._q.put_nowait((sql, {'user_id': member.id,
-                                  'guild': guild.id,
-                                  'value': -1}))
+        await self._writer.put(sql, {'user_id': member.id,
+                                     'guild': guild.id,
+                                     'value': -1})
 
         channel = self.bot.guild_cache.leave_channel(guild.id)
         channel = guild.get_channel(channel)
@@ -230,10 +224,10 @@ class Logger(Cog):
                 return
 
             sql = "INSERT INTO `messages` (`shard`, `guild`, `channel`, `user`, `user_id`, `message`, `message_id`, `attachment`, `time`) " \
-                  "VALUES (:shard, :guild, :channel, :user, :user_id, :message, :message_id, :attachment, :time) ON DUPLICATE KEY UPDATE attachment=IFNULL(attachment, :attachment)"
+                  "VALUES (:shard, :guild, :channel, :user, :user_id, :message, :message_id, :attachment, :time) ON DUPLICATE KEY UPDATE attachment=IFNULL(attachment, VALUES(attachment))"
 
             d = self.format_for_db(after)
-            self._q.put_nowait((sql, d))
+            await self._writer.put(sql, d)
 
         if before.author.bot or before.channel.id == 336917918040326166:
             return
@@ -293,7 +287,8 @@ class Logger(Cog):
             entries.append(command.name)
         entries = list(reversed(entries))
         entries.append(cmd.name)
-        await self.bot.dbutil.command_used(entries[0], ' '.join(entries[1:]) or "")
+        # Written to the database in batches
+        self.bot.command_stats.command_used(entries[0], ' '.join(entries[1:]) or "")
 
 
 def setup(bot):
@@ -10,7 +10,6 @@ from io import BytesIO
 
 import discord
 import imagehash
-import numpy
 from PIL import Image
 from discord import utils, Embed
 from discord.embeds import EmptyEmbed
@@ -23,7 +22,7 @@ from bot.bot import command, cooldown
 from bot.exceptions import BotException
 from bot.globals import POKESTATS
 from cogs.cog import Cog
-from utils.imagetools import image_from_url
+from utils.hashindex import HashIndex, pack_bits
 from utils.utilities import basic_check, random_color, wait_for_yes
 
 logger = logging.getLogger('debug')
@@ -224,10 +223,9 @@ def from_max_stat(min: int, max: int, value: int) -> tuple:
 class Pokemon(Cog):
     def __init__(self, bot):
         super().__init__(bot)
-        with open(os.path.join(os.getcwd(), 'data', 'pokestats', 'pokemon_hashes.json'), 'r', encoding='utf-8') as f:
-            self.poke_hashes = json.load(f)
-            self.poke_names = list(self.poke_hashes.values())
-            self.only_hash = numpy.array(list(map(lambda h: imagehash.hex_to_hash(h).hash.flatten(), self.poke_hashes.keys())))
+        self.hash_index = HashIndex.load_or_build(os.path.join(POKESTATS, 'pokemon_hashes.json'),
+                                                  os.path.join(POKESTATS, 'pokemon_hashes.bin'))
+        self.poke_names = self.hash_index.names
 
     @command(aliases=['pstats', 'pstat'])
     @cooldown(1, 3, BucketType.user)
@@ -411,12 +409,12 @@ class Pokemon(Cog):
     @command(ignore_extra=True, aliases=['gp'])
     @cooldown(1, 5, BucketType.guild)
     async def guess_pokemon(self, ctx, url):
-        img = await image_from_url(url, self.bot.aiohttp_client)
+        img = await self.bot.image_fetcher.image(url)
         if not img:
             return await ctx.send(f'No image found from {url}')
 
-        guess = await self.bot.loop.run_in_executor(self.bot.threadpool, self.get_match, img)
-        await ctx.send(f'That pokemon might be `{guess}`.\n'
+        guess, distance, margin = await self.bot.loop.run_in_executor(self.bot.threadpool, self.get_closest, img)
+        await ctx.send(f'That pokemon might be `{guess}` ({distance} bits off, next best {margin} bits further).\n'
                        f'Expected accuracy for this is command is max 80% so expect mistakes')
 
     @staticmethod
@@ -561,14 +559,17 @@ class Pokemon(Cog):
 
                 await self.bot.dbutil.log_pokespawn(poke_name, message.guild.id)
 
-    def get_match(self, img):
-        binarydiff = self.only_hash != imagehash.phash(img,
-                                                       hash_size=16,
-                                                       highfreq_factor=6).hash.reshape(1, -1)
-        hammingdiff = binarydiff.sum(axis=1)
-        closest_match = numpy.argmin(hammingdiff)
+    def get_closest(self, img):
+        """
+        Name of the pokemon closest to img, how many bits its hash differs
+        from the hash of img and how many bits more the next closest one differs
+        """
+        h = pack_bits(imagehash.phash(img, hash_size=16, highfreq_factor=6).hash)
+        idx, distance, margin = self.hash_index.nearest(h)
+        return self.poke_names[idx], distance, margin
 
-        return self.poke_names[closest_match]
+    def get_match(self, img):
+        return self.get_closest(img)[0]
 
     async def match_pokemon(self, url):
         async with await self.bot.aiohttp_client.get(url) as r:
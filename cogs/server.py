@@ -11,7 +11,6 @@ from validators import url as is_url
 from bot.bot import command, has_permissions, cooldown
 from bot.converters import PossibleUser
 from cogs.cog import Cog
-from utils.imagetools import raw_image_from_url
 from utils.utilities import (get_emote_url, get_emote_name, send_paged_message,
                              basic_check,
                              create_custom_emoji)
@@ -126,13 +125,16 @@ class Server(Cog):
 
     async def _dl(self, ctx, url):
         try:
-            data, mime_type = await raw_image_from_url(url, self.bot.aiohttp_client,
-                                                       get_mime=True)
+            data, mime_type = await self.bot.image_fetcher.fetch(url)
         except OverflowError:
             await ctx.send('Failed to download. File is too big')
         except TypeError:
             await ctx.send('Link is not a direct link to an image')
         else:
+            if data is None:
+                await ctx.send('Failed to download image')
+                return
+
             return data, mime_type
 
     @command(no_pm=True, aliases=['addemote', 'addemoji', 'add_emoji', 'add_emtoe'])
@@ -169,11 +171,11 @@ class Server(Cog):
         data, mime = data
         if 'gif' in mime:
             fmt = 'data:{mime};base64,{data}'
-            b64 = base64.b64encode(data.getvalue()).decode('ascii')
+            b64 = base64.b64encode(data).decode('ascii')
             img = fmt.format(mime=mime, data=b64)
             already_b64 = True
         else:
-            img = data.getvalue()
+            img = data
             already_b64 = False
 
         try:
@@ -221,11 +223,11 @@ class Server(Cog):
             data, mime = data
             if 'gif' in mime:
                 fmt = 'data:{mime};base64,{data}'
-                b64 = base64.b64encode(data.getvalue()).decode('ascii')
+                b64 = base64.b64encode(data).decode('ascii')
                 img = fmt.format(mime=mime, data=b64)
                 already_b64 = True
             else:
-                img = data.getvalue()
+                img = data
                 already_b64 = False
 
             try:
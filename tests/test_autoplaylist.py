@@ -0,0 +1,68 @@
+"""
+AutoplaylistStore noticing changes made to the file outside of the store.
+"""
+
+import os
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('discord')
+
+from bot.autoplaylist import AutoplaylistStore
+
+
+def write(path, lines):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(''.join(line + '\n' for line in lines))
+
+
+def make_store(tmp_path, lines):
+    path = str(tmp_path / 'autoplaylist.txt')
+    write(path, lines)
+    store = AutoplaylistStore(path)
+    assert list(store) == lines
+    return store
+
+
+def touch_later(path):
+    # Make sure the change is visible even on file systems with coarse mtimes
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+def test_append(tmp_path):
+    store = make_store(tmp_path, ['a', 'b'])
+    with open(store.path, 'a', encoding='utf-8') as f:
+        f.write('c\n')
+    touch_later(store.path)
+
+    assert list(store) == ['a', 'b', 'c']
+    assert store.reindexed == 1
+
+    assert store.add(['d', 'e']) == 2
+    assert list(store) == ['a', 'b', 'c', 'd', 'e']
+    assert store.reindexed == 1
+    store.close()
+
+
+def test_edit_and_grow(tmp_path):
+    store = make_store(tmp_path, ['aaaa', 'bbbb'])
+    # Same inode and a larger file but the old lines changed
+    with open(store.path, 'r+', encoding='utf-8') as f:
+        f.write('cc\ndddddd\neeee\n')
+    touch_later(store.path)
+
+    assert list(store) == ['cc', 'dddddd', 'eeee']
+    assert store.reindexed == 2
+    store.close()
+
+
+def test_delete(tmp_path):
+    store = make_store(tmp_path, ['a', 'b', 'a', 'c'])
+    assert store.delete(['a', 'missing']) == 1
+    assert list(store) == ['b', 'c']
+    assert store.delete(['missing']) == 0
+    assert store.delete(['b', 'c']) == 2
+    assert list(store) == []
+    store.close()
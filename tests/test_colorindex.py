@@ -0,0 +1,125 @@
+"""
+The vectorized color matching against colormath and the loops the color
+commands used before ColorIndex.
+"""
+
+import random
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('colormath')
+
+from colormath import color_diff_matrix
+from colormath.color_conversions import convert_color
+from colormath.color_objects import LabColor, sRGBColor
+
+from utils.colorindex import ColorIndex, delta_e_cie2000, rgb_to_lab
+
+TOLERANCE = 1e-9
+
+
+def random_lab(rng):
+    return LabColor(rng.uniform(0, 100), rng.uniform(-128, 127), rng.uniform(-128, 127))
+
+
+def colormath_delta_e(lab1, lab2):
+    # colormath.color_diff.delta_e_cie2000 does the same but uses numpy.asscalar
+    # which newer versions of numpy don't have
+    return float(color_diff_matrix.delta_e_cie2000(np.array(lab1.get_value_tuple()),
+                                                   np.array([lab2.get_value_tuple()]))[0])
+
+
+def loop_closest(colors, lab):
+    """How the closest color was found before ColorIndex"""
+    closest = None
+    similarity = 0
+    for color in colors:
+        s = 100 - colormath_delta_e(color, lab)
+        if s > similarity:
+            similarity = s
+            closest = color
+
+    return closest, similarity
+
+
+def loop_sorted(colors, start):
+    """How colors were sorted before ColorIndex"""
+    remaining = list(colors)
+    previous = start
+    ordered = []
+    while remaining:
+        closest = max(remaining, key=lambda c: 100 - colormath_delta_e(c, previous))
+        remaining.remove(closest)
+        ordered.append(closest)
+        previous = closest
+
+    return ordered
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_delta_e(seed):
+    rng = random.Random(seed)
+    colors = [random_lab(rng) for _ in range(50)]
+    target = random_lab(rng)
+
+    values = delta_e_cie2000([c.get_value_tuple() for c in colors], target.get_value_tuple())
+    for color, value in zip(colors, values):
+        assert value == pytest.approx(colormath_delta_e(color, target), abs=TOLERANCE)
+
+    # Broadcasting gives the full matrix
+    matrix = delta_e_cie2000(np.array([c.get_value_tuple() for c in colors])[:, None, :],
+                             np.array([c.get_value_tuple() for c in colors])[None, :, :])
+    for i in rng.sample(range(len(colors)), 5):
+        for j in rng.sample(range(len(colors)), 5):
+            assert matrix[i, j] == pytest.approx(colormath_delta_e(colors[i], colors[j]), abs=TOLERANCE)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_rgb_to_lab(seed):
+    rng = random.Random(seed)
+    for _ in range(50):
+        rgb = (rng.random(), rng.random(), rng.random())
+        expected = convert_color(sRGBColor(*rgb), LabColor).get_value_tuple()
+        assert tuple(rgb_to_lab(rgb)) == pytest.approx(expected, abs=TOLERANCE)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_closest(seed):
+    rng = random.Random(seed)
+    colors = [random_lab(rng) for _ in range(rng.randint(1, 40))]
+    index = ColorIndex(colors)
+    for _ in range(20):
+        lab = random_lab(rng)
+        color, similarity = index.closest(lab)
+        expected, expected_similarity = loop_closest(colors, lab)
+        assert color is expected
+        assert similarity == pytest.approx(expected_similarity, abs=TOLERANCE)
+
+
+def test_closest_no_similarity():
+    # Black and white are exactly 100 apart so their similarity is 0
+    index = ColorIndex([LabColor(100, 0, 0)])
+    assert index.closest(LabColor(0, 0, 0)) == (None, 0)
+
+    index = ColorIndex([LabColor(100, 0, 0), LabColor(95, -5, 5)])
+    # Both are more than 100 from the target
+    assert index.closest(LabColor(0, 127, 127)) == (None, 0)
+    assert loop_closest(index.colors, LabColor(0, 127, 127)) == (None, 0)
+
+    assert ColorIndex([]).closest(LabColor(50, 0, 0)) == (None, 0)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_sorted(seed):
+    rng = random.Random(seed)
+    colors = [random_lab(rng) for _ in range(rng.randint(1, 30))]
+    start = random_lab(rng)
+    index = ColorIndex(colors)
+    assert index.sorted(start) == loop_sorted(colors, start)
+    assert ColorIndex([]).sorted(start) == []
+
+    # The cached order isn't used for a different start
+    other = random_lab(rng)
+    assert index.sorted(other) == loop_sorted(colors, other)
+    assert index.sorted(start) == loop_sorted(colors, start)
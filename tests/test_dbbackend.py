@@ -0,0 +1,66 @@
+"""
+SQLiteBackend and the ResultProxy like Result all backends return.
+"""
+
+import asyncio
+
+import pytest
+
+pytest.importorskip('sqlalchemy')
+
+from sqlalchemy.exc import IntegrityError
+
+from bot.dbbackend import AiomysqlBackend, SQLiteBackend
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro(loop))
+    finally:
+        loop.close()
+
+
+def test_sqlite_backend():
+    async def main(loop):
+        backend = SQLiteBackend(loop)
+        try:
+            await backend.execute('CREATE TABLE `colors` (`id` INTEGER PRIMARY KEY, `guild` INTEGER, `name` TEXT)')
+            result = await backend.execute('INSERT INTO `colors` (`guild`, `name`) VALUES (:guild, :name)',
+                                           [{'guild': 1, 'name': 'red'}, {'guild': 1, 'name': 'blue'},
+                                            {'guild': 2, 'name': 'green'}], commit=True)
+            assert result.rowcount == 3
+            assert not result.returns_rows
+
+            result = await backend.execute('SELECT `id`, `name` FROM `colors` WHERE guild=:guild ORDER BY id',
+                                           {'guild': 1})
+            assert result.returns_rows
+            assert result.keys() == ['id', 'name']
+            row = result.fetchone()
+            assert row['name'] == 'red' and row[0] == 1 and row.get('missing') is None
+            assert dict(row.items()) == {'id': 1, 'name': 'red'}
+            assert [r['name'] for r in result] == ['blue']
+            assert result.fetchone() is None
+
+            result = await backend.execute('SELECT COUNT(*) FROM `colors`')
+            assert result.scalar() == 3
+
+            with pytest.raises(IntegrityError):
+                await backend.execute('INSERT INTO `colors` (`id`, `name`) VALUES (1, "duplicate")', commit=True)
+            assert backend.errors == 1
+            assert (await backend.execute('SELECT COUNT(*) FROM `colors`')).scalar() == 3
+
+            stats = backend.stats()
+            assert stats['backend'] == 'sqlite'
+            assert stats['query_latency']['count'] == 6
+        finally:
+            await backend.close()
+
+    run(main)
+
+
+def test_convert_sql():
+    sql = "SELECT * FROM `users` WHERE id=:id AND name LIKE '%a' AND time > '12:00'"
+    assert AiomysqlBackend.convert_sql(sql, {'id': 1}) == \
+        "SELECT * FROM `users` WHERE id=%(id)s AND name LIKE '%%a' AND time > '12:00'"
+    assert AiomysqlBackend.convert_sql(sql, None) == sql
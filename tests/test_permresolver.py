@@ -0,0 +1,128 @@
+"""
+PermResolver against the queries and check_perms that DatabaseUtils.check_blacklist
+uses. The blacklist rows are put in an sqlite table and selected with the same
+where clause as the guild query of check_blacklist.
+"""
+
+import random
+import sqlite3
+
+import pytest
+
+pytest.importorskip('discord')
+
+from bot.globals import BlacklistTypes, PermValues
+from bot.permresolver import PermResolver
+from utils import utilities
+
+COMMANDS = ('ping', 'color', 'play')
+USERS = (1, 2, 3)
+ROLES = (10, 11, 12, 13)
+CHANNELS = (20, 21)
+GUILD = 100
+
+
+def random_row(rng, row_id):
+    row = {'id': row_id,
+           'type': rng.choice((BlacklistTypes.WHITELIST, BlacklistTypes.BLACKLIST)),
+           'command': rng.choice(COMMANDS + (None,)),
+           'user': None, 'role': None, 'channel': None}
+
+    # Mostly rows the bot creates with one target but also ones with several
+    targets = rng.choice((0, 1, 1, 1, 1, 2, 3))
+    for key in rng.sample(('user', 'role', 'channel'), targets):
+        row[key] = rng.choice({'user': USERS, 'role': ROLES, 'channel': CHANNELS}[key])
+
+    return row
+
+
+def random_rows(rng, amount):
+    return [random_row(rng, i) for i in range(amount)]
+
+
+def make_db(rows):
+    db = sqlite3.connect(':memory:')
+    db.row_factory = sqlite3.Row
+    db.execute('CREATE TABLE `command_blacklist` (`id` INTEGER PRIMARY KEY, `command` TEXT, `type` INTEGER, '
+               '`user` INTEGER, `role` INTEGER, `channel` INTEGER, `guild` INTEGER)')
+    db.executemany('INSERT INTO `command_blacklist` VALUES (:id, :command, :type, :user, :role, :channel, :guild)',
+                   [dict(row, guild=GUILD) for row in rows])
+    return db
+
+
+def sql_check(db, command, user_id, role_ids, channel_id):
+    """The guild part of DatabaseUtils.check_blacklist"""
+    if role_ids:
+        roles = '(role IS NULL OR role IN ({}))'.format(', '.join(map(str, role_ids)))
+    else:
+        roles = 'role IS NULL'
+
+    sql = f'SELECT `type`, `role`, `user`, `channel` FROM `command_blacklist` WHERE guild={GUILD} ' \
+          f'AND (command=? OR command IS NULL) AND (user IS NULL OR user={user_id}) ' \
+          f'AND {roles} AND (channel IS NULL OR channel={channel_id})'
+    rows = db.execute(sql, (command,)).fetchall()
+    if not rows:
+        return None
+
+    return utilities.check_perms(rows, return_raw=True)
+
+
+def random_queries(rng, amount):
+    for _ in range(amount):
+        yield (rng.choice(COMMANDS), rng.choice(USERS),
+               rng.sample(ROLES, rng.randint(0, len(ROLES))), rng.choice(CHANNELS))
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_resolve_matches_sql(seed):
+    rng = random.Random(seed)
+    rows = random_rows(rng, rng.randint(0, 30))
+    db = make_db(rows)
+    resolver = PermResolver(rows)
+
+    for command, user_id, role_ids, channel_id in random_queries(rng, 200):
+        expected = sql_check(db, command, user_id, role_ids, channel_id)
+        assert resolver.resolve(command, user_id, role_ids, channel_id, return_raw=True) == expected
+
+        value = resolver.resolve(command, user_id, role_ids, channel_id)
+        if expected is None:
+            assert value is None
+        else:
+            assert value == PermValues.RETURNS.get(expected, False)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_add_and_remove_rows(seed):
+    """A resolver that has been edited gives the same results as one built from the final rows"""
+    rng = random.Random(seed)
+    rows = {row['id']: row for row in random_rows(rng, 30)}
+    resolver = PermResolver(rows.values())
+
+    next_id = len(rows)
+    for _ in range(40):
+        action = rng.random()
+        if action < 0.4 and rows:
+            row_id = rng.choice(list(rows))
+            del rows[row_id]
+            resolver.remove_row(row_id)
+        elif action < 0.7 and rows:
+            # Replaces the row with the same id
+            row = random_row(rng, rng.choice(list(rows)))
+            rows[row['id']] = row
+            resolver.add_row(row)
+        else:
+            row = random_row(rng, next_id)
+            next_id += 1
+            rows[row['id']] = row
+            resolver.add_row(row)
+
+    db = make_db(rows.values())
+    assert len(resolver) == len(rows)
+    for command, user_id, role_ids, channel_id in random_queries(rng, 200):
+        expected = sql_check(db, command, user_id, role_ids, channel_id)
+        assert resolver.resolve(command, user_id, role_ids, channel_id, return_raw=True) == expected
+
+    for row_id in list(rows):
+        resolver.remove_row(row_id)
+    assert len(resolver) == 0
+    assert resolver._index == {}
@@ -0,0 +1,61 @@
+"""
+Timing of the custom AudioPlayer.
+"""
+
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('discord')
+
+from bot.player import AudioPlayer
+
+
+class Source:
+    def read(self):
+        return b''
+
+    def is_opus(self):
+        return False
+
+    def cleanup(self):
+        pass
+
+
+def make_player():
+    client = SimpleNamespace(_connected=threading.Event(), guild=None)
+    player = AudioPlayer(Source(), client)
+    # Nothing to tell the speaking state to
+    player._speak = lambda *args, **kwargs: None
+    return player
+
+
+def test_delay_after_resume():
+    player = make_player()
+    # Been playing for a while
+    player._schedule_start = time.perf_counter() - 60
+    player.loops = int(60 / player.DELAY)
+
+    player.pause()
+    time.sleep(0.05)
+    player.resume()
+
+    # First frame after resuming. The schedule starts from the resume so
+    # the frame is at most one frame early and never late
+    player.loops += 1
+    delay = player.frame_delay(time.perf_counter())
+    assert 0 <= delay <= 2 * player.DELAY
+
+
+def test_delay_after_set_source():
+    player = make_player()
+    player._schedule_start = time.perf_counter() - 10
+    player.loops = 10
+
+    player.set_source(Source(), run_loops=100)
+    player.loops += 1
+    delay = player.frame_delay(time.perf_counter())
+    assert 0 <= delay <= 2 * player.DELAY
+    assert player.run_loops == 100
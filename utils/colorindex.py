@@ -0,0 +1,299 @@
+"""
+Vectorized color matching for the color roles of a guild and a search
+index for color names.
+"""
+
+import bisect
+import sys
+import time
+
+import numpy as np
+from colormath import color_constants
+from colormath.color_objects import sRGBColor
+
+
+def delta_e_cie2000(lab1, lab2, Kl=1, Kc=1, Kh=1):
+    """
+    CIEDE2000 difference of the Lab colors in lab1 and lab2. Both are arrays with
+    the L, a and b values in the last axis and are broadcast against each other.
+    The formula and the order of operations are the same as in
+    colormath.color_diff_matrix.delta_e_cie2000 so the results are identical
+    to comparing the colors one pair at a time with colormath
+    """
+    lab1 = np.asarray(lab1, dtype=np.float64)
+    lab2 = np.asarray(lab2, dtype=np.float64)
+    L1, a1, b1 = lab1[..., 0], lab1[..., 1], lab1[..., 2]
+    L2, a2, b2 = lab2[..., 0], lab2[..., 1], lab2[..., 2]
+
+    avg_Lp = (L1 + L2) / 2.0
+
+    C1 = np.sqrt(np.sum(np.power(lab1[..., 1:], 2), axis=-1))
+    C2 = np.sqrt(np.sum(np.power(lab2[..., 1:], 2), axis=-1))
+
+    avg_C1_C2 = (C1 + C2) / 2.0
+
+    G = 0.5 * (1 - np.sqrt(np.power(avg_C1_C2, 7.0) / (np.power(avg_C1_C2, 7.0) + np.power(25.0, 7.0))))
+
+    a1p = (1.0 + G) * a1
+    a2p = (1.0 + G) * a2
+
+    C1p = np.sqrt(np.power(a1p, 2) + np.power(b1, 2))
+    C2p = np.sqrt(np.power(a2p, 2) + np.power(b2, 2))
+
+    avg_C1p_C2p = (C1p + C2p) / 2.0
+
+    h1p = np.degrees(np.arctan2(b1, a1p))
+    h1p = h1p + (h1p < 0) * 360
+
+    h2p = np.degrees(np.arctan2(b2, a2p))
+    h2p = h2p + (h2p < 0) * 360
+
+    avg_Hp = (((np.fabs(h1p - h2p) > 180) * 360) + h1p + h2p) / 2.0
+
+    T = 1 - 0.17 * np.cos(np.radians(avg_Hp - 30)) + \
+        0.24 * np.cos(np.radians(2 * avg_Hp)) + \
+        0.32 * np.cos(np.radians(3 * avg_Hp + 6)) - \
+        0.2 * np.cos(np.radians(4 * avg_Hp - 63))
+
+    diff_h2p_h1p = h2p - h1p
+    delta_hp = diff_h2p_h1p + (np.fabs(diff_h2p_h1p) > 180) * 360
+    delta_hp = delta_hp - (h2p > h1p) * 720
+
+    delta_Lp = L2 - L1
+    delta_Cp = C2p - C1p
+    delta_Hp = 2 * np.sqrt(C2p * C1p) * np.sin(np.radians(delta_hp) / 2.0)
+
+    S_L = 1 + ((0.015 * np.power(avg_Lp - 50, 2)) / np.sqrt(20 + np.power(avg_Lp - 50, 2.0)))
+    S_C = 1 + 0.045 * avg_C1p_C2p
+    S_H = 1 + 0.015 * avg_C1p_C2p * T
+
+    delta_ro = 30 * np.exp(-(np.power(((avg_Hp - 275) / 25), 2.0)))
+    R_C = np.sqrt((np.power(avg_C1p_C2p, 7.0)) / (np.power(avg_C1p_C2p, 7.0) + np.power(25.0, 7.0)))
+    R_T = -2 * R_C * np.sin(2 * np.radians(delta_ro))
+
+    return np.sqrt(
+        np.power(delta_Lp / (S_L * Kl), 2) +
+        np.power(delta_Cp / (S_C * Kc), 2) +
+        np.power(delta_Hp / (S_H * Kh), 2) +
+        R_T * (delta_Cp / (S_C * Kc)) * (delta_Hp / (S_H * Kh)))
+
+
+def rgb_to_lab(rgb):
+    """
+    Lab values of sRGB colors. rgb is an array with the r, g and b values (0-1)
+    in the last axis. Does the same steps as converting a sRGBColor to a
+    LabColor with colormath so the values are the same as what it gives
+    """
+    rgb = np.asarray(rgb, dtype=np.float64)
+    linear = np.where(rgb <= 0.04045, rgb / 12.92, np.power((rgb + 0.055) / 1.055, 2.4))
+    xyz = np.maximum(linear @ np.asarray(sRGBColor.conversion_matrices['rgb_to_xyz']).T, 0.0)
+
+    illum = color_constants.ILLUMINANTS['2'][sRGBColor.native_illuminant]
+    xyz = xyz / np.asarray(illum)
+    xyz = np.where(xyz > color_constants.CIE_E, np.power(xyz, 1.0 / 3.0), (7.787 * xyz) + (16.0 / 116.0))
+    x, y, z = xyz[..., 0], xyz[..., 1], xyz[..., 2]
+
+    return np.stack(((116.0 * y) - 16.0, 500.0 * (x - y), 200.0 * (y - z)), axis=-1)
+
+
+def lab_values(lab):
+    """Lab values of a LabColor or anything that has them in a lab attribute"""
+    lab = getattr(lab, 'lab', lab)
+    if hasattr(lab, 'get_value_tuple'):
+        return lab.get_value_tuple()
+    return tuple(lab)
+
+
+class ColorIndex:
+    """
+    Lab values of colors in one array so the difference to all of them is
+    calculated in one call. The distance matrix and the sorted order are
+    calculated when they're first needed and kept until the index is replaced.
+    The sorted order is kept for the last start color it was calculated for.
+
+    Matches are picked the same way as the old loops did. The first color
+    with the highest similarity (100 - delta E) wins and nothing matches
+    if no color has a similarity above 0
+    """
+    def __init__(self, colors):
+        self.colors = list(colors)
+        self.lab = np.array([lab_values(c) for c in self.colors], dtype=np.float64).reshape(-1, 3)
+        self._distances = None
+        self._sorted = None
+
+    def __len__(self):
+        return len(self.colors)
+
+    def delta_e(self, lab):
+        """Delta E from every color in the index to lab"""
+        return delta_e_cie2000(self.lab, lab_values(lab))
+
+    def closest(self, lab):
+        """Returns the closest color and its similarity or (None, 0)"""
+        if not self.colors:
+            return None, 0
+
+        similarity = 100 - self.delta_e(lab)
+        idx = int(np.argmax(similarity))
+        if not similarity[idx] > 0:
+            return None, 0
+
+        return self.colors[idx], float(similarity[idx])
+
+    @property
+    def distances(self):
+        """distances[i, j] is the delta E from color i to color j"""
+        if self._distances is None:
+            self._distances = delta_e_cie2000(self.lab[:, None, :], self.lab[None, :, :])
+        return self._distances
+
+    def sorted(self, start):
+        """
+        Colors sorted by starting from the color closest to start and
+        always picking the closest remaining color to the previous one next
+        """
+        start = lab_values(start)
+        if self._sorted is not None and self._sorted[0] == start:
+            return self._sorted[1]
+
+        n = len(self.colors)
+        if n == 0:
+            return []
+
+        remaining = np.ones(n, dtype=bool)
+        similarity = 100 - self.delta_e(start)
+        order = []
+        for _ in range(n):
+            idx = int(np.argmax(np.where(remaining, similarity, -np.inf)))
+            order.append(idx)
+            remaining[idx] = False
+            # Distances from every color to the one just picked
+            similarity = 100 - self.distances[:, idx]
+
+        colors = [self.colors[i] for i in order]
+        self._sorted = (start, colors)
+        return colors
+
+
+def _trigrams(s):
+    return {s[i:i+3] for i in range(len(s) - 2)}
+
+
+class ColorNameIndex:
+    """
+    Search index for color names.
+
+    Names are kept sorted for prefix searches and every trigram of a name is
+    mapped to the names that contain it for substring and fuzzy searches.
+    The Lab values of the named colors are kept in an array so the named
+    color closest to any color can be found.
+
+    Args:
+        color_names: dict of lowercase color names to their info
+        to_lab: function that converts an rgb tuple (0-255) to a LabColor
+    """
+    def __init__(self, color_names, to_lab):
+        t = time.perf_counter()
+        self.names = sorted(color_names.keys())
+        self._ids = {name: idx for idx, name in enumerate(self.names)}
+        self._grams = {}
+        self._gram_counts = []
+        for idx, name in enumerate(self.names):
+            grams = _trigrams(name)
+            self._gram_counts.append(len(grams))
+            for gram in grams:
+                self._grams.setdefault(gram, set()).add(idx)
+
+        self.lab = np.array([lab_values(to_lab(tuple(color_names[name]['rgb'])))
+                             for name in self.names], dtype=np.float64).reshape(-1, 3)
+        self.build_time = (time.perf_counter() - t) * 1000
+
+    def __len__(self):
+        return len(self.names)
+
+    def _rank(self, ids):
+        # Shorter names are closer to the query. Names are already sorted alphabetically
+        return sorted(ids, key=lambda idx: (len(self.names[idx]), idx))
+
+    def prefix(self, query):
+        lo = bisect.bisect_left(self.names, query)
+        hi = bisect.bisect_left(self.names, query + '\uffff')
+        return self._rank(range(lo, hi))
+
+    def _substring_ids(self, query):
+        if len(query) < 3:
+            return [idx for idx, name in enumerate(self.names) if query in name]
+
+        postings = sorted((self._grams.get(gram, ()) for gram in _trigrams(query)), key=len)
+        if not postings[0]:
+            return []
+
+        ids = set(postings[0]).intersection(*postings[1:])
+        return [idx for idx in ids if query in self.names[idx]]
+
+    def search(self, query, limit=None):
+        """
+        Names containing query ranked by exact match, prefix matches,
+        matches at the start of a word and other substring matches
+        """
+        query = query.lower().strip()
+        if not query:
+            return []
+
+        exact = [self._ids[query]] if query in self._ids else []
+        starts = [idx for idx in self.prefix(query) if idx not in exact]
+        matched = set(exact).union(starts)
+        words = []
+        others = []
+        for idx in self._substring_ids(query):
+            if idx in matched:
+                continue
+            if ' ' + query in self.names[idx]:
+                words.append(idx)
+            else:
+                others.append(idx)
+
+        ranked = exact + starts + self._rank(words) + self._rank(others)
+        return [self.names[idx] for idx in ranked[:limit]]
+
+    def fuzzy(self, query, limit=10, min_score=0.2):
+        """
+        Names ranked by how many trigrams they share with query.
+        Returns tuples of name and score (0-1)
+        """
+        query = query.lower().strip()
+        grams = _trigrams(query)
+        if not grams:
+            return []
+
+        shared = {}
+        for gram in grams:
+            for idx in self._grams.get(gram, ()):
+                shared[idx] = shared.get(idx, 0) + 1
+
+        scores = []
+        for idx, count in shared.items():
+            score = count / (len(grams) + self._gram_counts[idx] - count)
+            if score >= min_score:
+                scores.append((score, idx))
+
+        scores.sort(key=lambda s: (-s[0], len(self.names[s[1]])))
+        return [(self.names[idx], score) for score, idx in scores[:limit]]
+
+    def nearest(self, lab):
+        """Returns the named color closest to lab and its similarity"""
+        similarity = 100 - delta_e_cie2000(self.lab, lab_values(lab))
+        idx = int(np.argmax(similarity))
+        return self.names[idx], float(similarity[idx])
+
+    def memory(self):
+        """Approximate memory usage of the index in bytes"""
+        names = sys.getsizeof(self.names) + sum(sys.getsizeof(name) for name in self.names)
+        ids = sys.getsizeof(self._ids)
+        grams = sys.getsizeof(self._grams) + sys.getsizeof(self._gram_counts)
+        grams += sum(sys.getsizeof(gram) + sys.getsizeof(ids_) for gram, ids_ in self._grams.items())
+        return {'names': names,
+                'name_ids': ids,
+                'trigrams': grams,
+                'lab': self.lab.nbytes,
+                'total': names + ids + grams + self.lab.nbytes}
@@ -0,0 +1,156 @@
+"""
+Packed index of perceptual hashes for matching pokemon sprites.
+
+The hashes used to be kept as a boolean matrix with a byte for every bit
+that was built from the hex strings every time the cog was loaded. They're
+now packed into 64 bit words so a 256 bit hash is 4 integers, compared with
+xor and a popcount. The packed index is saved to a binary file next to the
+json it was built from so loading it doesn't parse anything.
+"""
+
+import json
+import logging
+import os
+import struct
+
+import numpy as np
+
+terminal = logging.getLogger('terminal')
+
+MAGIC = b'PHIX'
+VERSION = 1
+# magic, version, amount of hashes, 64 bit words per hash
+_HEADER = struct.Struct('<4sHII')
+
+_bitwise_count = getattr(np, 'bitwise_count', None)
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+_H01 = np.uint64(0x0101010101010101)
+
+
+def popcount(x):
+    """Amount of set bits in every element of the uint64 array x"""
+    if _bitwise_count is not None:
+        return _bitwise_count(x)
+
+    # Older numpy. Count the bits in parallel inside each word
+    x = x - ((x >> np.uint64(1)) & _M1)
+    x = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+    x = (x + (x >> np.uint64(4))) & _M4
+    return (x * _H01) >> np.uint64(56)
+
+
+def pack_bits(bits):
+    """Packs a boolean array like imagehash.ImageHash.hash into uint64 words"""
+    data = np.packbits(np.asarray(bits, dtype=bool).ravel())
+    if len(data) % 8:
+        data = np.concatenate((data, np.zeros(8 - len(data) % 8, dtype=np.uint8)))
+    return data.view(np.uint64)
+
+
+def pack_hex(h):
+    """Packs a hex string in the format of str(imagehash.ImageHash)"""
+    data = bytes.fromhex(h)
+    if len(data) % 8:
+        data += b'\0' * (8 - len(data) % 8)
+    return np.frombuffer(data, dtype=np.uint64)
+
+
+class HashIndex:
+    """
+    Names and their packed hashes. hashes is a uint64 array with one row
+    per name. nearest scans every hash at once which with the amount of
+    sprites there are is faster than any tree or table lookup done in python
+    """
+    def __init__(self, hashes, names):
+        self.hashes = np.ascontiguousarray(hashes, dtype=np.uint64)
+        self.names = list(names)
+        if len(self.hashes) != len(self.names):
+            raise ValueError('Amount of hashes and names differ')
+
+        # Scanned one word of every hash at a time. Summing the words is
+        # a lot faster when they're in contiguous rows instead of columns
+        self._words = np.ascontiguousarray(self.hashes.reshape(len(self.names), -1).T)
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def words(self):
+        return self.hashes.shape[1] if self.hashes.ndim == 2 else 0
+
+    @classmethod
+    def from_hex(cls, items):
+        """Index from (hex hash, name) pairs"""
+        items = list(items)
+        hashes = np.array([pack_hex(h) for h, _ in items], dtype=np.uint64)
+        return cls(hashes, [name for _, name in items])
+
+    def distances(self, h):
+        """Hamming distances of every hash to the packed hash h"""
+        h = np.asarray(h, dtype=np.uint64).reshape(-1, 1)
+        return popcount(np.bitwise_xor(self._words, h)).sum(axis=0, dtype=np.int64)
+
+    def nearest(self, h):
+        """
+        Index of the closest hash to the packed hash h, its distance and how
+        many bits further the second closest one is. A small margin means the
+        match could just as well have been something else
+        """
+        distances = self.distances(h)
+        best = int(distances.argmin())
+        distance = int(distances[best])
+        if len(distances) < 2:
+            return best, distance, self.words * 64
+
+        distances[best] = self.words * 64 + 1
+        return best, distance, int(distances.min()) - distance
+
+    def save(self, path):
+        tmp = path + '.tmp'
+        names = '\n'.join(self.names).encode('utf-8')
+        with open(tmp, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, VERSION, len(self.names), self.words))
+            f.write(self.hashes.tobytes())
+            f.write(names)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        magic, version, amount, words = _HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path} is not a hash index or has a different version')
+
+        end = _HEADER.size + amount * words * 8
+        hashes = np.frombuffer(data, dtype=np.uint64, count=amount*words, offset=_HEADER.size)
+        names = data[end:].decode('utf-8').split('\n') if amount else []
+        return cls(hashes.reshape(amount, words), names)
+
+    @classmethod
+    def load_or_build(cls, json_path, path):
+        """
+        Loads the index from path. If it doesn't exist or is older than
+        the json of hex hashes and names at json_path it's built from the json
+        and saved to path
+        """
+        try:
+            if os.path.getmtime(path) >= os.path.getmtime(json_path):
+                return cls.load(path)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, struct.error):
+            terminal.exception(f'Failed to load hash index from {path}')
+
+        with open(json_path, 'r', encoding='utf-8') as f:
+            index = cls.from_hex(json.load(f).items())
+
+        try:
+            index.save(path)
+        except OSError:
+            terminal.exception(f'Failed to save hash index to {path}')
+
+        return index
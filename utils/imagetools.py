@@ -27,14 +27,13 @@ import os
 import subprocess
 from io import BytesIO
 from shlex import split
-from sys import platform
 from threading import Lock
 
 import aiohttp
 import geopatterns
 import magic
 import numpy as np
-from PIL import Image, ImageChops, ImageDraw, ImageSequence
+from PIL import Image, ImageChops, ImageDraw
 from colorthief import ColorThief as CF
 from colour import Color
 from geopatterns.utils import promap
@@ -55,9 +54,14 @@ try:
 except FileNotFoundError:
     MAGICK = ''
 
+# Gifs are encoded in process by default. With magick every gif is piped
+# through an ImageMagick process which is also the fallback on errors
+PIL_ENCODER = 'pil'
+MAGICK_ENCODER = 'magick'
+GIF_ENCODER = PIL_ENCODER
+
 MAX_COLOR_DIFF = 2.82842712475  # Biggest value produced by color_distance
 GLOW_LOCK = Lock()
-TRIMMING_LOCK = Lock()
 if not os.path.exists(IMAGES_PATH):
     os.mkdir(IMAGES_PATH)
 
@@ -144,7 +148,47 @@ def replace_color(im, color1, color2):
     return im
 
 
-def sepia(im, strength=0.75):
+def sepia(im, strength=0.75, encoder=None):
+    """
+    Sepia tone with some noise on top. Done in process with numpy by default.
+    encoder='magick' or an error in the numpy version uses ImageMagick
+    """
+    if (encoder or GIF_ENCODER) != MAGICK_ENCODER:
+        try:
+            return _sepia_numpy(im, strength)
+        except Exception:
+            logger.exception('Failed to apply sepia in process. Falling back to magick')
+
+    return _sepia_magick(im, strength)
+
+
+def _sepia_numpy(im, strength=0.75):
+    # Same formula as the -sepia-tone operator of ImageMagick
+    alpha = im.getchannel('A') if im.mode == 'RGBA' else None
+    rgb = np.asarray(im.convert('RGB'), dtype=np.float32) / 255
+    intensity = rgb @ np.array([0.298839, 0.586811, 0.114350], dtype=np.float32)
+    threshold = strength
+
+    out = np.empty(rgb.shape, dtype=np.float32)
+    out[..., 0] = np.where(intensity > threshold, 1, intensity + 1 - threshold)
+    out[..., 1] = np.where(intensity > 7 * threshold / 6, 1, intensity + 1 - 7 * threshold / 6)
+    out[..., 2] = np.where(intensity < threshold / 6, 0, intensity - threshold / 6)
+    np.maximum(out[..., 1:], threshold / 7, out=out[..., 1:])
+
+    # Normalize like magick does after toning. Darkest 2% and brightest 1% are clipped
+    flat = out.reshape(-1, 3)
+    low = np.percentile(flat, 2, axis=0)
+    high = np.percentile(flat, 99, axis=0)
+    out = np.clip((out - low) / np.maximum(high - low, 1e-6), 0, 1)
+
+    out = out * 255 + np.random.uniform(-7, 7, out.shape).astype(np.float32)
+    img = Image.fromarray(np.clip(out, 0, 255).astype(np.uint8))
+    if alpha is not None:
+        img.putalpha(alpha)
+    return img
+
+
+def _sepia_magick(im, strength=0.75):
     image = BytesIO()
     im.save(image, 'PNG')
     args = '{}convert - -sepia-tone {:.0%} -evaluate Uniform-noise 7 png:-'.format(MAGICK, strength)
@@ -282,18 +326,17 @@ def remove_background(image, blur=21, canny_thresh_1=10, canny_thresh_2=50,
     MASK_DILATE_ITER = mask_dilate_iter
     MASK_ERODE_ITER = mask_erode_iter
 
-    p = os.path.join(IMAGES_PATH, 'trimmed.png')
-    with TRIMMING_LOCK:
-        try:
-            image.save(p)
-            # Processing
-            # Read image
-            if platform == 'win32':
-                p = p.replace('\\', '/')  # Windows paths don't work in cv2
+    # Decode from memory instead of a shared file since this is run
+    # in multiple render processes at the same time
+    try:
+        buf = BytesIO()
+        image.save(buf, 'PNG')
+        img = cv2.imdecode(np.frombuffer(buf.getvalue(), np.uint8), cv2.IMREAD_COLOR)
+    except OSError:
+        return image
 
-            img = cv2.imread(p)
-        except OSError:
-            return image
+    if img is None:
+        return image
 
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 
@@ -341,7 +384,54 @@ async def image_from_url(url, client):
     return Image.open(await raw_image_from_url(url, client))
 
 
-async def raw_image_from_url(url, client, get_mime=False):
+# Download chunk sizes. Chunks grow from the minimum when the size of the
+# file isn't known beforehand
+MIN_CHUNK = 16384
+MAX_CHUNK = 262144
+# How much data is read at most while looking for the image dimensions
+MAX_HEADER_SIZE = 65536
+
+
+def _chunk_size(content_length):
+    if content_length <= 0:
+        return MIN_CHUNK
+
+    return min(max(content_length // 8, MIN_CHUNK), MAX_CHUNK)
+
+
+def check_image_header(buffer, max_pixels):
+    """
+    Check the dimensions of a partially downloaded image from its header.
+    Raises ImageSizeException if the image has more than max_pixels pixels.
+    Returns True when the check is done and False if more data is needed
+    """
+    pos = buffer.tell()
+    buffer.seek(0)
+    try:
+        w, h = Image.open(buffer).size
+    except Image.DecompressionBombError:
+        raise ImageSizeException(f'over {Image.MAX_IMAGE_PIXELS * 2}', max_pixels)
+    except (OSError, SyntaxError, ValueError):
+        # Header not complete yet. Leave the rest to the full decode
+        # if it isn't in the beginning of the file
+        return pos > MAX_HEADER_SIZE
+    finally:
+        buffer.seek(pos)
+
+    if w * h > max_pixels:
+        raise ImageSizeException(w * h, max_pixels)
+
+    return True
+
+
+async def raw_image_from_url(url, client, get_mime=False, max_size=8000000, max_pixels=None):
+    """
+    Download an image into a BytesIO.
+    Raises TypeError if the url isn't an image and OverflowError if it's bigger than
+    max_size bytes. If max_pixels is given the dimensions are checked as soon as
+    the image header has been downloaded and ImageSizeException is raised if
+    they're too big.
+    """
     data = None
     mime_type = None
     try:
@@ -350,26 +440,34 @@ async def raw_image_from_url(url, client, get_mime=False):
             if not r.headers.get('Content-Type', '').startswith('image'):
                 raise TypeError
 
-            max_size = 8000000
             size = int(r.headers.get('Content-Length', 0))
             if size > max_size:
                 raise OverflowError
 
             data = BytesIO()
-            chunk = 4096
+            chunk = _chunk_size(size)
             total = 0
-            async for d in r.content.iter_chunked(chunk):
+            header_checked = max_pixels is None
+            while True:
+                d = await r.content.read(chunk)
+                if not d:
+                    break
+
                 if total == 0:
                     mime_type = magic.from_buffer(d, mime=True)
-                    total += chunk
                     if not mime_type.startswith('image') and mime_type != 'application/octet-stream':
                         raise TypeError
 
-                total += chunk
+                total += len(d)
                 if total > max_size:
                     raise OverflowError
 
                 data.write(d)
+                if not header_checked:
+                    header_checked = check_image_header(data, max_pixels)
+
+                if size <= 0:
+                    chunk = min(chunk * 2, MAX_CHUNK)
         data.seek(0)
     except aiohttp.ClientError:
         logger.exception('Could not download image %s' % url)
@@ -542,22 +640,100 @@ def convert_frames(img, mode='RGBA'):
     return fixed_gif_frames(img, func)
 
 
-def func_to_gif(img, f, get_raw=True):
-    if max(img.size) > 600:
-        frames = [resize_keep_aspect_ratio(frame.convert('RGBA'), (600, 600), can_be_bigger=False, resample=Image.BILINEAR)
-                  for frame in ImageSequence.Iterator(img)]
+def get_frame_stack(img, max_size=None, max_frames=None):
+    """
+    Decode all frames of img into one (frames, height, width, 4) uint8 array.
+    Frames are resized to fit in max_size x max_size if they're bigger.
+    Returns the array and a list of frame durations
+    """
+    n_frames = getattr(img, 'n_frames', 1)
+    if max_frames is not None and n_frames > max_frames:
+        raise TooManyFrames(max_frames)
+
+    def func(frame):
+        frame = frame.convert('RGBA')
+        if max_size is not None and max(frame.size) > max_size:
+            frame = resize_keep_aspect_ratio(frame, (max_size, max_size), can_be_bigger=False,
+                                             resample=Image.BILINEAR)
+        return frame
+
+    frames = fixed_gif_frames(img, func)
+    duration = get_duration(frames)[:len(frames)]
+    return stack_frames(frames), duration
+
+
+def stack_frames(frames):
+    """Stack a list of images into one RGBA array"""
+    stack = np.empty((len(frames), frames[0].height, frames[0].width, 4), dtype=np.uint8)
+    for i, frame in enumerate(frames):
+        stack[i] = np.asarray(frame if frame.mode == 'RGBA' else frame.convert('RGBA'))
+    return stack
+
+
+def unstack_frames(stack):
+    return [Image.fromarray(frame, 'RGBA') for frame in stack]
+
+
+def tint_frames(stack, colors):
+    """
+    Multiply the color channels of every frame like ImageChops.multiply.
+    colors is one RGB color or an RGB color for each frame
+    """
+    n, h, w = stack.shape[:3]
+    colors = np.asarray(colors, dtype=np.uint8).reshape(-1, 3)
+    # All frames are multiplied in one call. A tint image with one color
+    # for each frame is made by stretching a column of n pixels
+    if len(colors) == 1:
+        tint = Image.new('RGBA', (w, n*h), tuple(colors[0].tolist()) + (255,))
     else:
-        frames = [frame.convert('RGBA') for frame in ImageSequence.Iterator(img)]
+        tint = np.full((len(colors), 1, 4), 255, dtype=np.uint8)
+        tint[:, 0, :3] = colors
+        tint = Image.fromarray(tint, 'RGBA').resize((w, n*h), Image.NEAREST)
+    out = ImageChops.multiply(_tall_image(stack), tint)
+    return np.asarray(out).reshape(stack.shape)
 
-    if len(frames) > 150:
-        raise TooManyFrames('Maximum amount of frames is 100')
 
-    images = []
-    for frame in frames:
-        images.append(f(frame))
+def _tall_image(stack):
+    """All frames of a frame stack as one tall image sharing the same memory"""
+    n, h, w = stack.shape[:3]
+    stack = np.ascontiguousarray(stack)
+    return Image.frombuffer('RGBA', (w, n*h), stack, 'raw', 'RGBA', 0, 1)
 
+
+def repeat_frames(stack, duration, min_frames):
+    """Repeat all frames until there are more than min_frames of them"""
+    repeats = 1
+    while len(stack) * repeats <= min_frames:
+        repeats *= 2
+
+    if repeats == 1:
+        return stack, list(duration)
+
+    return np.tile(stack, (repeats, 1, 1, 1)), list(duration) * repeats
+
+
+def transparent_mask(stack, threshold=128):
+    """Mask of the pixels that are transparent in a gif"""
+    return stack[..., 3] <= threshold
+
+
+def func_to_gif(img, f, get_raw=True, encoder=None, batched=False):
+    """
+    Apply f to every frame of img and make a gif of the results.
+    If batched is True f gets the whole frame stack made with get_frame_stack
+    and returns a new stack. Otherwise it's called with each frame as an image
+    """
+    stack, duration = get_frame_stack(img, max_size=600, max_frames=150)
+    if batched:
+        stack = f(stack)
+    else:
+        stack = stack_frames([f(frame) for frame in unstack_frames(stack)])
+
+    if get_raw and (encoder or GIF_ENCODER) != MAGICK_ENCODER:
+        return encode_gif(stack, duration, encoder=encoder)
+
+    images = unstack_frames(stack)
     data = BytesIO()
-    duration = get_duration(frames)
     images[0].info['duration'] = duration
     images[0].save(data, format='GIF', duration=duration, save_all=True, append_images=images[1:], loop=65535)
     data.seek(0)
@@ -569,69 +745,31 @@ def func_to_gif(img, f, get_raw=True):
     return data
 
 
-def gradient_flash(im, get_raw=True, transparency=None):
+def gradient_flash(im, get_raw=True, transparency=None, encoder=None):
     """
-    When get_raw is True gif is optimized with magick fixing some problems that PIL
+    When get_raw is True the gif is encoded with encode_gif fixing some problems that PIL
     creates. It is the suggested method of using this funcion
     """
-
-    frames = []
-    if max(im.size) > 600:
-        def f(frame):
-            return resize_keep_aspect_ratio(frame.convert('RGBA'), (600, 600), can_be_bigger=False, resample=Image.BILINEAR)
-    else:
-        def f(frame):
-            return frame.convert('RGBA')
-
-    while True:
-        frames.append(f(im))
-        if len(frames) > 150:
-            raise TooManyFrames('fuck this')
-        try:
-            im.seek(im.tell() + 1)
-        except EOFError:
-            frames[-1] = f(im)
-            break
+    stack, duration = get_frame_stack(im, max_size=600, max_frames=150)
 
     if transparency is None and im.mode == 'RGBA' or im.info.get('background', None) is not None or im.info.get('transparency', None) is not None:
         transparency = True
 
-    extended = 1
-    while len(frames) <= 20:
-        frames.extend([frame.copy() for frame in frames])
-        extended += 1
+    stack, duration = repeat_frames(stack, duration, 20)
 
-    gradient = Color('red').range_to('#ff0004', len(frames))
-    frames_ = zip(frames, gradient)
-    images = []
-    try:
-        for frame in frames_:
-            frame, g = frame
-            img = Image.new('RGBA', im.size, tuple(map(lambda v: int(v*255), g.get_rgb())))
-            img = ImageChops.multiply(frame, img)
-            if transparency:
-                # Use a mask to map the transparent area in the gif frame
-                # optimize MUST be set to False when saving or transparency
-                # will most likely be broken
-                # source http://www.pythonclub.org/modules/pil/convert-png-gif
-                alpha = img.split()[3]
-                img = img.convert('P', palette=Image.ADAPTIVE, colors=255)
-                mask = Image.eval(alpha, lambda a: 255 if a <= 128 else 0)
-                img.paste(255, mask=mask)
-                img.info['transparency'] = 255
-                img.info['background'] = 255
-            images.append(img)
-    except Exception as e:
-        logger.exception('{} Failed to create gif'.format(e))
+    gradient = Color('red').range_to('#ff0004', len(stack))
+    colors = [[int(v*255) for v in g.get_rgb()] for g in gradient]
+    stack = tint_frames(stack, colors)
 
-    data = BytesIO()
-    if isinstance(frames[0].info.get('duration', None), list):
-        duration = frames[0].info['duration']
-        for i in range(1, extended):
-            duration.extend(duration)
+    if get_raw and (encoder or GIF_ENCODER) != MAGICK_ENCODER:
+        return encode_gif(stack, duration, transparency=bool(transparency), encoder=encoder)
+
+    if transparency:
+        images = _transparent_frames(stack)
     else:
-        duration = [frame.info.get('duration', 20) for frame in frames]
+        images = unstack_frames(stack)
 
+    data = BytesIO()
     images[0].save(data, format='gif', duration=duration, save_all=True, append_images=images[1:], loop=65535, disposal=2, optimize=False)
 
     data.seek(0)
@@ -652,27 +790,188 @@ def apply_transparency(frames):
     if not transparency:
         return frames
 
+    return _transparent_frames(stack_frames(frames))
+
+
+def _transparent_frames(stack):
+    # Map the transparent area of each frame to the transparent palette index.
+    # optimize MUST be set to False when saving or transparency
+    # will most likely be broken
+    indices, palette = quantize_frames(stack)
+    indices[transparent_mask(stack)] = _TRANSPARENT_INDEX
+    return _palette_frames(indices, palette.getpalette())
+
+
+def _palette_frames(indices, palette_colors):
     images = []
-    for img in frames:
-        # Use a mask to map the transparent area in the gif frame
-        # optimize MUST be set to False when saving or transparency
-        # will most likely be broken
-        # source http://www.pythonclub.org/modules/pil/convert-png-gif
-        alpha = img.split()[3]
-        img = img.convert('P', palette=Image.ADAPTIVE, colors=255)
-        mask = Image.eval(alpha, lambda a: 255 if a <= 128 else 0)
-        img.paste(255, mask=mask)
-        img.info['transparency'] = 255
-        img.info['background'] = 255
+    for frame in indices:
+        img = Image.frombytes('P', (frame.shape[1], frame.shape[0]), frame.tobytes())
+        img.putpalette(palette_colors)
+        img.info['transparency'] = _TRANSPARENT_INDEX
+        img.info['background'] = _TRANSPARENT_INDEX
         images.append(img)
 
     return images
 
 
-def optimize_gif(gif_bytes):
+def optimize_gif(gif_bytes, encoder=None):
+    """
+    Re-encode gif data to make it smaller. Returns a BytesIO.
+    In process encoding is used unless encoder is 'magick' or it fails
+    """
+    if (encoder or GIF_ENCODER) != MAGICK_ENCODER:
+        try:
+            img = Image.open(BytesIO(gif_bytes))
+            frames = convert_frames(img, 'RGBA')
+            return _encode_gif_pil(frames, get_duration(frames), loop=img.info.get('loop'))
+        except Exception:
+            logger.exception('Failed to optimize gif in process. Falling back to magick')
+
+    return _optimize_gif_magick(gif_bytes)
+
+
+def _optimize_gif_magick(gif_bytes):
     cmd = '{}convert - -dither none -deconstruct -layers optimize -dispose background -matte -depth 8 gif:-'.format(MAGICK)
     p = subprocess.Popen(split(cmd), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
     p.stdin.write(gif_bytes)
     out, err = p.communicate()
     buff = BytesIO(out)
     return buff
+
+
+def encode_gif(frames, duration, loop=65535, transparency=None, encoder=None, tolerance=0):
+    """
+    Encode RGBA frames into an optimized gif. Returns a BytesIO.
+
+    Args:
+        frames: list of frames or a frame stack from get_frame_stack.
+                Images are converted to RGBA if needed
+        duration: Frame duration in ms or a list of durations for each frame
+        loop: Loop count of the gif. None if it should only play once
+        transparency: Whether to keep transparent areas. By default checked from the frames
+        encoder: 'pil' for the in process encoder or 'magick' to pipe it through ImageMagick
+        tolerance: Max difference of a color channel between frames that is still
+                   considered unchanged. Bigger values give smaller files but lose detail
+    """
+    if not isinstance(duration, (list, tuple)):
+        duration = [duration] * len(frames)
+
+    if (encoder or GIF_ENCODER) != MAGICK_ENCODER:
+        try:
+            return _encode_gif_pil(frames, duration, loop, transparency, tolerance)
+        except Exception:
+            logger.exception('Failed to encode gif in process. Falling back to magick')
+
+    stack = frames if isinstance(frames, np.ndarray) else stack_frames(frames)
+    if transparency:
+        frames = _transparent_frames(stack)
+    else:
+        frames = unstack_frames(stack)
+
+    kwargs = {'loop': loop} if loop is not None else {}
+    data = BytesIO()
+    frames[0].save(data, format='GIF', save_all=True, append_images=frames[1:],
+                   duration=list(duration), optimize=False, disposal=2, **kwargs)
+    return _optimize_gif_magick(data.getvalue())
+
+
+# Palette index reserved for transparent and unchanged pixels
+_TRANSPARENT_INDEX = 255
+
+
+def _shared_palette(stack, max_frames=16, sample_size=128):
+    """Quantize a strip of downscaled sample frames to get one palette for all frames"""
+    n, h, w = stack.shape[:3]
+    step = max(n // max_frames, 1)
+    scale = min(sample_size / max(w, h), 1)
+    size = (max(int(w*scale), 1), max(int(h*scale), 1))
+    samples = range(0, n, step)[:max_frames]
+
+    strip = Image.new('RGBA', (size[0], size[1]*len(samples)))
+    for i, idx in enumerate(samples):
+        frame = _tall_image(stack[idx:idx+1])
+        strip.paste(frame.resize(size, Image.NEAREST), (0, i*size[1]))
+    strip = strip.convert('RGB')
+
+    palette = strip.quantize(colors=_TRANSPARENT_INDEX, method=Image.FASTOCTREE)
+    colors = palette.getpalette()[:_TRANSPARENT_INDEX*3]
+    colors += [0] * (_TRANSPARENT_INDEX*3 - len(colors))
+    # Make the last slot a copy of the first one so no pixel needs it
+    palette.putpalette(colors + colors[:3])
+    return palette
+
+
+def quantize_frames(stack, palette=None):
+    """
+    Quantize every frame of a frame stack to one shared palette.
+    The frames are quantized as one tall image instead of one by one.
+    Returns an array of palette indices and the palette image.
+    The last index of the palette is left unused so it can mark transparency
+    """
+    if palette is None:
+        palette = _shared_palette(stack)
+
+    n, h, w = stack.shape[:3]
+    tall = _tall_image(stack).convert('RGB')
+    try:
+        quantized = tall.quantize(palette=palette, dither=0)
+    except TypeError:
+        # Older PIL versions don't have the dither argument
+        quantized = tall.quantize(palette=palette)
+
+    indices = np.array(quantized, dtype=np.uint8).reshape(n, h, w)
+    indices[indices == _TRANSPARENT_INDEX] = 0
+    return indices, palette
+
+
+def _encode_gif_pil(frames, duration, loop=65535, transparency=None, tolerance=0):
+    stack = frames if isinstance(frames, np.ndarray) else stack_frames(frames)
+    n = len(stack)
+    if not isinstance(duration, (list, tuple)):
+        duration = [duration] * n
+    duration = list(duration)[:n]
+    duration += [duration[-1] if duration else 20] * (n - len(duration))
+
+    # Merge identical consecutive frames and add up their durations
+    keep = np.ones(n, dtype=bool)
+    keep[1:] = (stack[1:] != stack[:-1]).reshape(n - 1, -1).any(axis=1)
+    groups = np.cumsum(keep) - 1
+    durations = np.bincount(groups, weights=duration).astype(int).tolist()
+    stack = stack[keep]
+
+    alpha = transparent_mask(stack)
+    if transparency is None:
+        transparency = bool(alpha.any())
+
+    indices, palette = quantize_frames(stack)
+    palette_colors = palette.getpalette()
+
+    if transparency:
+        # Frames replace each other completely (disposal 2) so transparent
+        # areas can become transparent again after being drawn on
+        indices[alpha] = _TRANSPARENT_INDEX
+    elif tolerance > 0:
+        # Opaque frames are drawn on top of the previous one (disposal 1).
+        # Pixels that didn't change are left transparent which leaves only
+        # the changed area to be encoded. PIL crops the frame to its bounding box.
+        # Small changes add up over frames so the drawn canvas must be tracked
+        lut = np.array(palette_colors[:768], dtype=np.int16).reshape(-1, 3)
+        canvas = lut[indices[0]]
+        for frame, idx in zip(stack[1:], indices[1:]):
+            diff = np.abs(frame[..., :3].astype(np.int16) - canvas).max(axis=2)
+            changed = diff > tolerance
+            canvas[changed] = lut[idx[changed]]
+            idx[~changed] = _TRANSPARENT_INDEX
+    elif len(indices) > 1:
+        # Without tolerance the canvas is always the previous frame
+        unchanged = indices[1:] == indices[:-1]
+        indices[1:][unchanged] = _TRANSPARENT_INDEX
+
+    images = _palette_frames(indices, palette_colors)
+    kwargs = {'loop': loop} if loop is not None else {}
+    data = BytesIO()
+    images[0].save(data, format='GIF', save_all=True, append_images=images[1:],
+                   duration=durations, transparency=_TRANSPARENT_INDEX,
+                   disposal=2 if transparency else 1, optimize=False, **kwargs)
+    data.seek(0)
+    return data
@@ -0,0 +1,186 @@
+"""
+Decoded template images used by the image commands.
+
+Templates are decoded once and kept in memory. When they're preloaded before
+the render workers are forked the workers share the decoded data with the bot
+process instead of each decoding every template again for every render.
+Workers count template uses in their own copy of the registry so the render
+pool sends the counts back to the bot with every result.
+"""
+
+import logging
+import os
+import time
+
+from PIL import Image, ImageSequence
+
+logger = logging.getLogger('debug')
+terminal = logging.getLogger('terminal')
+
+TEMPLATES = os.path.join('data', 'templates')
+
+
+class Template:
+    __slots__ = ('name', 'image', 'frames', 'mask', 'load_time', 'uses')
+
+    def __init__(self, name, image=None, frames=None, mask=None, load_time=0):
+        self.name = name
+        self.image = image
+        self.frames = frames
+        self.mask = mask
+        self.load_time = load_time
+        self.uses = 0
+
+    @property
+    def size(self):
+        """Memory used by the decoded pixels in bytes"""
+        images = self.frames or [self.image]
+        size = sum(len(im.getbands()) * im.width * im.height for im in images)
+        if self.mask is not None:
+            size += self.mask.width * self.mask.height
+        return size
+
+
+class TemplateRegistry:
+    """
+    Keeps decoded templates in memory up to max_bytes.
+    Still images are converted to RGB or RGBA and the alpha band of RGBA
+    images is split into a paste mask beforehand. Templates that don't fit
+    in the budget are decoded from disk every time they're used.
+
+    get returns a copy that can be drawn on. shared and mask return the cached
+    image itself which must not be modified.
+    """
+    def __init__(self, path=TEMPLATES, max_bytes=256*1024*1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._templates = {}
+        self.memory = 0
+        self.startup_time = 0
+        self.skipped = []
+        self.misses = 0
+        self._pid = os.getpid()
+
+    def _decode(self, name):
+        t = time.perf_counter()
+        im = Image.open(os.path.join(self.path, name))
+        if getattr(im, 'is_animated', False):
+            frames = [frame.copy().convert('RGBA') for frame in ImageSequence.Iterator(im)]
+            return Template(name, frames=frames, load_time=(time.perf_counter() - t) * 1000)
+
+        if im.mode not in ('RGB', 'RGBA'):
+            im = im.convert('RGBA')
+        else:
+            im.load()
+
+        mask = im.getchannel('A') if im.mode == 'RGBA' else None
+        return Template(name, image=im, mask=mask, load_time=(time.perf_counter() - t) * 1000)
+
+    def preload(self, max_bytes=None):
+        """Decode every template in the template folder that fits in the memory budget"""
+        if max_bytes is not None:
+            self.max_bytes = max_bytes
+
+        t = time.perf_counter()
+        try:
+            names = sorted(os.listdir(self.path))
+        except OSError:
+            terminal.exception('Failed to list templates')
+            return
+
+        names = [name for name in names if name not in self._templates and name not in self.skipped]
+        if not names:
+            return
+
+        for name in names:
+            try:
+                template = self._decode(name)
+            except OSError:
+                logger.exception(f'Failed to load template {name}')
+                continue
+
+            size = template.size
+            if self.memory + size > self.max_bytes:
+                self.skipped.append(name)
+                continue
+
+            self._templates[name] = template
+            self.memory += size
+
+        self.startup_time += (time.perf_counter() - t) * 1000
+        terminal.info(f'Loaded {len(self._templates)} templates ({self.memory/1024/1024:.1f}MB) '
+                      f'in {self.startup_time:.0f}ms')
+        if self.skipped:
+            terminal.warning(f'Templates over the memory budget: {", ".join(self.skipped)}')
+
+    def _check_fork(self):
+        # A forked worker starts with the counts of the bot. Only its own are sent back
+        pid = os.getpid()
+        if pid != self._pid:
+            self._pid = pid
+            self._reset_counts()
+
+    def _reset_counts(self):
+        self.misses = 0
+        for template in self._templates.values():
+            template.uses = 0
+
+    def take_counts(self):
+        """Uses by template and misses since the last call. Called in the render workers"""
+        self._check_fork()
+        uses = {name: t.uses for name, t in self._templates.items() if t.uses}
+        misses = self.misses
+        self._reset_counts()
+        return uses, misses
+
+    def add_counts(self, uses, misses):
+        """Adds counts from take_counts of a worker"""
+        for name, amount in uses.items():
+            template = self._templates.get(name)
+            if template is not None:
+                template.uses += amount
+        self.misses += misses
+
+    def _get(self, name):
+        self._check_fork()
+        template = self._templates.get(name)
+        if template is None:
+            self.misses += 1
+            return self._decode(name)
+
+        template.uses += 1
+        return template
+
+    def shared(self, name):
+        """The cached image. Don't modify it"""
+        return self._get(name).image
+
+    def get(self, name):
+        """Copy of the template that can be modified"""
+        return self._get(name).image.copy()
+
+    def mask(self, name):
+        """Paste mask of the template or None if it has no alpha"""
+        return self._get(name).mask
+
+    def frames(self, name):
+        """Copies of the frames of an animated template"""
+        template = self._get(name)
+        if template.frames is None:
+            return [template.image.copy()]
+
+        return [frame.copy() for frame in template.frames]
+
+    def stats(self):
+        return {'templates': {name: {'bytes': t.size,
+                                     'load_ms': round(t.load_time, 2),
+                                     'uses': t.uses}
+                              for name, t in self._templates.items()},
+                'memory': self.memory,
+                'max_bytes': self.max_bytes,
+                'startup_ms': round(self.startup_time, 2),
+                'skipped': list(self.skipped),
+                'misses': self.misses}
+
+
+templates = TemplateRegistry()
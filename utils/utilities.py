@@ -160,36 +160,87 @@ def split_string(to_split, list_join='', maxlen=2000, splitter=' '):
     raise NotImplementedError('This only works with dicts and strings for now')
 
 
-async def mean_volume(file, loop, threadpool, avconv=False, duration=0):
-    """Gets the mean volume from"""
-    audio.debug('Getting mean volume')
+_volume_regex = re.compile(r'(mean|max)_volume: ([\-\d.]+) dB')
+_loudness_regex = re.compile(r'I:\s+([\-\d.]+) LUFS')
+
+
+def volume_command(file, avconv=False, duration=0, ebur128=False):
+    """ffmpeg arguments that print the volume stats of a 3 minute sample of file"""
     ffmpeg = 'ffmpeg' if not avconv else 'avconv'
-    file = '"{}"'.format(file)
 
     if not duration:
         start, stop = 0, 180
     else:
         start = int(duration * 0.2)
         stop = start + 180
-    cmd = '{0} -i {1} -ss {2} -t {3} -filter:a "volumedetect" -vn -sn -f null /dev/null'.format(ffmpeg, file, start, stop)
-    audio.debug(cmd)
-    args = shlex.split(cmd)
-    process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
 
-    out, err = await loop.run_in_executor(threadpool, process.communicate)
-    out += err
+    filters = 'volumedetect,ebur128' if ebur128 else 'volumedetect'
+    return [ffmpeg, '-i', file, '-ss', str(start), '-t', str(stop), '-filter:a', filters,
+            '-vn', '-sn', '-f', 'null', '/dev/null']
 
-    matches = re.findall('mean_volume: [\-\d.]+ dB', str(out))
 
-    if not matches:
+def parse_volume_stats(out):
+    """
+    Parses the output of the command from volume_command.
+    Returns a dict with mean and max volume in dB and the integrated
+    loudness in LUFS if it was measured or None if the output has no mean volume
+    """
+    volumes = dict(_volume_regex.findall(out))
+    if 'mean' not in volumes:
         return
+
     try:
-        volume = float(matches[0].split(' ')[1])
-        audio.debug('Parsed volume is {}'.format(volume))
-        return volume
+        stats = {'mean': float(volumes['mean']),
+                 'max': float(volumes['max']) if 'max' in volumes else None,
+                 'loudness': None}
     except ValueError:
         return
 
+    loudness = _loudness_regex.findall(out)
+    if loudness:
+        try:
+            # The summary at the end is the last match
+            stats['loudness'] = float(loudness[-1])
+        except ValueError:
+            pass
+
+    return stats
+
+
+def volume_stats(file, avconv=False, duration=0, ebur128=False, timeout=None):
+    """
+    Blocking version of mean_volume that returns all of the stats from
+    parse_volume_stats. ffmpeg is killed if it runs longer than timeout
+    """
+    args = volume_command(file, avconv=avconv, duration=duration, ebur128=ebur128)
+    audio.debug(' '.join(args))
+    try:
+        process = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        audio.debug(f'Volume analysis of {file} timed out')
+        return
+
+    out = (process.stdout + process.stderr).decode('utf-8', 'replace')
+    return parse_volume_stats(out)
+
+
+async def mean_volume(file, loop, threadpool, avconv=False, duration=0):
+    """Gets the mean volume from"""
+    audio.debug('Getting mean volume')
+    args = volume_command(file, avconv=avconv, duration=duration)
+    audio.debug(' '.join(args))
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    out, err = await loop.run_in_executor(threadpool, process.communicate)
+    stats = parse_volume_stats((out + err).decode('utf-8', 'replace'))
+
+    if stats is None:
+        return
+
+    volume = stats['mean']
+    audio.debug('Parsed volume is {}'.format(volume))
+    return volume
+
 
 def get_cached_song(name):
     if os.path.isfile(name):
@@ -852,11 +903,11 @@ async def send_paged_message(bot, ctx, pages, embed=False, starting_idx=0, page_
                 await message.edit(content=page)
 
     def check(reaction, user):
-        return paged.check(reaction, user) and ctx.author.id == user.id and reaction.message.id == message.id
+        return paged.check(reaction, user) and ctx.author.id == user.id
 
     while True:
         try:
-            result = await bot.wait_for('reaction_changed', check=check, timeout=60)
+            result = await bot.wait_for_reaction(message, check=check, timeout=60)
         except asyncio.TimeoutError:
             return
 
@@ -922,7 +973,11 @@ async def check_blacklist(ctx):
     if not await bot.check_auth(ctx):
         return False
 
-    overwrite_perms = await bot.dbutil.check_blacklist('(command="%s" OR command IS NULL)' % ctx.command, ctx.author, ctx, True)
+    auth_cache = getattr(bot, 'auth_cache', None)
+    if auth_cache is not None:
+        overwrite_perms = await auth_cache.check_blacklist(ctx.command.qualified_name, ctx.author, ctx, True)
+    else:
+        overwrite_perms = await bot.dbutil.check_blacklist('(command="%s" OR command IS NULL)' % ctx.command, ctx.author, ctx, True)
     msg = PermValues.BLACKLIST_MESSAGES.get(overwrite_perms, None)
     if isinstance(overwrite_perms, int):
         if ctx.guild and ctx.guild.owner.id == ctx.author.id: